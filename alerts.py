@@ -0,0 +1,234 @@
+"""
+Alerts on what changed between consecutive monitoring runs.
+
+A nightly run recomputes the whole change point table, and most of it is the same as the night before. Here the current
+calculate_change_points output is compared with the previous run's table, change points are matched per feature within
+a time tolerance, and only the differences are reported:
+new_change_point: a trend/volatility change point with no previous one of the same feature within the tolerance
+disappeared_change_point: a previous change point with no current one within the tolerance
+new_bad_data: a NaN / Inf / Zero / Constant record (a row, or the start of a run with bad_data='runs') with no previous
+              record of the same feature and description within the tolerance
+
+update_alerts keeps the previous table next to the alert file, so a nightly job only needs:
+
+    df_cp = calculate_change_points(df, explode=False)
+    alert = update_alerts(df_cp, './data_s3/OVForecast_cp.pickle', './data_s3/OVForecast_alerts.json')
+    if alert['n_alerts'] > 0:
+        generate_vlm_report(df[alert['features']], 'alerts.html', change_points=df_cp)
+
+The alert file is small JSON (the alerts and the list of affected features), so downstream alerting and a partial
+report of the affected features do not need the full table or pdf.
+"""
+import os
+import json
+import datetime
+import numpy as np
+import pandas as pd
+import profiling
+from change_point_table import BAD_DATA_CHECKS
+
+
+ALERT_VERSION = 1
+ALERT_TYPES = ['new_change_point', 'disappeared_change_point', 'new_bad_data']
+
+
+
+def _event_times(values)->np.ndarray:
+    """
+    Comparable times of change point datetimes: datetime64[ns] for dates / timestamps, float for numeric indexes
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iuf':
+        return values.astype(float)
+    return pd.to_datetime(values).values
+
+
+def change_point_events(change_points:pd.DataFrame, key_columns:list = [], series_end:bool = True)->pd.DataFrame:
+    """
+    One row per change point or bad data record of a change point table, exploded or not
+
+    INPUTS:
+    change_points: pd.dataframe output of calculate_change_points (or calculate_grouped_change_points)
+    key_columns: extra columns identifying a series together with feature_name, e.g. the entity columns
+    series_end: the table holds the artificial change point at the end of each series (keep_last_changepoint=True, the
+                default), which is dropped. False for tables from keep_last_changepoint=False
+
+    OUTPUT:
+    events: key_columns, feature_name, datetime, description and, for bad data runs, end_datetime and length
+    """
+    series = list(key_columns) + ['feature_name']
+    columns = series + ['datetime', 'description'] + [col for col in ['end_datetime','length'] if col in change_points.columns]
+    # exploded tables repeat each change point once per percentile. A new frame, without the table's attrs (a DataFrame
+    # of series percentiles, which pd.concat cannot compare)
+    events = pd.DataFrame({col:change_points[col].values for col in columns}, columns=columns)
+    events = events.drop_duplicates(subset=series + ['datetime','description'])
+    if series_end:
+        trend = (events['description'] == 'trend/volatility').values
+        is_end = np.zeros(len(events), dtype=bool)
+        is_end[trend] = ~events[trend].duplicated(subset=series, keep='last').values
+        events = events[~is_end]
+    return events.reset_index(drop=True)
+
+
+def _match_events(current:pd.DataFrame, previous:pd.DataFrame, group_columns:list, tolerance)->tuple:
+    """
+    One to one matching of current and previous events of the same group within the tolerance, nearest first
+
+    OUTPUT:
+    (current matched, previous matched) boolean arrays
+    """
+    both = pd.concat([current[group_columns], previous[group_columns]], ignore_index=True)
+    codes = both.groupby(group_columns, sort=False, dropna=False).ngroup().values
+    cur = pd.DataFrame({'group':codes[:len(current)], 'time':_event_times(current['datetime'].values), 'cur':np.arange(len(current))})
+    prev = pd.DataFrame({'group':codes[len(current):], 'time':_event_times(previous['datetime'].values), 'prev':np.arange(len(previous))})
+    if cur['time'].dtype.kind == 'M':
+        tolerance = pd.Timedelta(tolerance)
+    cur_matched = np.zeros(len(current), dtype=bool)
+    prev_matched = np.zeros(len(previous), dtype=bool)
+    # each pass matches the current events to their nearest free previous event, the closest of several claims wins,
+    # and the losers try again against the remaining previous events
+    while True:
+        left = cur[~cur_matched].dropna(subset=['time']).sort_values('time')
+        right = prev[~prev_matched].dropna(subset=['time']).sort_values('time')
+        if len(left) == 0 or len(right) == 0:
+            break
+        pairs = pd.merge_asof(left, right.rename(columns={'time':'prev_time'}), left_on='time', right_on='prev_time', by='group',
+                              direction='nearest', tolerance=tolerance).dropna(subset=['prev'])
+        if len(pairs) == 0:
+            break
+        pairs['gap'] = np.abs(pairs['time'] - pairs['prev_time'])
+        pairs = pairs.sort_values(['gap','cur'], kind='stable').drop_duplicates(subset=['prev'])
+        cur_matched[pairs['cur'].values.astype(int)] = True
+        prev_matched[pairs['prev'].values.astype(int)] = True
+    return cur_matched, prev_matched
+
+
+def change_point_alerts(change_points:pd.DataFrame, previous:pd.DataFrame, tolerance = '7d', key_columns:list = [],
+                        series_end:bool = True, since = None)->pd.DataFrame:
+    """
+    Differences between the change point tables of two runs
+
+    INPUTS:
+    change_points: current calculate_change_points output
+    previous: the previous run's output (same settings)
+    tolerance: largest shift of a change point between runs that still counts as the same change point, a pd.Timedelta
+               or string such as '7d' for datetime indexes, a number for numeric indexes. With the default PELT jump of 5
+               a change point can move by up to 5 rows when the start of the history moves
+    key_columns: extra columns identifying a series together with feature_name, e.g. the entity columns of
+                 calculate_grouped_change_points
+    series_end: as in change_point_events
+    since: ignore records of both tables before this datetime, e.g. the start of the current run's history when the runs
+           cover a rolling window (otherwise change points leaving the window are reported as disappeared)
+
+    OUTPUT:
+    alerts: pd.DataFrame with key_columns, feature_name, alert (one of ALERT_TYPES), datetime, description and, for bad data
+            runs, end_datetime and length
+    """
+    with profiling.stage('alerts'):
+        current = change_point_events(change_points, key_columns, series_end)
+        previous = change_point_events(previous, key_columns, series_end)
+        if since is not None:
+            current = current[~(_event_times(current['datetime'].values) < _event_times([since])[0])]
+            previous = previous[~(_event_times(previous['datetime'].values) < _event_times([since])[0])]
+        group_columns = list(key_columns) + ['feature_name', 'description']
+        cur_matched, prev_matched = _match_events(current, previous, group_columns, tolerance)
+
+        is_trend = (current['description'] == 'trend/volatility').values
+        is_bad = current['description'].isin(BAD_DATA_CHECKS).values
+        is_new = ~cur_matched & (is_trend | is_bad)
+        new = current[is_new].copy()
+        new.insert(len(key_columns) + 1, 'alert', np.where(is_trend[is_new], 'new_change_point', 'new_bad_data'))
+        gone = previous[~prev_matched & (previous['description'] == 'trend/volatility').values].copy()
+        gone.insert(len(key_columns) + 1, 'alert', 'disappeared_change_point')
+        alerts = pd.concat([new, gone], ignore_index=True)
+        if len(alerts) > 0:
+            order = np.lexsort((_event_times(alerts['datetime'].values),
+                                alerts.groupby(list(key_columns) + ['feature_name'], sort=True, dropna=False).ngroup().values))
+            alerts = alerts.iloc[order]
+        return alerts.reset_index(drop=True)
+
+
+
+def _json_value(value):
+    """
+    JSON representation of a table value: ISO strings for dates / timestamps, None for missing values
+    """
+    if value is pd.NaT:
+        return None
+    if isinstance(value, (pd.Timestamp, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, np.datetime64):
+        return None if np.isnat(value) else pd.Timestamp(value).isoformat()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def save_alerts(alerts:pd.DataFrame, path:str, baseline:bool = False)->dict:
+    """
+    Write alerts to a JSON file, replacing it atomically
+
+    INPUTS:
+    alerts: output of change_point_alerts
+    path: .json file
+    baseline: there was no previous run to compare with (the alerts are then empty)
+
+    OUTPUT:
+    alert: dict as written, with version, created, baseline, n_alerts, counts (per alert type), features (affected
+           feature names) and alerts (list of records)
+    """
+    records = [{col:_json_value(value) for col, value in record.items()} for record in alerts.to_dict('records')]
+    alert = {'version':ALERT_VERSION,
+             'created':datetime.datetime.now(datetime.timezone.utc).isoformat(),
+             'baseline':baseline,
+             'n_alerts':len(records),
+             'counts':{alert_type:int((alerts['alert'] == alert_type).sum()) if len(alerts) > 0 else 0 for alert_type in ALERT_TYPES},
+             'features':[_json_value(name) for name in pd.unique(alerts['feature_name'])] if len(alerts) > 0 else [],
+             'alerts':records}
+    tmp_path = path+'.'+str(os.getpid())+'.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(alert, f, indent=1)
+    os.replace(tmp_path, path)
+    return alert
+
+
+def read_alerts(path:str)->dict:
+    """
+    Alert file written by save_alerts, with the alerts as a pd.DataFrame
+    """
+    with open(path) as f:
+        alert = json.load(f)
+    if alert.get('version') != ALERT_VERSION:
+        raise ValueError(path+' is not a supported alert file (version '+str(alert.get('version'))+')')
+    alert['alerts'] = pd.DataFrame(alert['alerts'])
+    return alert
+
+
+def update_alerts(change_points:pd.DataFrame, state_path:str, alert_file:str, tolerance = '7d', key_columns:list = [],
+                  series_end:bool = True, since = None)->dict:
+    """
+    Compare a run's change points with the previous run's, write the alert file and keep the current table for the next run
+
+    INPUTS:
+    change_points: current calculate_change_points output
+    state_path: pickle of the previous run's table, replaced by change_points. When it does not exist yet the alert file
+                is written with no alerts and baseline true
+    alert_file: .json file for save_alerts
+    tolerance, key_columns, series_end, since: as in change_point_alerts
+
+    OUTPUT:
+    alert: dict written to alert_file (see save_alerts)
+    """
+    baseline = not os.path.exists(state_path)
+    if baseline:
+        alerts = change_point_alerts(change_points, change_points, tolerance, key_columns, series_end, since)
+    else:
+        previous = pd.read_pickle(state_path, compression=None)
+        alerts = change_point_alerts(change_points, previous, tolerance, key_columns, series_end, since)
+    alert = save_alerts(alerts, alert_file, baseline)
+    tmp_path = state_path+'.'+str(os.getpid())+'.tmp'
+    change_points.to_pickle(tmp_path, compression=None)
+    os.replace(tmp_path, state_path)
+    return alert
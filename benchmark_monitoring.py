@@ -0,0 +1,390 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+from model_monitoring import ChangePointBuilder, series_percentiles, synthetic_features, calculate_change_points, drop_end_changepoints, generate_vlm_display
+import segmentation
+import profiling
+
+
+
+def _synthetic_records(n_features:int, n_change_points:int, n_bad:int, n_history:int = 365, percentiles:list = [25,50,75], seed:int = 1234)->list:
+    '''
+    Synthetic per-feature change point records in the ChangePointBuilder.add format
+
+    INPUTS: n_features: number of features
+            n_change_points: number of trend/volatility segments per feature
+            n_bad: number of NaN / Inf rows per feature
+
+    OUTPUTS: list of (feature_name, bad_x, bad_description, seg_x, seg_values) tuples
+    '''
+    rng = np.random.RandomState(seed)
+    x = pd.date_range('2022-01-01', periods=n_history, freq='1d')
+    records = []
+    for i in range(n_features):
+        # distinct, increasing dates for the NaN, Inf and segment rows (the legacy explode needs a unique, sorted index)
+        idx = np.sort(rng.choice(n_history, n_bad+n_change_points, replace=False))
+        idx_bad, idx_seg = idx[:n_bad], idx[n_bad:]
+        description = ['NaN']*(n_bad//2) + ['Inf']*(n_bad - n_bad//2)
+        seg_values = np.sort(rng.randn(n_change_points, len(percentiles)), axis=1)
+        records.append(('feature_%05d' % i, x[idx_bad], description, x[idx_seg], seg_values))
+    return records
+
+
+def _legacy_concat_build(records:list, percentiles:list = [25,50,75], explode:bool = True)->pd.DataFrame:
+    '''
+    Change point dataframe built the way calculate_change_points used to: one pd.concat per record block,
+    one per segment, then a date conversion and a column-wise explode
+    '''
+    df_cp = pd.DataFrame({})
+    for feature_name, bad_x, bad_description, seg_x, seg_values in records:
+        for desc in ['NaN', 'Inf']:
+            x_bad = [xb for xb, d in zip(bad_x, bad_description) if d == desc]
+            dfn = pd.DataFrame({'feature_name':[feature_name]*len(x_bad),'datetime':x_bad,'percentile':[np.nan]*len(x_bad),'value':[np.nan]*len(x_bad),'description':[desc]*len(x_bad)})
+            df_cp = pd.concat([df_cp, dfn])
+        for k in range(len(seg_x)):
+            dfn = pd.DataFrame({'feature_name':[feature_name],'datetime':[seg_x[k]],'percentile':[percentiles],'value':[seg_values[k]],'description':['trend/volatility']})
+            df_cp = pd.concat([df_cp, dfn])
+    df_cp['datetime']=pd.to_datetime(df_cp['datetime']).dt.date
+    if explode:
+        df_cp = df_cp.set_index(['feature_name','datetime']).apply(pd.Series.explode).reset_index()
+    return df_cp.reset_index(drop=True)
+
+
+def _builder_build(records:list, percentiles:list = [25,50,75], explode:bool = True)->pd.DataFrame:
+    builder = ChangePointBuilder(percentiles)
+    for record in records:
+        builder.add(*record)
+    return builder.build(explode=explode)
+
+
+def _time_call(func, *args, repeat:int = 3, **kwargs)->float:
+    '''
+    Best wall time in seconds of repeat calls to func
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_result_builder(n_features_list:list = [10, 50, 200],
+                         n_change_points_list:list = [2, 10, 40],
+                         n_bad:int = 10,
+                         repeat:int = 3)->pd.DataFrame:
+    '''
+    Compare the legacy pd.concat accumulation against ChangePointBuilder as the number of features and change points grows
+
+    INPUTS: n_features_list: feature counts to sweep
+            n_change_points_list: segments per feature to sweep
+            n_bad: NaN / Inf rows per feature
+            repeat: timing repeats (best is kept)
+
+    OUTPUTS: pd.DataFrame with one row per (n_features, n_change_points) and the legacy / builder wall times
+    '''
+    rows = []
+    for n_features in n_features_list:
+        for n_change_points in n_change_points_list:
+            records = _synthetic_records(n_features, n_change_points, n_bad)
+            t_legacy = _time_call(_legacy_concat_build, records, repeat=repeat)
+            t_builder = _time_call(_builder_build, records, repeat=repeat)
+            rows.append({'n_features':n_features, 'n_change_points':n_change_points,
+                         'n_records':n_features*(n_change_points+n_bad),
+                         'legacy_s':t_legacy, 'builder_s':t_builder,
+                         'speedup':t_legacy/t_builder})
+    return pd.DataFrame(rows)
+
+
+def _loop_segment_percentiles(y:np.ndarray, bkps:list, percentiles:list = [25,50,75])->list:
+    bounds = [0] + list(bkps)
+    return [np.percentile(y[bounds[k]:bounds[k+1]], percentiles) for k in range(len(bkps))]
+
+
+def _loop_series_percentiles(df:pd.DataFrame, percentiles:list = [25,50,75])->list:
+    return [np.percentile(df[col].values, percentiles) for col in df.columns]
+
+
+def bench_segment_percentiles(n_history_list:list = [365, 10000, 100000],
+                              n_segments_list:list = [2, 20, 200],
+                              n_features:int = 200,
+                              repeat:int = 3,
+                              seed:int = 1234)->pd.DataFrame:
+    '''
+    Compare one np.percentile call per segment against segmentation.segment_percentiles (single sort per feature), and
+    one np.percentile call per feature against the vectorized series_percentiles used by the report
+
+    INPUTS: n_history_list: series lengths to sweep
+            n_segments_list: segments per series to sweep
+            n_features: number of features for the whole-series comparison
+            repeat: timing repeats (best is kept)
+
+    OUTPUTS: pd.DataFrame with one row per (n_history, n_segments) and the loop / vectorized wall times
+    '''
+    rng = np.random.RandomState(seed)
+    rows = []
+    for n_history in n_history_list:
+        y = rng.randn(n_history)
+        df = pd.DataFrame(rng.randn(n_history, n_features))
+        t_series_loop = _time_call(_loop_series_percentiles, df, repeat=repeat)
+        t_series = _time_call(series_percentiles, df, repeat=repeat)
+        for n_segments in n_segments_list:
+            bkps = sorted(rng.choice(np.arange(1, n_history), min(n_segments, n_history-1) - 1, replace=False)) + [n_history]
+            t_loop = _time_call(_loop_segment_percentiles, y, bkps, repeat=repeat)
+            t_batched = _time_call(segmentation.segment_percentiles, y, bkps, repeat=repeat)
+            rows.append({'n_history':n_history, 'n_segments':len(bkps),
+                         'loop_s':t_loop, 'batched_s':t_batched, 'speedup':t_loop/t_batched,
+                         'series_loop_s':t_series_loop, 'series_batched_s':t_series})
+    return pd.DataFrame(rows)
+
+
+def _legacy_drop_end_changepoints(change_points:pd.DataFrame, explode:bool = True, keep_percentiles:list = [25,50,75])->pd.DataFrame:
+    '''
+    drop_end_changepoints the way it used to be: MultiIndex set / drop round trip and a column-wise explode
+    '''
+    df_cp = change_points.copy()
+    df_cp1 = df_cp.set_index(['feature_name','datetime'])
+    df_cp2 = df_cp.drop_duplicates(subset='feature_name',keep='last').set_index(['feature_name','datetime'])
+    df_cp3 = df_cp1.drop(df_cp2.index).round(2).reset_index()
+    if explode:
+        df_cp3 = df_cp3.set_index(['feature_name','datetime']).apply(pd.Series.explode).reset_index()
+        df_cp3 = df_cp3[df_cp3['percentile'].isin(keep_percentiles)]
+    return df_cp3.reset_index(drop=True)
+
+
+def bench_drop_end_changepoints(n_rows_list:list = [1000, 10000, 100000, 400000],
+                                n_change_points:int = 20,
+                                n_bad:int = 5,
+                                repeat:int = 3)->pd.DataFrame:
+    '''
+    Compare the legacy drop_end_changepoints against the vectorized one on change point tables of growing size
+
+    INPUTS: n_rows_list: approximate change point rows (before exploding) to sweep
+            n_change_points: trend/volatility segments per feature
+            n_bad: NaN / Inf rows per feature
+            repeat: timing repeats (best is kept)
+
+    OUTPUTS: pd.DataFrame with one row per (n_rows, explode) with the legacy / vectorized wall times and whether the
+             outputs are identical
+    '''
+    rows = []
+    for n_rows in n_rows_list:
+        n_features = max(1, n_rows//(n_change_points + n_bad))
+        change_points = _builder_build(_synthetic_records(n_features, n_change_points, n_bad), explode=False)
+        for explode in [False, True]:
+            t_legacy = _time_call(_legacy_drop_end_changepoints, change_points, explode=explode, repeat=repeat)
+            t_vectorized = _time_call(drop_end_changepoints, change_points, explode=explode, repeat=repeat)
+            identical = _legacy_drop_end_changepoints(change_points, explode=explode).equals(drop_end_changepoints(change_points, explode=explode))
+            rows.append({'n_features':n_features, 'n_rows':len(change_points), 'explode':explode,
+                         'legacy_s':t_legacy, 'vectorized_s':t_vectorized,
+                         'speedup':t_legacy/t_vectorized, 'identical':identical})
+    return pd.DataFrame(rows)
+
+
+PIPELINE_STAGES = ['calculate_change_points', 'drop_end_changepoints', 'generate_vlm_display']
+
+
+def _peak_rss_mb()->float:
+    '''
+    High-water resident set size of this process in MB (nan where the resource module is unavailable)
+    '''
+    if resource is None:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+
+def _pipeline_workload(n_features:int, n_history:int, stages:list, freq:str, seed:int, kwargs:dict)->dict:
+    '''
+    Run the monitoring stages on one synthetic workload, meant to run in a fresh process so the peak RSS is its own
+
+    OUTPUTS: dict of the workload size, per stage wall times (<stage>_s), the peak RSS after each stage (<stage>_rss_mb)
+             and the total seconds of each profiling stage within them (profile_<stage>_s, see profiling.py).
+             A stage that raises is recorded in 'error' and ends the workload, so one failure does not lose the sweep
+    '''
+    record = {'n_features':n_features, 'n_history':n_history, 'freq':freq, 'error':None, 'baseline_rss_mb':_peak_rss_mb()}
+    t0 = time.perf_counter()
+    df = synthetic_features(n_features, n_history, end_date='2022-06-06', freq=freq, seed=seed)
+    record['synthetic_features_s'] = time.perf_counter() - t0
+    record['synthetic_features_rss_mb'] = _peak_rss_mb()
+    change_points = None
+    with tempfile.TemporaryDirectory() as tmp_dir, profiling.StageProfiler() as profiler:
+        for stage in stages:
+            t0 = time.perf_counter()
+            try:
+                if stage == 'calculate_change_points':
+                    change_points = calculate_change_points(df, explode=False, **kwargs)
+                    record['n_change_points'] = len(change_points)
+                elif stage == 'drop_end_changepoints':
+                    drop_end_changepoints(change_points, explode=False)
+                elif stage == 'generate_vlm_display':
+                    generate_vlm_display(df, os.path.join(tmp_dir, 'vlm.pdf'), change_points=change_points)
+            except Exception as e:
+                record['error'] = stage+': '+type(e).__name__+': '+str(e)
+                break
+            record[stage+'_s'] = time.perf_counter() - t0
+            record[stage+'_rss_mb'] = _peak_rss_mb()
+    record['total_s'] = sum(record.get(stage+'_s', np.nan) for stage in stages)
+    if len(profiler.records) > 0:
+        for name, seconds in profiler.stage_summary()['total_s'].items():
+            record['profile_'+name+'_s'] = seconds
+    record['peak_rss_mb'] = _peak_rss_mb()
+    return record
+
+
+def bench_pipeline(n_features_list:list = [7, 28, 112],
+                   n_history_list:list = [365, 730],
+                   stages:list = PIPELINE_STAGES,
+                   freq:str = '1d',
+                   seed:int = 1234,
+                   **kwargs)->pd.DataFrame:
+    '''
+    Wall time and peak memory of the monitoring pipeline on synthetic_features workloads of growing width and length.
+    Each workload runs in a freshly spawned process
+
+    INPUTS: n_features_list: feature counts to sweep
+            n_history_list: history lengths (rows) to sweep
+            stages: subset of PIPELINE_STAGES to run, in order (drop_end_changepoints and generate_vlm_display need
+                    calculate_change_points)
+            freq: index frequency of the synthetic features
+            seed: random seed of the synthetic features
+            kwargs: passed to calculate_change_points, e.g. cost_model='normal'
+
+    OUTPUTS: pd.DataFrame with one row per (n_features, n_history), per stage wall times and peak RSS
+    '''
+    unknown = [stage for stage in stages if stage not in PIPELINE_STAGES]
+    if len(unknown) > 0:
+        raise ValueError('Unknown stages '+str(unknown)+', expected a subset of '+str(PIPELINE_STAGES))
+    if 'calculate_change_points' not in stages and len(stages) > 0:
+        raise ValueError('drop_end_changepoints and generate_vlm_display need the calculate_change_points stage')
+    rows = []
+    context = multiprocessing.get_context('spawn')
+    for n_history in n_history_list:
+        for n_features in n_features_list:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                rows.append(executor.submit(_pipeline_workload, n_features, n_history, list(stages), freq, seed, kwargs).result())
+    return pd.DataFrame(rows)
+
+
+def _stationary_features(n_features:int, n_history:int, freq:str, noise:str, seed:int)->pd.DataFrame:
+    '''
+    Features without any change: 'normal' or heavy tailed 'student_t' (3 degrees of freedom) noise around random offsets
+    '''
+    rng = np.random.RandomState(seed)
+    if noise == 'normal':
+        X = rng.randn(n_history, n_features)
+    elif noise == 'student_t':
+        X = rng.standard_t(3, (n_history, n_features))
+    else:
+        raise ValueError('Unknown noise '+str(noise)+", expected 'normal' or 'student_t'")
+    x = pd.date_range(end=pd.Timestamp('2022-06-06'), periods=n_history, freq=freq)
+    return pd.DataFrame(X + 5*rng.randn(n_features), index=x, columns=['feature_%05d' % i for i in range(n_features)])
+
+
+def bench_false_positives(n_features:int = 200,
+                          noise_list:list = ['normal', 'student_t'],
+                          settings:list = [{'freq':'1d', 'n_history':730, 'rolling_sd_window':10},
+                                           {'freq':'1d', 'n_history':730, 'rolling_sd_window':None},
+                                           {'freq':'1h', 'n_history':24*120, 'cost_model':'normal', 'coarse_freq':'1d', 'rolling_sd_window':10},
+                                           {'freq':'1h', 'n_history':24*120, 'cost_model':'normal', 'coarse_freq':'1d', 'rolling_sd_window':None}],
+                          seed:int = 1234)->pd.DataFrame:
+    '''
+    Share of stationary features with any trend/volatility change point, which should be (close to) zero whatever the
+    noise distribution
+
+    INPUTS: n_features: number of stationary features per workload
+            noise_list: noise distributions, 'normal' and / or 'student_t'
+            settings: workloads, each with the index freq and n_history of the features and any other
+                      calculate_change_points arguments (e.g. cost_model, coarse_freq, rolling_sd_window)
+
+    OUTPUTS: pd.DataFrame with one row per (noise, setting): the number and share of features flagged and the wall time
+    '''
+    rows = []
+    for noise in noise_list:
+        for setting in settings:
+            kwargs = {k:v for k, v in setting.items() if k not in ['freq', 'n_history']}
+            df = _stationary_features(n_features, setting['n_history'], setting['freq'], noise, seed)
+            t0 = time.perf_counter()
+            change_points = calculate_change_points(df, explode=False, keep_last_changepoint=False, **kwargs)
+            elapsed = time.perf_counter() - t0
+            flagged = change_points.loc[change_points['description'] == 'trend/volatility', 'feature_name'].nunique()
+            rows.append(dict(setting, noise=noise, n_features=n_features, n_flagged=flagged,
+                             flagged_share=flagged/n_features, seconds=elapsed))
+    return pd.DataFrame(rows)
+
+
+def _git_revision()->str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results:pd.DataFrame, path:str, benchmark:str, params:dict = {})->list:
+    '''
+    Append benchmark results to a JSON lines file, one record per row tagged with the run metadata, so runs on different
+    commits / machines can be compared with pd.read_json(path, lines=True)
+
+    INPUTS: results: pd.DataFrame returned by a benchmark
+            path: results file, e.g. ./benchmark_results.jsonl
+            benchmark: name of the benchmark
+            params: benchmark parameters to record
+
+    OUTPUTS: list of the records written
+    '''
+    meta = {'benchmark':benchmark,
+            'timestamp':pd.Timestamp.now().isoformat(timespec='seconds'),
+            'git_revision':_git_revision(),
+            'python':platform.python_version(),
+            'numpy':np.__version__,
+            'pandas':pd.__version__,
+            'platform':platform.platform(),
+            'cpu_count':os.cpu_count(),
+            'params':params}
+    records = [dict(meta, **row) for row in json.loads(results.to_json(orient='records'))]
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record)+'\n')
+    return records
+
+
+BENCHMARKS = {'result_builder':bench_result_builder,
+              'segment_percentiles':bench_segment_percentiles,
+              'drop_end_changepoints':bench_drop_end_changepoints,
+              'pipeline':bench_pipeline,
+              'false_positives':bench_false_positives}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Model monitoring benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--n-features', type=int, nargs='+', help='feature counts to sweep (result_builder, pipeline)')
+    parser.add_argument('--n-history', type=int, nargs='+', help='history lengths to sweep (segment_percentiles, pipeline)')
+    parser.add_argument('--stages', nargs='+', choices=PIPELINE_STAGES, help='pipeline stages to run')
+    parser.add_argument('--cost-model', help='calculate_change_points cost model of the pipeline benchmark, e.g. normal')
+    parser.add_argument('--output', help='append the results to this JSON lines file, e.g. benchmark_results.jsonl')
+    args = parser.parse_args()
+    params = {'n_features_list':args.n_features, 'n_history_list':args.n_history, 'stages':args.stages, 'cost_model':args.cost_model}
+    params = {k:v for k, v in params.items() if v is not None}
+    func = BENCHMARKS[args.benchmark]
+    if args.benchmark != 'pipeline':
+        params = {k:v for k, v in params.items() if k in func.__code__.co_varnames}
+    results = func(**params)
+    print(results.to_string(index=False))
+    if args.output is not None:
+        save_results(results, args.output, args.benchmark, params)
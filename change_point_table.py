@@ -0,0 +1,334 @@
+"""
+Change point table of the monitoring pipeline: its schema and the bad data records.
+
+ChangePointBuilder collects each feature's segment ends, percentile levels and bad data records and builds the table
+returned by calculate_change_points, one row per change point with the levels as lists or exploded. Bad data (NaN, Inf,
+zero and constant values) is found for a block of features at once and reported per row or per contiguous run, and
+drop_end_changepoints removes the end of series rows that every segmentation reports.
+"""
+import numpy as np
+import pandas as pd
+import profiling
+
+
+
+def drop_end_changepoints(change_points:pd.DataFrame,explode=True,keep_percentiles=[25,50,75],key_columns:list=[])->pd.DataFrame:
+    '''
+    Drop artifical changepoints at end of timeseries
+    
+    Every row sharing a series' last (feature_name, datetime) is dropped, found with one vectorized last-row mask,
+    and list-valued percentile columns are exploded in a single pass.
+    
+    INPUTS: change_points: pd.dataframe output of calculate_changepoints
+            key_columns: extra columns identifying a series together with feature_name, e.g. the entity columns of
+                         calculate_grouped_change_points
+    
+    OUTPUTS: dfcp: pd.DataFrame output with end of file change points dropped
+    '''
+    with profiling.stage('drop_end_changepoints'):
+        series = list(key_columns) + ['feature_name']
+        if len(key_columns) == 0:
+            codes = pd.factorize(change_points['feature_name'].values)[0]
+        else:
+            codes = change_points.groupby(series, sort=False, dropna=False).ngroup().values
+        dates = change_points['datetime'].values
+        # datetime of the last row of each series
+        is_last = ~change_points.duplicated(subset=series, keep='last').values
+        last_dates = np.empty(int(is_last.sum()), dtype=dates.dtype)
+        last_dates[codes[is_last]] = dates[is_last]
+        keep = dates != last_dates[codes]
+        
+        columns = series + ['datetime'] + [col for col in change_points.columns if col not in series + ['datetime']]
+        df_cp3 = change_points.loc[keep, columns].round({col:2 for col in columns[len(series)+1:]})
+        if explode:
+            list_columns = [col for col in ['percentile','value'] if col in df_cp3.columns and df_cp3[col].dtype == object]
+            if len(list_columns) > 0:
+                df_cp3 = df_cp3.explode(list_columns)
+            df_cp3 = df_cp3[df_cp3['percentile'].isin(keep_percentiles)]
+        return df_cp3.reset_index(drop=True)
+
+
+def _object_array(items)->np.ndarray:
+    """
+    1d object array of items (without numpy unpacking nested sequences such as tuple feature names)
+    """
+    arr = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        arr[i] = item
+    return arr
+
+
+BAD_DATA_CHECKS = ['NaN','Inf','Zero','Constant']
+BAD_DATA_OUTPUTS = ['rows','runs']
+
+
+class ChangePointBuilder:
+    """
+    Columnar accumulator for change point records.
+    
+    Per-feature bad data records and trend/volatility segments are collected as numpy blocks and the
+    change point dataframe is built once in build(), so the cost is linear in the number of records
+    rather than quadratic as with repeated pd.concat calls.
+    
+    INPUTS:
+    percentiles: the percentiles reported for every segment
+    key_columns: optional extra key columns (e.g. ['penalty']) placed before feature_name, one key tuple per add call
+    bad_data: 'rows' (one record per bad timestamp) or 'runs' (one record per bad data run, with end_datetime and length columns)
+    """
+    columns = ['feature_name','datetime','percentile','value','description']
+    run_columns = ['feature_name','datetime','end_datetime','length','percentile','value','description']
+    
+    def __init__(self, percentiles:list = [25,50,75], key_columns:list = [], bad_data:str = 'rows'):
+        if bad_data not in BAD_DATA_OUTPUTS:
+            raise ValueError('Unknown bad_data output '+str(bad_data)+', expected one of '+str(BAD_DATA_OUTPUTS))
+        self.percentiles = percentiles
+        self.key_columns = list(key_columns)
+        self.bad_data = bad_data
+        self._keys = []
+        self._names = []
+        self._n_bad = []
+        self._n_seg = []
+        self._x = []
+        self._description = []
+        self._values = []
+        self._end_x = []
+        self._length = []
+    
+    def add(self, feature_name, bad_x, bad_description, seg_x, seg_values, keys:tuple = (), bad_end_x = None, bad_length = None):
+        """
+        Add the records of one feature
+        
+        INPUTS:
+        feature_name: name of the feature
+        bad_x: index values of the bad data rows (or of the first row of each run)
+        bad_description: description of each bad data record ('NaN', 'Inf', 'Zero' or 'Constant')
+        seg_x: index values of the segment ends
+        seg_values: 2d array (n_segments x n_percentiles) of segment percentile levels
+        keys: values of the key_columns for these records
+        bad_end_x: index values of the last row of each run (bad_data='runs' only)
+        bad_length: number of rows in each run (bad_data='runs' only)
+        """
+        if self.bad_data == 'runs':
+            if bad_end_x is None or bad_length is None:
+                raise ValueError('bad_end_x and bad_length are needed for bad_data runs')
+            self._end_x.append(pd.Index(bad_end_x))
+            self._length.append(np.asarray(bad_length, dtype=float))
+        self._keys.append(tuple(keys))
+        self._names.append(feature_name)
+        self._n_bad.append(len(bad_x))
+        self._n_seg.append(len(seg_x))
+        self._x.append(pd.Index(bad_x))
+        self._x.append(pd.Index(seg_x))
+        self._description.append(np.asarray(bad_description, dtype=object))
+        self._values.append(np.asarray(seg_values, dtype=float).reshape(len(seg_x), len(self.percentiles)))
+    
+    def build(self, explode:bool = True, as_date:bool = True)->pd.DataFrame:
+        """
+        Build the change point dataframe in a single pass
+        
+        INPUTS:
+        explode: one row per percentile level (True) or percentiles / values kept in list form (False)
+        as_date: convert datetimes to dates
+        
+        OUTPUT:
+        df_cp: pandas dataframe of change points
+        """
+        n_pc = len(self.percentiles)
+        n_bad = np.array(self._n_bad, dtype=int)
+        n_rows = n_bad + np.array(self._n_seg, dtype=int)
+        n_total = int(n_rows.sum())
+        
+        # rows of each feature: bad data rows first, then segments
+        offset = np.arange(n_total) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+        is_seg = offset >= np.repeat(n_bad, n_rows)
+        
+        feature_name = np.repeat(_object_array(self._names), n_rows)
+        keys = {col:np.repeat(_object_array([k[j] for k in self._keys]), n_rows) for j, col in enumerate(self.key_columns)}
+        if n_total > 0:
+            datetime = self._x[0].append(self._x[1:])
+        else:
+            datetime = pd.DatetimeIndex([])
+        if as_date:
+            datetime = pd.to_datetime(datetime).date
+        else:
+            datetime = np.asarray(datetime)
+        description = np.empty(n_total, dtype=object)
+        description[is_seg] = 'trend/volatility'
+        if len(self._description) > 0:
+            description[~is_seg] = np.concatenate(self._description)
+        values = np.full((n_total, n_pc), np.nan)
+        if len(self._values) > 0:
+            values[is_seg] = np.concatenate(self._values)
+        runs = {}
+        if self.bad_data == 'runs':
+            length = np.full(n_total, np.nan)
+            if int(n_bad.sum()) > 0:
+                end_x = self._end_x[0].append(self._end_x[1:])
+                length[~is_seg] = np.concatenate(self._length)
+            else:
+                end_x = pd.DatetimeIndex([])
+            # NaT on the segment rows
+            end_datetime = pd.Series(end_x, index=np.flatnonzero(~is_seg)).reindex(np.arange(n_total)).values
+            if as_date:
+                end_datetime = pd.to_datetime(end_datetime).date
+            runs = {'end_datetime':end_datetime, 'length':length}
+        
+        if explode:
+            counts = np.where(is_seg, n_pc, 1)
+            rows = np.repeat(np.arange(n_total), counts)
+            pos = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+            percentile = _object_array(self.percentiles)[pos]
+            percentile[~is_seg[rows]] = np.nan
+            value = values[rows, pos].astype(object)
+            feature_name, datetime, description = feature_name[rows], datetime[rows], description[rows]
+            keys = {col:k[rows] for col, k in keys.items()}
+            runs = {col:r[rows] for col, r in runs.items()}
+        else:
+            percentile = np.empty(n_total, dtype=object)
+            value = np.empty(n_total, dtype=object)
+            for i in range(n_total):
+                percentile[i] = self.percentiles if is_seg[i] else np.nan
+                value[i] = values[i] if is_seg[i] else np.nan
+        
+        data = dict(keys)
+        data.update({'feature_name':feature_name,
+                     'datetime':datetime,
+                     'percentile':percentile,
+                     'value':value,
+                     'description':description})
+        data.update(runs)
+        columns = self.run_columns if self.bad_data == 'runs' else self.columns
+        return pd.DataFrame(data, columns=self.key_columns+columns)
+
+
+def _bad_data_runs(Y:np.ndarray, checks:list = ['NaN','Inf'], min_constant_run:int = 7)->tuple:
+    """
+    Contiguous runs of bad data in every column of a 2d array, found in one vectorized pass per check
+    
+    NaN, Inf and Zero runs are the rising / falling edges of the column masks. Constant runs are runs of identical
+    consecutive finite values (excluding zeros when 'Zero' is also checked). A legitimate series can hold a value for
+    a few rows, so Zero and Constant runs shorter than min_constant_run are not reported.
+    
+    INPUTS:
+    Y: 2d numpy array (n_history x n_features) of feature values (a 1d array is treated as a single feature)
+    checks: subset of BAD_DATA_CHECKS
+    min_constant_run: minimum length of a reported Zero or Constant run
+    
+    OUTPUT:
+    col, start, length, description: one entry per run, ordered by column, then check (in checks order), then start row
+    """
+    unknown = [check for check in checks if check not in BAD_DATA_CHECKS]
+    if len(unknown) > 0:
+        raise ValueError('Unknown bad data checks '+str(unknown)+', expected a subset of '+str(BAD_DATA_CHECKS))
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    n, ny = Y.shape
+    cols, starts, lengths, kinds = [], [], [], []
+    for k, check in enumerate(checks):
+        if check == 'Constant':
+            # a run starts wherever the value differs from the previous row (NaN never equals NaN)
+            new_run = np.ones((ny, n), dtype=bool)
+            new_run[:, 1:] = Y[1:].T != Y[:-1].T
+            flat = np.flatnonzero(new_run)
+            col, start = flat//n, flat%n
+            length = np.diff(np.append(flat, n*ny))
+            value = Y[start, col]
+            keep = (length >= min_constant_run) & np.isfinite(value)
+            if 'Zero' in checks:
+                keep &= value != 0
+        else:
+            #identify nans / infs / zeros
+            if check == 'NaN':
+                mask = np.isnan(Y)
+            elif check == 'Inf':
+                mask = np.isinf(Y)
+            else:
+                mask = Y == 0
+            edges = np.zeros((ny, n+2), dtype=np.int8)
+            edges[:, 1:-1] = mask.T
+            edges = np.diff(edges, axis=1)
+            col, start = np.nonzero(edges == 1)
+            length = np.nonzero(edges == -1)[1] - start
+            keep = length >= (min_constant_run if check == 'Zero' else 1)
+        cols.append(col[keep])
+        starts.append(start[keep])
+        lengths.append(length[keep])
+        kinds.append(np.full(int(keep.sum()), k))
+    if len(checks) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=object)
+    col, start, length, kind = [np.concatenate(a) for a in (cols, starts, lengths, kinds)]
+    order = np.lexsort((start, kind, col))
+    return col[order], start[order], length[order], np.array(checks, dtype=object)[kind[order]]
+
+
+def _bad_data_blocks(x, Y:np.ndarray, checks:list = ['NaN','Inf'], min_constant_run:int = 7, bad_data:str = 'rows')->list:
+    """
+    Bad data records of every column of Y in the ChangePointBuilder.add format
+    
+    INPUTS:
+    x: index (datetimes) of the feature timeseries
+    Y: 2d numpy array (n_history x n_features) of feature values
+    checks, min_constant_run: as in _bad_data_runs
+    bad_data: 'runs' for one record per run or 'rows' for one record per bad row
+    
+    OUTPUT:
+    list with one dict per column of bad_x, bad_description and (runs only) bad_end_x, bad_length
+    """
+    Y = np.asarray(Y)
+    ny = Y.shape[1] if Y.ndim == 2 else 1
+    col, start, length, description = _bad_data_runs(Y, checks, min_constant_run)
+    if bad_data == 'rows':
+        # expand the runs back to one record per row
+        row = np.repeat(start, length) + np.arange(int(length.sum())) - np.repeat(np.cumsum(length) - length, length)
+        col, description = np.repeat(col, length), np.repeat(description, length)
+        bounds = np.searchsorted(col, np.arange(ny+1))
+        return [dict(bad_x=x[row[bounds[j]:bounds[j+1]]],
+                     bad_description=description[bounds[j]:bounds[j+1]]) for j in range(ny)]
+    bounds = np.searchsorted(col, np.arange(ny+1))
+    end = start + length - 1
+    return [dict(bad_x=x[start[bounds[j]:bounds[j+1]]],
+                 bad_description=description[bounds[j]:bounds[j+1]],
+                 bad_end_x=x[end[bounds[j]:bounds[j+1]]],
+                 bad_length=length[bounds[j]:bounds[j+1]]) for j in range(ny)]
+
+
+def bad_data_runs(dfin:pd.DataFrame, checks:list = ['NaN','Inf'], min_constant_run:int = 7)->pd.DataFrame:
+    """
+    Contiguous runs of bad data (NaN, Inf, zero or constant values) in a dataframe of timeseries data
+    
+    INPUTS:
+    dfin: Input pandas dataframe
+    checks: subset of ['NaN','Inf','Zero','Constant']
+    min_constant_run: minimum number of rows of a reported Zero / Constant run
+    
+    OUTPUT:
+    df_runs: pandas dataframe with one row per run (feature_name, datetime, end_datetime, length, description)
+    """
+    col, start, length, description = _bad_data_runs(dfin.values, checks, min_constant_run)
+    x = dfin.index
+    return pd.DataFrame({'feature_name':_object_array(list(dfin.columns))[col],
+                         'datetime':x[start],
+                         'end_datetime':x[start + length - 1],
+                         'length':length,
+                         'description':description})
+
+
+def _column_stats(x, Y:np.ndarray, percentiles:list = [25,50,75], bad_data_checks:list = ['NaN','Inf'], min_constant_run:int = 7, bad_data:str = 'rows')->list:
+    """
+    Per-feature statistics of a block of features from one vectorized pass over the block: bad data records and
+    whole-series percentiles
+    
+    INPUTS:
+    x: index (datetimes) of the feature timeseries
+    Y: 2d numpy array (n_history x n_block) of feature values
+    remaining inputs as in calculate_change_points
+    
+    OUTPUT:
+    list with one (bad data ChangePointBuilder.add keyword arguments, whole-series percentiles) tuple per column
+    """
+    with profiling.stage('bad_data'):
+        bad = _bad_data_blocks(x, Y, bad_data_checks, min_constant_run, bad_data)
+    with profiling.stage('series_percentiles'):
+        y_percentiles = np.percentile(np.asarray(Y, dtype=float), percentiles, axis=0).T.reshape(Y.shape[1], len(percentiles))
+    return list(zip(bad, y_percentiles))
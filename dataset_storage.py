@@ -0,0 +1,268 @@
+"""
+Chunked columnar dataset storage, as an alternative to pickling whole DataFrames.
+
+A dataset is a directory named with the ModelName_DateStamp_Version convention (e.g. ./data_s3/OVForecast_20220606_1)
+holding one numpy .npy file per column per block of chunk_rows rows, plus a manifest.json describing the columns,
+dtypes, index and shards. Loading reads only the shards of the requested columns and row range, and uncompressed
+shards can be memory-mapped so a monitoring job touches just the bytes it needs. With compress=True each shard is a
+compressed .npz file instead (smaller to store and transfer, but decompressed in full when read).
+
+Only the numpy format is used (no pickles), so numeric, bool, datetime64 and string columns are supported. A timezone
+aware DatetimeIndex is stored as its UTC datetime64 values, with the timezone in the manifest.
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+
+def dataset_name(model_name:str, date_stamp:str = None, version:int = 1)->str:
+    """
+    Dataset name following the ModelName_DateStamp_Version convention
+
+    INPUTS:
+    model_name: name of the model, e.g. OVForecast
+    date_stamp: YYYYMMDD date stamp (defaults to today)
+    version: dataset version for the date
+
+    OUTPUT:
+    name: e.g. OVForecast_20220606_1
+    """
+    if '_' in model_name:
+        raise ValueError('model_name cannot contain underscores: '+model_name)
+    if date_stamp is None:
+        date_stamp = pd.Timestamp.today().strftime('%Y%m%d')
+    return model_name+'_'+str(date_stamp)+'_'+str(int(version))
+
+
+def _shard_file(column:int, chunk:int, compress:bool)->str:
+    """
+    File name of a shard, column -1 is the index
+    """
+    prefix = 'index' if column < 0 else 'c%05d' % column
+    return prefix+'_r%05d' % chunk+('.npz' if compress else '.npy')
+
+
+def _storable(values:np.ndarray, label:str)->tuple:
+    """
+    numpy array that can be saved without pickling and the pandas dtype to restore on load, label naming the values in
+    errors (e.g. 'Column x' or 'Index')
+    """
+    dtype = str(values.dtype)
+    if values.dtype.kind in 'biufcmM':
+        return values, dtype
+    if values.dtype.kind == 'O' and pd.api.types.infer_dtype(values, skipna=False) in ('string', 'empty'):
+        return values.astype(str), 'object'
+    raise TypeError(label+' of dtype '+dtype+' cannot be stored, expected numeric, bool, datetime or string values')
+
+
+def _sha256(path:str)->str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def save_dataset(df:pd.DataFrame, path:str, chunk_rows:int = 1000000, compress:bool = False, overwrite:bool = False)->dict:
+    """
+    Save a DataFrame as a chunked columnar dataset
+
+    INPUTS:
+    df: DataFrame to save. Column names must be strings or integers
+    path: dataset directory, e.g. './data_s3/'+dataset_name('OVForecast')
+    chunk_rows: rows per shard
+    compress: write compressed .npz shards (not memory-mappable)
+    overwrite: replace an existing dataset at path (datasets are otherwise immutable)
+
+    OUTPUT:
+    manifest: dict, as written to path/manifest.json
+    """
+    if os.path.exists(path) and not overwrite:
+        raise FileExistsError(path+' already exists, bump the version or pass overwrite=True')
+    for col in df.columns:
+        if not isinstance(col, (str, int, np.integer)):
+            raise TypeError('Column names must be strings or integers, got '+repr(col))
+    chunk_rows = max(1, int(chunk_rows))
+    n_rows = len(df)
+    n_chunks = max(1, int(np.ceil(n_rows/chunk_rows)))
+
+    if isinstance(df.index, pd.RangeIndex):
+        index = {'kind':'range', 'name':df.index.name, 'start':int(df.index.start), 'step':int(df.index.step)}
+        arrays = []
+    else:
+        tz = getattr(df.index, 'tz', None)
+        #tz-aware datetimes are stored as their UTC datetime64 values
+        values, dtype = _storable(np.asarray(df.index if tz is None else df.index.tz_convert('UTC').tz_localize(None)), 'Index')
+        index = {'kind':'array', 'name':df.index.name, 'dtype':dtype, 'freq':getattr(df.index, 'freqstr', None),
+                 'tz':None if tz is None else str(tz)}
+        arrays = [(-1, values)]
+    dtypes = []
+    for j in range(df.shape[1]):
+        values, dtype = _storable(df.iloc[:, j].values, 'Column '+str(df.columns[j]))
+        arrays.append((j, values))
+        dtypes.append(dtype)
+
+    # write to a temporary directory and swap it in, so readers never see a partial dataset
+    tmp_path = path.rstrip('/')+'.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    checksums = {}
+    try:
+        for j, values in arrays:
+            for k in range(n_chunks):
+                shard = _shard_file(j, k, compress)
+                block = values[k*chunk_rows:(k+1)*chunk_rows]
+                if compress:
+                    np.savez_compressed(os.path.join(tmp_path, shard), values=block)
+                else:
+                    np.save(os.path.join(tmp_path, shard), block)
+                checksums[shard] = _sha256(os.path.join(tmp_path, shard))
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    manifest = {'format':'npy-shards',
+                'format_version':FORMAT_VERSION,
+                'n_rows':n_rows,
+                'chunk_rows':chunk_rows,
+                'n_chunks':n_chunks,
+                'compressed':bool(compress),
+                'columns':[int(c) if isinstance(c, np.integer) else c for c in df.columns],
+                'dtypes':dtypes,
+                'index':index,
+                'checksums':checksums}
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def read_manifest(path:str)->dict:
+    """
+    Manifest of a dataset saved with save_dataset
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != 'npy-shards' or manifest.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError(path+' is not a supported dataset (format '+str(manifest.get('format'))+')')
+    return manifest
+
+
+def _row_range(rows, n_rows:int)->tuple:
+    """
+    (start, stop) of a row selection given as None, (start, stop) or a slice with step 1
+    """
+    if rows is None:
+        return 0, n_rows
+    if not isinstance(rows, slice):
+        rows = slice(*rows)
+    start, stop, step = rows.indices(n_rows)
+    if step != 1:
+        raise ValueError('Row ranges must be contiguous (step 1)')
+    return start, max(start, stop)
+
+
+def _read_column(path:str, manifest:dict, column:int, start:int, stop:int, mmap:bool)->np.ndarray:
+    """
+    Rows start:stop of a stored column (column -1 is the index), reading only the overlapping shards
+    """
+    chunk_rows = manifest['chunk_rows']
+    compress = manifest['compressed']
+    first, last = start//chunk_rows, max(start, stop - 1)//chunk_rows
+    blocks = []
+    for k in range(first, last + 1):
+        shard = os.path.join(path, _shard_file(column, k, compress))
+        if compress:
+            with np.load(shard) as npz:
+                values = npz['values']
+        else:
+            values = np.load(shard, mmap_mode='r' if mmap else None)
+        lo = max(start - k*chunk_rows, 0)
+        hi = min(stop - k*chunk_rows, len(values))
+        blocks.append(values[lo:hi])
+    if len(blocks) == 1:
+        return blocks[0]
+    return np.concatenate(blocks)
+
+
+def load_dataset(path:str, columns:list = None, rows = None, mmap:bool = False)->pd.DataFrame:
+    """
+    Load a dataset saved with save_dataset, reading only the requested columns and rows
+
+    INPUTS:
+    path: dataset directory
+    columns: None (all) or list of column names to load, in the order wanted
+    rows: None (all), (start, stop) or slice of row positions to load
+    mmap: memory-map the shards instead of reading them (uncompressed datasets only). A single shard selection is returned
+          as a read-only view of the file, selections spanning several shards copy just the selected rows
+
+    OUTPUT:
+    df: DataFrame with the selected columns and rows and the stored index
+    """
+    manifest = read_manifest(path)
+    if mmap and manifest['compressed']:
+        raise ValueError('Compressed datasets cannot be memory-mapped')
+    stored = manifest['columns']
+    if columns is None:
+        columns = stored
+    missing = [col for col in columns if col not in stored]
+    if len(missing) > 0:
+        raise KeyError('Columns not in dataset: '+str(missing))
+    start, stop = _row_range(rows, manifest['n_rows'])
+
+    data = {}
+    for col in columns:
+        j = stored.index(col)
+        values = _read_column(path, manifest, j, start, stop, mmap)
+        if manifest['dtypes'][j] == 'object':
+            values = values.astype(object)
+        data[col] = values
+
+    index = manifest['index']
+    if index['kind'] == 'range':
+        x = pd.RangeIndex(index['start'] + start*index['step'], index['start'] + stop*index['step'], index['step'], name=index['name'])
+    else:
+        values = _read_column(path, manifest, -1, start, stop, mmap)
+        if index['dtype'] == 'object':
+            values = values.astype(object)
+        x = pd.Index(values, name=index['name'])
+        if index.get('tz') is not None:
+            x = pd.DatetimeIndex(x).tz_localize('UTC').tz_convert(index['tz'])
+        if index.get('freq') is not None and len(x) > 0:
+            x = pd.DatetimeIndex(x, freq=index['freq'])
+    return pd.DataFrame(data, index=x, columns=columns, copy=False)
+
+
+def iter_column_chunks(path:str, columns:list = None, chunk_columns:int = 16, rows = None, mmap:bool = None):
+    """
+    Iterate over a dataset in blocks of columns, e.g. to stream it through calculate_change_points without loading it whole
+
+    INPUTS:
+    path: dataset directory
+    columns: None (all) or list of column names
+    chunk_columns: number of columns per block
+    rows: as in load_dataset
+    mmap: as in load_dataset, None (default) memory-maps uncompressed datasets and reads compressed ones
+
+    OUTPUT:
+    generator of DataFrames of up to chunk_columns columns, all with the same index
+    """
+    manifest = read_manifest(path)
+    if columns is None:
+        columns = manifest['columns']
+    if mmap is None:
+        mmap = not manifest['compressed']
+    chunk_columns = max(1, int(chunk_columns))
+    for i in range(0, len(columns), chunk_columns):
+        yield load_dataset(path, columns=columns[i:i+chunk_columns], rows=rows, mmap=mmap)
@@ -0,0 +1,336 @@
+"""
+Distribution drift of live features against a stored training snapshot.
+
+The change point monitoring looks at each live series on its own. Here each live feature's distribution is compared with
+its distribution in the reference (training) set. The reference is summarised once into a sketch per feature: quantiles
+at evenly spaced levels, the interior bin edges of n_bins equal-frequency bins and the reference counts in those bins.
+The sketch of a stored dataset (a dataset_storage directory or a pickle following the ModelName_DateStamp_Version
+convention) is cached next to it, e.g. ./data_s3/OVForecast_20220606_1.sketch.npz, so a multi-million-row snapshot is
+only read again when it changes:
+
+    df_drift = drift_scores('./data_s3/OVForecast_20220606_1', df_live)
+
+Scores are computed for all features at once from the sketches:
+psi: population stability index over the reference bins (< 0.1 stable, 0.1 - 0.25 moderate, > 0.25 significant shift)
+ks: Kolmogorov-Smirnov distance, the largest gap between the cumulative distributions (within 1/(levels-1))
+wasserstein: Wasserstein-1 (earth mover's) distance between the quantile functions, in feature units, and
+wasserstein_iqr, the same relative to the reference interquartile range
+NaN / Inf values are left out of the distributions and reported as the share of bad values instead.
+"""
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+import profiling
+from dataset_storage import MANIFEST, read_manifest, iter_column_chunks
+
+
+SKETCH_VERSION = 1
+SKETCH_ARRAYS = ['levels', 'quantiles', 'bin_edges', 'bin_counts', 'n', 'n_bad']
+
+
+
+def sketch_path(path:str)->str:
+    """
+    Cache file of the reference sketch of a dataset directory or pickle, e.g. ./data_s3/OVForecast_20220606_1.sketch.npz
+    """
+    path = path.rstrip('/')
+    if os.path.isfile(path):
+        path = os.path.splitext(path)[0]
+    return path+'.sketch.npz'
+
+
+def _fingerprint(path:str)->str:
+    """
+    Identifies the stored version of a dataset: its manifest (which holds the shard checksums) or the size and modification
+    time of a pickle
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, MANIFEST), 'rb') as f:
+            return 'manifest:'+json.dumps(json.load(f), sort_keys=True)
+    stat = os.stat(path)
+    return 'file:'+str(stat.st_size)+':'+str(stat.st_mtime_ns)
+
+
+def _numeric_columns(df:pd.DataFrame)->list:
+    return [col for col, dtype in zip(df.columns, df.dtypes) if isinstance(dtype, np.dtype) and dtype.kind in 'biuf']
+
+
+def _finite_values(df:pd.DataFrame)->np.ndarray:
+    """
+    2d float array of the columns, NaN where the value is NaN or +-Inf
+    """
+    Y = df.values.astype(float)
+    Y[~np.isfinite(Y)] = np.nan
+    return Y
+
+
+def _nanquantile(Y:np.ndarray, q:np.ndarray)->np.ndarray:
+    """
+    np.nanquantile(Y, q, axis=0) (linear interpolation) from one sort of the whole block, instead of column by column.
+    All NaN columns give NaN quantiles
+
+    OUTPUT:
+    2d numpy array (len(q) x n_features)
+    """
+    Y = np.sort(Y, axis=0)
+    n = (~np.isnan(Y)).sum(axis=0)
+    pos = np.asarray(q, dtype=float)[:, None]*np.maximum(n - 1, 0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+    y_lo = np.take_along_axis(Y, lo, axis=0)
+    y_hi = np.take_along_axis(Y, hi, axis=0)
+    out = y_lo + (pos - lo)*(y_hi - y_lo)
+    out[:, n == 0] = np.nan
+    return out
+
+
+def _bin_counts(Y:np.ndarray, bin_edges:np.ndarray, block_bytes:int = 2**26)->np.ndarray:
+    """
+    Counts per bin of every column, values above an edge falling in the next bin
+
+    INPUTS:
+    Y: 2d numpy array (n_rows x n_features), NaN values are not counted
+    bin_edges: 2d numpy array (n_bins-1 x n_features) of increasing interior edges
+    block_bytes: rows are compared with the edges in blocks of about this many bytes
+
+    OUTPUT:
+    2d numpy array (n_bins x n_features) of counts
+    """
+    n_edges, n_features = bin_edges.shape
+    n_bins = n_edges + 1
+    offsets = np.arange(n_features)*n_bins
+    counts = np.zeros(n_features*n_bins, dtype=np.int64)
+    block = max(1, block_bytes//max(1, n_features*n_edges))
+    for i in range(0, len(Y), block):
+        Yb = Y[i:i+block]
+        bins = (Yb[:, :, None] > bin_edges.T[None, :, :]).sum(axis=2)
+        valid = ~np.isnan(Yb)
+        counts += np.bincount((bins + offsets)[valid], minlength=n_features*n_bins)
+    return counts.reshape(n_features, n_bins).T
+
+
+def _sketch_columns(df:pd.DataFrame, levels:np.ndarray, n_bins:int)->dict:
+    """
+    Sketch arrays of the numeric columns of a DataFrame
+    """
+    Y = _finite_values(df)
+    #one pass for the quantile levels and the bin edges
+    quantiles = _nanquantile(Y, np.concatenate([levels, np.linspace(0, 1, n_bins + 1)[1:-1]]))
+    bin_edges = quantiles[len(levels):]
+    n = (~np.isnan(Y)).sum(axis=0)
+    return {'levels':levels,
+            'quantiles':quantiles[:len(levels)],
+            'bin_edges':bin_edges,
+            'bin_counts':_bin_counts(Y, bin_edges),
+            'n':n,
+            'n_bad':len(Y) - n}
+
+
+def reference_sketch(reference, levels:int = 101, n_bins:int = 10, chunk_columns:int = 16)->dict:
+    """
+    Per-feature quantile and histogram sketch of a reference set
+
+    INPUTS:
+    reference: DataFrame, or an iterable of column chunks (DataFrames sharing the rows, e.g.
+               dataset_storage.iter_column_chunks). Only numeric and bool columns are sketched
+    levels: number of evenly spaced quantile levels from 0 to 1 (101 gives percentiles)
+    n_bins: number of equal-frequency bins of the PSI
+    chunk_columns: columns of a DataFrame are sketched in blocks of this size, to bound the float copy
+
+    OUTPUT:
+    dict with columns (feature names), levels, quantiles (levels x features), bin_edges (n_bins-1 x features),
+    bin_counts (n_bins x features), n (finite values per feature) and n_bad (NaN / Inf values per feature)
+    """
+    if levels < 2 or n_bins < 2:
+        raise ValueError('A sketch needs at least 2 quantile levels and 2 bins')
+    if isinstance(reference, pd.DataFrame):
+        chunk_columns = max(1, int(chunk_columns))
+        df, numeric = reference, _numeric_columns(reference)
+        reference = (df[numeric[i:i+chunk_columns]] for i in range(0, len(numeric), chunk_columns))
+    level_values = np.linspace(0, 1, int(levels))
+    columns, parts = [], []
+    with profiling.stage('drift_sketch'):
+        for chunk in reference:
+            chunk = chunk[_numeric_columns(chunk)]
+            if chunk.shape[1] == 0:
+                continue
+            columns.extend(chunk.columns)
+            parts.append(_sketch_columns(chunk, level_values, int(n_bins)))
+    if len(parts) == 0:
+        raise ValueError('The reference set has no numeric columns')
+    sketch = {'columns':[int(c) if isinstance(c, np.integer) else c for c in columns], 'levels':level_values}
+    for name in SKETCH_ARRAYS[1:]:
+        sketch[name] = np.concatenate([part[name] for part in parts], axis=-1)
+    return sketch
+
+
+def save_sketch(sketch:dict, path:str, source:str = None):
+    """
+    Write a sketch to an .npz file (no pickles), replacing it atomically
+
+    INPUTS:
+    sketch: output of reference_sketch
+    path: .npz file
+    source: fingerprint of the data the sketch was computed from, checked by load_reference_sketch
+    """
+    meta = {'version':SKETCH_VERSION, 'columns':sketch['columns'], 'source':source}
+    tmp_path = path+'.'+str(os.getpid())+'.tmp.npz'
+    np.savez(tmp_path, meta=np.array(json.dumps(meta)), **{name:sketch[name] for name in SKETCH_ARRAYS})
+    os.replace(tmp_path, path)
+
+
+def read_sketch(path:str)->dict:
+    """
+    Sketch saved with save_sketch, with its 'source' fingerprint
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(str(npz['meta']))
+        if meta.get('version') != SKETCH_VERSION:
+            raise ValueError(path+' is not a supported sketch (version '+str(meta.get('version'))+')')
+        sketch = {name:npz[name] for name in SKETCH_ARRAYS}
+    sketch['columns'] = meta['columns']
+    sketch['source'] = meta['source']
+    return sketch
+
+
+def load_reference_sketch(path:str, levels:int = 101, n_bins:int = 10, chunk_columns:int = 16, refresh:bool = False)->dict:
+    """
+    Sketch of a stored reference set, read from its cache file (sketch_path) when it is up to date, else computed and cached
+
+    INPUTS:
+    path: dataset directory saved with dataset_storage.save_dataset (read chunk_columns columns at a time, memory-mapped
+          when uncompressed) or pickled DataFrame
+    levels, n_bins: as in reference_sketch. A cached sketch with other settings is recomputed
+    chunk_columns: number of columns sketched at a time
+    refresh: recompute even if the cached sketch is up to date
+
+    OUTPUT:
+    sketch dict (see reference_sketch)
+    """
+    cache_file = sketch_path(path)
+    source = _fingerprint(path)
+    if not refresh and os.path.exists(cache_file):
+        try:
+            sketch = read_sketch(cache_file)
+        except (ValueError, KeyError, OSError):
+            sketch = None
+        if (sketch is not None and sketch['source'] == source and len(sketch['levels']) == levels
+                and sketch['bin_counts'].shape[0] == n_bins):
+            return sketch
+    if os.path.isdir(path):
+        manifest = read_manifest(path)
+        reference = iter_column_chunks(path, chunk_columns=chunk_columns, mmap=not manifest['compressed'])
+    else:
+        with open(path, 'rb') as f:
+            reference = pickle.load(f)
+    sketch = reference_sketch(reference, levels=levels, n_bins=n_bins, chunk_columns=chunk_columns)
+    save_sketch(sketch, cache_file, source)
+    sketch['source'] = source
+    return sketch
+
+
+def _interp_columns(u:np.ndarray, xp:np.ndarray, fp:np.ndarray)->np.ndarray:
+    """
+    np.interp(u[:, j], xp[:, j], fp) for every column j at once, taking the last of tied xp values (right continuous,
+    as a cumulative distribution). Columns with NaN xp give NaN
+
+    INPUTS:
+    u: 2d numpy array (n_points x n_features) of points
+    xp: 2d numpy array (k x n_features), sorted in each column
+    fp: 1d numpy array of the k values at xp
+    """
+    k = len(xp)
+    order = np.argsort(np.concatenate([xp, u]), axis=0, kind='stable')
+    # ties sort xp first, so the xp count before each point includes the xp equal to it
+    n_xp = np.cumsum(order < k, axis=0)
+    rows, cols = np.nonzero(order >= k)
+    idx = np.empty(u.shape, dtype=np.int64)
+    idx[order[rows, cols] - k, cols] = n_xp[rows, cols]
+    lo = np.clip(idx - 1, 0, k - 1)
+    hi = np.clip(idx, 0, k - 1)
+    x0 = np.take_along_axis(xp, lo, axis=0)
+    x1 = np.take_along_axis(xp, hi, axis=0)
+    width = x1 - x0
+    frac = np.divide(u - x0, width, out=np.zeros(u.shape), where=width > 0)
+    out = fp[lo] + np.clip(frac, 0, 1)*(fp[hi] - fp[lo])
+    out[np.isnan(u) | np.isnan(xp).any(axis=0)] = np.nan
+    return out
+
+
+def _level_values(quantiles:np.ndarray, levels:np.ndarray, level:float)->np.ndarray:
+    """
+    Per-feature value at a quantile level, interpolated between the sketch levels
+    """
+    pos = np.interp(level, levels, np.arange(len(levels)))
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, len(levels) - 1)
+    return quantiles[lo] + (pos - lo)*(quantiles[hi] - quantiles[lo])
+
+
+def drift_scores(reference, live:pd.DataFrame, levels:int = 101, n_bins:int = 10, psi_epsilon:float = 1e-4)->pd.DataFrame:
+    """
+    Distribution drift of every live feature against the reference set
+
+    INPUTS:
+    reference: stored dataset path (sketch cached next to it, see load_reference_sketch), reference DataFrame, or a sketch
+               from reference_sketch / load_reference_sketch
+    live: live feature DataFrame (e.g. the recent rows of the monitoring table). Columns missing from the reference
+          sketch are skipped
+    levels, n_bins: sketch settings when the reference is not a sketch already
+    psi_epsilon: floor of the bin shares in the PSI, so empty bins give a large but finite score
+
+    OUTPUT:
+    pd.DataFrame indexed by feature_name with psi, ks, wasserstein, wasserstein_iqr, ref_n, live_n, ref_bad_share and
+    live_bad_share (share of NaN / Inf values) columns
+    """
+    if isinstance(reference, str):
+        reference = load_reference_sketch(reference, levels=levels, n_bins=n_bins)
+    elif isinstance(reference, pd.DataFrame):
+        reference = reference_sketch(reference, levels=levels, n_bins=n_bins)
+    position = {col:j for j, col in enumerate(reference['columns'])}
+    features = [col for col in _numeric_columns(live) if col in position]
+    if len(features) == 0:
+        raise ValueError('None of the live features are in the reference sketch')
+    ref = [position[col] for col in features]
+
+    with profiling.stage('drift_scores'):
+        levels = reference['levels']
+        q_ref = reference['quantiles'][:, ref]
+        ref_counts = reference['bin_counts'][:, ref]
+        ref_n = reference['n'][ref]
+        Y = _finite_values(live[features])
+        q_live = _nanquantile(Y, levels)
+        live_counts = _bin_counts(Y, reference['bin_edges'][:, ref])
+        live_n = live_counts.sum(axis=0)
+
+        #population stability index over the reference bins
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p_ref = np.maximum(ref_counts/ref_n, psi_epsilon)
+            p_live = np.maximum(live_counts/live_n, psi_epsilon)
+        psi = ((p_live - p_ref)*np.log(p_live/p_ref)).sum(axis=0)
+
+        #largest gap between the cumulative distributions, both evaluated at the quantiles of both sets
+        points = np.concatenate([q_ref, q_live])
+        ks = np.abs(_interp_columns(points, q_ref, levels) - _interp_columns(points, q_live, levels)).max(axis=0)
+
+        #area between the quantile functions. The end intervals take the inner quantiles, the sample minimum and
+        #maximum are too noisy (and the live ones come from far fewer rows)
+        gap = np.abs(q_live - q_ref)
+        if len(levels) > 2:
+            gap[0], gap[-1] = gap[1], gap[-2]
+        wasserstein = np.trapz(gap, levels, axis=0)
+        q25, q75 = _level_values(q_ref, levels, 0.25), _level_values(q_ref, levels, 0.75)
+        wasserstein_iqr = np.divide(wasserstein, q75 - q25, out=np.full(len(features), np.nan), where=q75 > q25)
+
+    out = pd.DataFrame({'psi':psi,
+                        'ks':ks,
+                        'wasserstein':wasserstein,
+                        'wasserstein_iqr':wasserstein_iqr,
+                        'ref_n':ref_n,
+                        'live_n':live_n,
+                        'ref_bad_share':reference['n_bad'][ref]/(ref_n + reference['n_bad'][ref]),
+                        'live_bad_share':1 - live_n/len(Y) if len(Y) > 0 else np.nan},
+                       index=pd.Index(features, name='feature_name'))
+    return out
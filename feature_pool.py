@@ -0,0 +1,212 @@
+"""
+Evaluation of per-feature functions over a feature table, in chunks of columns and optionally over a process pool.
+
+_map_features sends chunks of feature columns to a per-feature function (e.g. _feature_change_points) together with
+the column statistics of the chunk (bad data records and whole-series percentiles, one vectorized pass), and applies
+the result cache (result_cache.py), the tiered screening (screening.py) and the quantile sketch levels
+(quantile_sketch.py) per chunk. Results are yielded in column order for any number of workers, so the parallel output
+equals the serial one.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+import profiling
+from result_cache import ResultCache
+from shared_matrix import SharedFeatureMatrix, shareable
+from quantile_sketch import merge_sketches
+from change_point_table import _column_stats
+from screening import _screen_features
+
+
+
+def _chunk_features(func, feature_names:list, x, Y:np.ndarray, kwargs:dict, stats_kwargs:dict = None, cache:ResultCache = None,
+                    screen_penalty:float = None, sketches:list = None)->list:
+    """
+    Process pool task: apply a per-feature function to a chunk of features
+    
+    INPUTS:
+    func: module level per-feature function func(feature_name, x, y, **kwargs)
+    feature_names: names of the features in the chunk
+    x: shared index (datetimes) of the feature timeseries, or the SharedFeatureMatrix holding the features
+    Y: 2d numpy array (n_history x n_chunk) of feature values, or the slice of the chunk's columns in the SharedFeatureMatrix
+    kwargs: parameters passed on to func
+    stats_kwargs: None or the parameters of _column_stats, computed for the whole chunk at once
+    cache: None or a ResultCache. Results are keyed by the function, feature name, index, values and kwargs, so
+           features whose history has not changed are read back instead of recomputed
+    screen_penalty: None, or screen the chunk first (_screen_features) and call func with segment=False for the
+                    features that are not flagged
+    sketches: None or, per feature, None or the list of per-row quantile sketches passed on to func and used for the
+              whole-series percentiles (see _chunk_sketches)
+    
+    OUTPUT:
+    list of per-feature results, in feature order (with stats_kwargs, (result, column stats) pairs)
+    """
+    if isinstance(x, SharedFeatureMatrix):
+        x, Y = x.index, x.values[:, Y]
+    feature_kwargs = [kwargs]*len(feature_names)
+    if screen_penalty is not None:
+        flagged = _screen_features(Y, screen_penalty)
+        feature_kwargs = [kwargs if flagged[j] else dict(kwargs, segment=False) for j in range(len(feature_names))]
+    if sketches is not None:
+        feature_kwargs = [feature_kwargs[j] if sketches[j] is None else dict(feature_kwargs[j], sketches=sketches[j])
+                          for j in range(len(feature_names))]
+    if cache is None:
+        results = [func(feature_names[j], x, Y[:,j], **feature_kwargs[j]) for j in range(len(feature_names))]
+    else:
+        x_key = cache.key(x)
+        results = [cache.get_or_compute(cache.key(func.__name__, feature_names[j], x_key, Y[:,j], feature_kwargs[j]),
+                                        func, feature_names[j], x, Y[:,j], **feature_kwargs[j]) for j in range(len(feature_names))]
+    if stats_kwargs is None:
+        return results
+    stats = _column_stats(x, Y, **stats_kwargs)
+    if sketches is not None:
+        stats = [(bad, y_pc if sketches[j] is None else merge_sketches(sketches[j]).percentiles(stats_kwargs['percentiles']))
+                 for j, (bad, y_pc) in enumerate(stats)]
+    return list(zip(results, stats))
+
+
+def _chunk_sketches(sketches:pd.DataFrame, index, columns)->list:
+    """
+    Per-row quantile sketches of the features of a chunk: a list with, per feature, None (no sketch column, exact
+    percentiles) or the sketches aligned to index (None / NaN for rows without one)
+    """
+    if sketches is None:
+        return None
+    rows = sketches.reindex(index=index)
+    return [list(rows[col].values) if col in sketches.columns else None for col in columns]
+
+
+def _feature_chunks(dfin):
+    """
+    Normalise a feature table to an iterator of DataFrames of feature columns sharing one index
+    
+    INPUTS:
+    dfin: pandas dataframe, or an iterable of column chunks (DataFrames) or single feature columns (named Series),
+          e.g. dataset_storage.iter_column_chunks. Chunks are consumed one at a time
+    
+    OUTPUT:
+    generator of DataFrames
+    """
+    if isinstance(dfin, pd.DataFrame):
+        yield dfin
+        return
+    index = None
+    for chunk in dfin:
+        if isinstance(chunk, pd.Series):
+            chunk = chunk.to_frame()
+        if not isinstance(chunk, pd.DataFrame):
+            raise TypeError('Feature chunks must be DataFrames or Series, got '+type(chunk).__name__)
+        if index is None:
+            index = chunk.index
+        elif not chunk.index.equals(index):
+            raise ValueError('All feature chunks must share the same index')
+        yield chunk
+
+
+def _map_features(func, dfin, kwargs:dict, n_jobs:int = 1, chunksize:int = 16, stats_kwargs:dict = None, cache:ResultCache = None,
+                  screen_penalty:float = None, sketches:pd.DataFrame = None):
+    """
+    Apply a per-feature function to every feature column, serially or over a process pool in chunks of columns
+    
+    INPUTS:
+    func: module level per-feature function func(feature_name, x, y, **kwargs)
+    dfin: feature dataframe or iterable of column chunks (see _feature_chunks)
+    kwargs: parameters passed on to func
+    n_jobs: number of worker processes (1 runs serially, None or -1 uses all cores)
+    chunksize: number of features per task
+    stats_kwargs: None or the parameters of _column_stats, to also return the column statistics of each feature
+    cache: None or a ResultCache of per-feature results
+    screen_penalty: None or the penalty of the screening pass (see _chunk_features)
+    sketches: None or a pd.DataFrame of per-row quantile sketches of the features (see calculate_change_points)
+    
+    OUTPUT:
+    generator of per-feature results in column order. Input chunks are pulled lazily, so only the chunks behind the
+    in-flight tasks are held in memory. A DataFrame is placed in a SharedFeatureMatrix for the process pool, so the
+    tasks carry column positions instead of copies of the values (iterables of chunks are still sent chunk by chunk)
+    """
+    n_jobs = _resolve_n_jobs(n_jobs)
+    chunksize = max(1, int(chunksize))
+    if n_jobs > 1 and isinstance(dfin, pd.DataFrame) and shareable(dfin):
+        with SharedFeatureMatrix(dfin) as matrix:
+            tasks = ((func, list(dfin.columns[i:i+chunksize]), matrix, slice(i, i+chunksize), kwargs, stats_kwargs, cache, screen_penalty,
+                      _chunk_sketches(sketches, dfin.index, dfin.columns[i:i+chunksize]))
+                     for i in range(0, dfin.shape[1], chunksize))
+            chunks = _ordered_parallel_map(_chunk_features, tasks, n_jobs)
+            # the workers are done with the shared block before it is removed
+            try:
+                for chunk in chunks:
+                    for result in chunk:
+                        yield result
+            finally:
+                chunks.close()
+        return
+    tasks = ((func, list(df.columns[i:i+chunksize]), df.index, df.iloc[:, i:i+chunksize].values, kwargs, stats_kwargs, cache, screen_penalty,
+              _chunk_sketches(sketches, df.index, df.columns[i:i+chunksize]))
+             for df in _feature_chunks(dfin) for i in range(0, df.shape[1], chunksize))
+    if n_jobs == 1:
+        chunks = (_chunk_features(*task) for task in tasks)
+    else:
+        chunks = _ordered_parallel_map(_chunk_features, tasks, n_jobs)
+    for chunk in chunks:
+        for result in chunk:
+            yield result
+
+
+def _ordered_parallel_map(func, tasks, n_jobs:int, max_pending:int = None):
+    """
+    Run func(*task) for each task in a process pool, yielding results in task order
+    
+    INPUTS:
+    func: module level (picklable) function
+    tasks: iterable of argument tuples. Consumed lazily so only max_pending tasks are held in memory at once
+    n_jobs: number of worker processes
+    max_pending: maximum number of submitted but unconsumed tasks (defaults to 2*n_jobs)
+    
+    OUTPUT:
+    generator of results in the same order as tasks
+    """
+    if max_pending is None:
+        max_pending = 2*n_jobs
+    # stages timed in the workers are sent back and merged into the active profiler
+    profiler = profiling.active()
+    
+    def submit(executor, task):
+        if profiler is None:
+            return executor.submit(func, *task)
+        return executor.submit(profiling.call_profiled, func, profiler.allocations, *task)
+    
+    def result(future):
+        if profiler is None:
+            return future.result()
+        out, records = future.result()
+        profiler.extend(records)
+        return out
+    
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(submit(executor, task))
+            if len(pending) >= max_pending:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+
+
+def _resolve_cache(cache)->ResultCache:
+    """
+    None, a ResultCache, or a cache directory for a ResultCache with the default size budget
+    """
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    return ResultCache(cache)
+
+
+def _resolve_n_jobs(n_jobs)->int:
+    """
+    Translate n_jobs (None or -1 means all cores) into a worker count
+    """
+    if n_jobs is None or n_jobs < 1:
+        return os.cpu_count() or 1
+    return int(n_jobs)
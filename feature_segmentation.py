@@ -0,0 +1,200 @@
+"""
+Trend and volatility change points of a single feature.
+
+_feature_change_points is the unit of work of calculate_change_points: the feature is cleaned (NaN / Inf filled from
+the neighbouring finite values), segmented with the chosen cost model and search method (_segmenter: ruptures or the
+backends of segmentation.py), the rolling sd of the residuals from the trend segments is searched for volatility
+changes, and each segment is reported with its percentile levels.
+"""
+import copy
+import numpy as np
+import ruptures as rpt
+import segmentation
+import profiling
+from quantile_sketch import sketch_segment_percentiles
+
+
+
+SEARCH_METHODS = ['pelt','binseg','window']
+DEFAULT_WINDOW_WIDTH = 30
+# longest series searched with PELT by the linear cost backends, longer ones use binary segmentation
+PELT_MAX_LENGTH = 20000
+
+
+def _segmenter(cost_model:str = 'rbf', search_method = 'pelt', n_samples:int = None, jump:int = 5):
+    """
+    Unfitted change point search algorithm with the ruptures fit(signal).predict(pen) interface
+    
+    INPUTS:
+    cost_model: 'rbf' uses the ruptures kernel cost (O(n^2) gram matrix per feature). 'normal' or 'l2' use the
+                linear cost numpy backends in segmentation.py, suited to long (hourly / minute level) histories
+    search_method: 'pelt', 'binseg' or 'window' (window width DEFAULT_WINDOW_WIDTH). Alternatively an unfitted
+                   algorithm instance (e.g. rpt.Window(width=50, model='rbf') or segmentation.Binseg(model='l2')) which is copied per feature
+    n_samples: length of the series to fit. With the linear costs, 'pelt' with more than PELT_MAX_LENGTH/5 candidate
+               positions (series longer than PELT_MAX_LENGTH at the default jump) uses 'binseg': PELT prunes few
+               candidates where there are no change points, so on stationary series its run time grows as about n^1.4
+               (3s per feature at 100k rows), while binary segmentation stays O(n) per level
+    jump: spacing of the candidate change points (5 as in ruptures)
+    
+    OUTPUT:
+    algo: unfitted search algorithm
+    """
+    if not isinstance(search_method, str):
+        return copy.deepcopy(search_method)
+    if search_method not in SEARCH_METHODS:
+        raise ValueError('Unknown search method '+str(search_method)+', expected one of '+str(SEARCH_METHODS))
+    if search_method == 'pelt' and cost_model in segmentation.COST_MODELS and n_samples is not None and n_samples/jump > PELT_MAX_LENGTH/5:
+        search_method = 'binseg'
+    if cost_model == 'rbf':
+        algos = {'pelt':rpt.Pelt, 'binseg':rpt.Binseg, 'window':rpt.Window}
+    elif cost_model in segmentation.COST_MODELS:
+        algos = {'pelt':segmentation.Pelt, 'binseg':segmentation.Binseg, 'window':segmentation.Window}
+    else:
+        raise ValueError('Unknown cost model '+str(cost_model)+', expected rbf or one of '+str(segmentation.COST_MODELS))
+    if search_method == 'window':
+        return algos[search_method](width=DEFAULT_WINDOW_WIDTH, model=cost_model, jump=jump)
+    return algos[search_method](model=cost_model, jump=jump)
+
+
+def _volatility_change_points(y:np.ndarray, trend_bkps:list, rolling_sd_window:int = 10, rolling_sd_penalty:int = 10)->list:
+    """
+    Volatility change points: segment the rolling standard deviation of the residuals from the trend segments
+    
+    The rolling SD is computed from cumulative sums (O(1) per step) on y minus its trend segment means, so level
+    shifts do not show up as volatility bursts. Neighbouring windows overlap, so only every w-th (non-overlapping)
+    window is kept: the segmentation then runs on len(y)/w independent points, and change points are placed to within
+    one window. Their log SDs are segmented with the linear cost l2 PELT (every window a candidate), whatever cost model
+    the trend stage uses: the noise of the log of a w point SD does not depend on the volatility level, but it does
+    depend on the noise distribution (about 1/sqrt(2(w-1)) for Gaussian data, several times more for heavy tails), so
+    the cost is standardised by the noise estimated from the differences of consecutive windows.
+    Breaks within one window of a trend change point cannot be told apart from it and are dropped.
+    
+    INPUTS:
+    y: numpy array of feature values (bad data already removed)
+    trend_bkps: change points from the trend stage
+    rolling_sd_window: rolling standard deviation window
+    rolling_sd_penalty: penalty for the volatility segmentation
+    
+    OUTPUT:
+    list of volatility change points (positions in y, ruptures convention with the last point len(y))
+    """
+    nx = len(y)
+    w = int(rolling_sd_window)
+    if w < 2 or nx < 2*w:
+        return [nx]
+    bounds = np.array([0] + sorted(trend_bkps))
+    seg = np.searchsorted(bounds[1:], np.arange(nx), side='right')
+    finite = np.isfinite(y)
+    seg_mean = np.bincount(seg[finite], weights=y[finite], minlength=len(bounds))/np.maximum(np.bincount(seg[finite], minlength=len(bounds)), 1)
+    resid = np.where(finite, y - seg_mean[seg], 0.0)
+    
+    # non-overlapping windows, window k covers y[k*w:(k+1)*w]
+    yrsd = segmentation.rolling_std(resid, w)[::w]
+    log_rsd = np.log(np.maximum(yrsd, 1e-3*segmentation.robust_scale(resid)))
+    #noise sd of one window's log SD (the Gaussian value if the differences are all 0)
+    window_sd = np.std(np.diff(log_rsd))/np.sqrt(2)
+    if not window_sd > 0:
+        window_sd = 1/np.sqrt(2.0*(w - 1))
+    algo = _segmenter('l2', 'pelt', len(log_rsd), jump=1)
+    algo.scale = window_sd
+    bkps = algo.fit(log_rsd).predict(pen=rolling_sd_penalty)
+    
+    # a break before window k is a change at y[k*w]
+    vol = np.array(bkps[:-1], dtype=int)*w
+    near_trend = np.abs(vol[:, None] - bounds[None, 1:-1]).min(axis=1) <= w if len(bounds) > 2 else np.zeros(len(vol), dtype=bool)
+    return [int(v) for v in vol[~near_trend]] + [nx]
+
+
+def _clean_feature(y:np.ndarray)->np.ndarray:
+    """
+    Series used for segmentation, with NaN / Inf forward filled. Bad rows before the first finite value are back filled
+    from it (as the online detector does), an all bad series stays NaN
+    
+    INPUTS:
+    y: numpy array of feature values, or 2d array (n_history x n_features) cleaned column by column
+    
+    OUTPUT:
+    y: cleaned numpy array
+    """
+    #remove bad data for trend bit (on a copy, y may be a view of the caller's data)
+    y = np.array(y, dtype=float)
+    finite = np.isfinite(y)
+    y[~finite] = np.nan
+    # forward fill: position of the last finite value at or before each row, leading bad rows take the first finite value
+    rows = np.arange(len(y)).reshape((-1,) + (1,)*(y.ndim - 1))
+    last = np.maximum.accumulate(np.where(finite, rows, 0), axis=0)
+    last = np.where(np.logical_or.accumulate(finite, axis=0), last, np.argmax(finite, axis=0))
+    if y.ndim == 1:
+        return y[last]
+    return np.take_along_axis(y, last, axis=0)
+
+
+def _segment_records(x, y:np.ndarray, result:list, percentiles:list = [25,50,75], sketches:list = None)->tuple:
+    """
+    Segment end datetimes and percentile levels for a segmentation
+    
+    INPUTS:
+    x: index (datetimes) of the feature timeseries
+    y: cleaned numpy array of feature values
+    result: segment ends (ruptures convention, last one len(y))
+    percentiles: Percentiles to report levels
+    sketches: None, or one quantile sketch per row of y to read the segment levels from (see calculate_change_points)
+    
+    OUTPUT:
+    seg_x: index value of each segment end (the last point of the series for the final segment)
+    seg_values: percentile levels of each segment
+    """
+    nx = len(y)
+    if sketches is None:
+        seg_values = segmentation.segment_percentiles(y, result, percentiles)
+    else:
+        seg_values = sketch_segment_percentiles(sketches, result, percentiles)
+    seg_x = x[np.minimum(nx-1, np.array(result, dtype=int))]
+    return seg_x, seg_values
+
+
+def _feature_change_points(feature_name, x, y,
+                           percentiles:list= [25,50,75],
+                           trend_penalty:int = 10,
+                           rolling_sd_window:int = 10,
+                           rolling_sd_penalty:int=10,
+                           cost_model:str = 'rbf',
+                           search_method = 'pelt',
+                           segment:bool = True,
+                           sketches:list = None)->tuple:
+    """
+    Trend/volatility change point records for a single feature (bad data runs are found for all features at once by _bad_data_blocks)
+    
+    INPUTS:
+    feature_name: name of the feature column
+    x: index (datetimes) of the feature timeseries
+    y: numpy array of feature values
+    segment: False skips the segmentation (feature cleared by the screening pass) and reports the whole series as one segment
+    sketches: None or the per-row quantile sketches of the feature, for the segment levels
+    remaining inputs as in calculate_change_points
+    
+    OUTPUT:
+    tuple (feature_name, seg_x, seg_values)
+    """
+    with profiling.stage('clean', feature_name):
+        y = _clean_feature(y)
+    
+    if not segment:
+        with profiling.stage('segment_percentiles', feature_name):
+            seg_x, seg_values = _segment_records(x, y, [len(y)], percentiles, sketches)
+        return feature_name, seg_x, seg_values
+    
+    #trend / level changes
+    with profiling.stage('trend_fit', feature_name):
+        algo = _segmenter(cost_model, search_method, len(y)).fit(y)
+        result = algo.predict(pen=trend_penalty)
+    
+    
+    #volatility changes from the rolling standard deviation
+    if rolling_sd_window is not None:
+        with profiling.stage('volatility_fit', feature_name):
+            result = sorted(set(result) | set(_volatility_change_points(y, result, rolling_sd_window, rolling_sd_penalty)))
+    
+    with profiling.stage('segment_percentiles', feature_name):
+        seg_x, seg_values = _segment_records(x, y, result, percentiles, sketches)
+    return feature_name, seg_x, seg_values
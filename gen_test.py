@@ -1,6 +1,6 @@
 import pandas as pd
 import sklearn.datasets
-import pickle
+from dataset_storage import dataset_name, save_dataset
 
 #generate data
 data = sklearn.datasets.make_classification(n_samples=4000000, 
@@ -20,6 +20,5 @@ df['label'] = data[1]
 df.head()
 
 
-#pickle to data folder
-with open('./data_lfs/test_data1.pickle', 'wb') as f:
-    pickle.dump(df, f)
\ No newline at end of file
+#save to data folder as chunked columnar shards (ModelName_DateStamp_Version), compressed for lfs
+save_dataset(df, './data_lfs/'+dataset_name('TestData', version=1), chunk_rows=1000000, compress=True)
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+Change point detection for long format data: many (entity, feature) series of different lengths and timestamps, e.g.
+features monitored per zone or restaurant (calculate_grouped_change_points), without pivoting to a wide dataframe.
+"""
+import numpy as np
+import pandas as pd
+import profiling
+from result_cache import ResultCache
+from change_point_table import ChangePointBuilder, drop_end_changepoints
+from feature_segmentation import _feature_change_points
+from feature_pool import _chunk_features, _ordered_parallel_map, _resolve_cache, _resolve_n_jobs
+
+
+
+def _chunk_groups(func, feature_names:list, xs:list, ys:list, kwargs:dict, stats_kwargs:dict, cache:ResultCache = None,
+                  screen_penalty:float = None)->list:
+    """
+    Process pool task: apply a per-feature function to a batch of series of different lengths and timestamps
+    
+    INPUTS:
+    func: module level per-feature function func(feature_name, x, y, **kwargs)
+    feature_names: feature name of each series
+    xs: timestamps of each series
+    ys: values of each series
+    kwargs, stats_kwargs, cache, screen_penalty: as in _chunk_features
+    
+    OUTPUT:
+    list of (result, column stats) pairs, in series order
+    """
+    out = []
+    for feature_name, x, y in zip(feature_names, xs, ys):
+        out.extend(_chunk_features(func, [feature_name], x, y[:, None], kwargs, stats_kwargs, cache, screen_penalty))
+    return out
+
+
+def calculate_grouped_change_points(dflong:pd.DataFrame,
+                                    entity_columns:list = ['entity'],
+                                    feature_column:str = 'feature',
+                                    time_column:str = 'timestamp',
+                                    value_column:str = 'value',
+                                    percentiles:list= [25,50,75],
+                                    explode:bool=True,
+                                    keep_last_changepoint=True,
+                                    trend_penalty:int = 10,
+                                    rolling_sd_window:int = 10,
+                                    rolling_sd_penalty:int=10,
+                                    cost_model:str = 'rbf',
+                                    search_method = 'pelt',
+                                    n_jobs:int = 1,
+                                    chunksize:int = 256,
+                                    bad_data:str = 'rows',
+                                    bad_data_checks:list = ['NaN','Inf'],
+                                    min_constant_run:int = 7,
+                                    cache = None,
+                                    screen_penalty:float = None)->pd.DataFrame:
+    """
+    Calculate change points per (entity, feature) series of long format data, e.g. features monitored per zone or
+    restaurant, without pivoting to a wide (and mostly empty) dataframe
+    
+    The rows are sorted once by series and timestamp and each series is cut out as a slice, so series may have
+    different lengths and timestamps (missing timestamps are not filled in). Series are sent to the workers in batches
+    of chunksize. For each series the change points equal calculate_change_points on that series alone.
+    
+    INPUTS:
+    dflong: long format pandas dataframe with one row per (entity, feature, timestamp)
+    entity_columns: columns identifying the entity, e.g. ['market', 'zone']
+    feature_column: column holding the feature name
+    time_column: column holding the timestamps
+    value_column: column holding the feature values
+    chunksize: number of series per task
+    remaining inputs as in calculate_change_points
+    
+    OUTPUT:
+    df_cp: pandas dataframe of change points in the calculate_change_points schema, preceded by the entity_columns.
+           df_cp.attrs['series_percentiles'] holds the whole-series percentiles, indexed by entity and feature_name
+    """
+    entity_columns = list(entity_columns)
+    key_columns = entity_columns + [feature_column]
+    missing = [col for col in key_columns + [time_column, value_column] if col not in dflong.columns]
+    if len(missing) > 0:
+        raise KeyError('Columns not in dataframe: '+str(missing))
+    kwargs = dict(percentiles=percentiles,
+                  trend_penalty=trend_penalty,
+                  rolling_sd_window=rolling_sd_window,
+                  rolling_sd_penalty=rolling_sd_penalty,
+                  cost_model=cost_model,
+                  search_method=search_method)
+    stats_kwargs = dict(percentiles=percentiles,
+                        bad_data_checks=bad_data_checks,
+                        min_constant_run=min_constant_run,
+                        bad_data=bad_data)
+    cache = _resolve_cache(cache)
+    
+    # one sort by series and timestamp, then every series is a contiguous slice
+    codes = dflong.groupby(key_columns, sort=True, dropna=False).ngroup().values
+    times = dflong[time_column].values
+    order = np.lexsort((times, codes))
+    codes, times = codes[order], times[order]
+    values = np.asarray(dflong[value_column].values, dtype=float)[order]
+    if np.any((codes[1:] == codes[:-1]) & (times[1:] == times[:-1])):
+        raise ValueError('Duplicate timestamps within an (entity, feature) series')
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) > 0 else np.array([], dtype=int)
+    ends = np.r_[starts[1:], len(codes)]
+    keys = list(zip(*[dflong[col].values[order[starts]] for col in key_columns]))
+    
+    chunksize = max(1, int(chunksize))
+    tasks = ((_feature_change_points, [k[-1] for k in keys[i:i+chunksize]],
+              [times[s:e] for s, e in zip(starts[i:i+chunksize], ends[i:i+chunksize])],
+              [values[s:e] for s, e in zip(starts[i:i+chunksize], ends[i:i+chunksize])],
+              kwargs, stats_kwargs, cache, screen_penalty) for i in range(0, len(keys), chunksize))
+    n_jobs = _resolve_n_jobs(n_jobs)
+    if n_jobs == 1:
+        chunks = (_chunk_groups(*task) for task in tasks)
+    else:
+        chunks = _ordered_parallel_map(_chunk_groups, tasks, n_jobs)
+    
+    builder = ChangePointBuilder(percentiles, key_columns=entity_columns, bad_data=bad_data)
+    y_percentiles = []
+    i = 0
+    for chunk in chunks:
+        for (feature_name, seg_x, seg_values), (bad, y_pc) in chunk:
+            builder.add(feature_name, seg_x=seg_x, seg_values=seg_values, keys=keys[i][:-1], **bad)
+            y_percentiles.append(y_pc)
+            i += 1
+    
+    if keep_last_changepoint is False:
+        with profiling.stage('build'):
+            df_cp = builder.build(explode=False)
+        df_cp = drop_end_changepoints(df_cp, key_columns=entity_columns)
+    else:
+        with profiling.stage('build'):
+            df_cp = builder.build(explode=explode)
+    
+    df_cp = df_cp.reset_index(drop=True)
+    df_cp.attrs['series_percentiles'] = pd.DataFrame(np.array(y_percentiles).reshape(len(keys), len(percentiles)),
+                                                     index=pd.MultiIndex.from_tuples(keys, names=entity_columns+['feature_name']),
+                                                     columns=list(percentiles))
+    if cache is not None:
+        cache.evict()
+    return df_cp
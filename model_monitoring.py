@@ -2,289 +2,200 @@ import pandas as pd
 import numpy as np
 #regenerate identical synthetic data
 np.random.seed(1234)
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pylab as plt
-import ruptures as rpt
+import profiling
+from feature_segmentation import _feature_change_points
+from feature_pool import _map_features, _resolve_cache
+from multi_resolution import _feature_refined_change_points
+# the change point table, the other detection modes and the reports live in their own modules and are re-exported here
+from change_point_table import drop_end_changepoints, ChangePointBuilder, BAD_DATA_CHECKS, BAD_DATA_OUTPUTS, bad_data_runs
+from feature_segmentation import SEARCH_METHODS, DEFAULT_WINDOW_WIDTH, PELT_MAX_LENGTH
+from penalty_sweep import penalty_sweep_change_points
+from grouped_monitoring import calculate_grouped_change_points
+from vlm_report import (series_percentiles, generate_vlm_display, generate_vlm_report, downsample_index, SUMMARY_ROWS_PER_PAGE,
+                        DOWNSAMPLE_METHODS, REPORT_FORMATS)
 
 
 
-def drop_end_changepoints(change_points:pd.DataFrame,explode=True,keep_percentiles=[25,50,75])->pd.DataFrame:
-    '''
-    Drop artifical changepoints at end of timeseries
-    
-    INPUTS: change_points: pd.dataframe output of calculate_changepoints
-    
-    OUTPUTS: dfcp: pd.DataFrame output with end of file change points dropped
-    '''
-    df_cp = change_points.copy()
-    df_cp1 = df_cp.set_index(['feature_name','datetime'])
-    df_cp2 = df_cp.drop_duplicates(subset='feature_name',keep='last').set_index(['feature_name','datetime'])
-    df_cp3 = df_cp1.drop(df_cp2.index).round(2).reset_index()
-    if explode:
-        df_cp3 = df_cp3.set_index(['feature_name','datetime']).apply(pd.Series.explode).reset_index()
-        df_cp3 = df_cp3[df_cp3['percentile'].isin(keep_percentiles)]
-    return df_cp3.reset_index(drop=True)
-
-
-
-
-# Model Monitoring Utils
-def generate_vlm_display(dfin:pd.DataFrame, pdf_file:str, 
-                         percentiles:list = [25,50,75], 
-                         percentile_lines:bool=False, 
-                         change_points = None,
-                         change_point_percentile_lines:bool=True):
-    """
-    Visualise the results of variable level monitoring. Creates a multi page pdf with vlm timeseries plots (one per page) and optiona change points overlaid.
-    
-    INPUTS:
-    dfin: Input dataframe of timeseries features
-    pdf_file: The output filename to save the multipage pdf
-    percentiles: The percentiles to draw on the charts
-    percentile_lines: bool. Do we show percentiles?
-    change_points: None or pd.dataframe output of the change point analysis in the calculate_change_points function
-    change_point_percentile_lines: bool. Do we show change point percentiles for each change point split?
-    
-    OUTPUT:
-    None
-    """
-    df = dfin.copy()
-    pdf_pages = PdfPages(pdf_file)
-    nx,ny = np.shape(df)
-    for i in range(ny):
-        feature_name = df.columns[i]
-        x = df.index
-        y = df[feature_name].values
-        
-        # Create a figure instance (ie. a new page)
-        fig = plt.figure(figsize=(8.27, 11.69), dpi=100)
-        ax1 = fig.add_subplot(111)
-        
-        # Plot variable-level data
-        y_percentiles = np.percentile(y, percentiles) 
-        str_pc1 = ', '.join([str(int(pc))+'%' for pc in percentiles])+' percentiles'
-        str_pc2 = ', '.join([str(np.round(pc,2)) for pc in y_percentiles])
-        
-        
-           
-        # add change points
-        str_pc0 = '\n'
-        if change_points is not None:
-            change_points_dropna = change_points.dropna()
-            cpnow = change_points_dropna[change_points_dropna['feature_name']==feature_name]
-            ncp = len(cpnow)
-            if ncp > 1:
-                str_pc0 = str(int(ncp-1))+' change points detected\n'
-            for i2 in range(ncp):
-                datetime = cpnow['datetime'].iloc[i2]
-                if ((ncp > 1) and (i2 < ncp-1)):
-                    ax1.axvline(datetime,color='k',linewidth=2)
-                if change_point_percentile_lines:
-                    ypc = cpnow['value'].iloc[i2]
-                    ax1.axhline(ypc[0],ls=':',color='k')
-                    ax1.axhline(ypc[1],ls='--',color='k')
-                    ax1.axhline(ypc[2],ls=':',color='k')
-            
-            #add nan change points
-            change_points_nan = change_points[change_points['description'].isin(['NaN','Inf'])]
-            cpnow = change_points_nan[change_points_nan['feature_name']==feature_name]
-            for i3 in range(len(cpnow)):
-                datetime = cpnow['datetime'].iloc[i3]
-                if i3==0:
-                    lab = 'Bad Data'
-                else:
-                    lab=None
-                ax1.axvline(datetime,color='r',linewidth=2,label=lab,ls=':')
-            
-                    
-        str_pc = str_pc0+ str_pc1+'\n'+str_pc2
-        
-        label = feature_name+': '+ str_pc            
-        ax1.plot(x, y,label=label,zorder=0)
-        ax1.set_ylabel('value')
-        ax1.legend()
-        
-        #show percentiles
-        if percentile_lines:
-            if change_points is not None:
-                cpnow = change_points_dropna[change_points_dropna['feature_name']==feature_name]
-                if len(cpnow) > 0:
-                    continue
-            ax1.axhline(y_percentiles[0],ls=':',color='k')
-            ax1.axhline(y_percentiles[1],ls='--',color='k')
-            ax1.axhline(y_percentiles[2],ls=':',color='k')
-        
-        
-        # titles
-        ax1.set_title(feature_name)
-        ax1.legend()
-        plt.grid()
-    
-        # Done with the page
-        pdf_pages.savefig(fig)
-        
-    # save change point data to pdf
-    if change_points is not None:
-        df_cp3 = drop_end_changepoints(change_points_dropna)
-        if len(df_cp3)>0:
-            fig = plt.figure()
-            fig.suptitle('VLM Change Point Summary')
-            table = plt.table(cellText=df_cp3.values, colLabels=df_cp3.columns, loc='center',
-                  colWidths=[0.1 for col in range(df_cp3.columns.size)])
-            table.auto_set_font_size(True)
-            #table.set_fontsize(24)
-            #table.scale(2, 2)
-            plt.axis('off')
-            pdf_pages.savefig()
-    
-
-    pdf_pages.close()
-
-
-def calculate_change_points(dfin:pd.DataFrame, 
+def calculate_change_points(dfin, 
                             percentiles:list= [25,50,75], 
                             explode:bool=True,
                             keep_last_changepoint=True,
                             trend_penalty:int = 10, 
                             rolling_sd_window:int = 10, 
-                            rolling_sd_penalty:int=10)->pd.DataFrame:
+                            rolling_sd_penalty:int=10,
+                            cost_model:str = 'rbf',
+                            search_method = 'pelt',
+                            n_jobs:int = 1,
+                            chunksize:int = 16,
+                            bad_data:str = 'rows',
+                            bad_data_checks:list = ['NaN','Inf'],
+                            min_constant_run:int = 7,
+                            cache = None,
+                            screen_penalty:float = None,
+                            percentile_sketches:pd.DataFrame = None,
+                            coarse_freq:str = None,
+                            refine_periods:int = 1)->pd.DataFrame:
     """
     Calculate change points in a dataframe of timeseries data
     INPUTS:
-    dfin: Input pandas dataframe
+    dfin: Input pandas dataframe, or an iterable of column chunks (DataFrames or named Series sharing one index), e.g.
+          dataset_storage.iter_column_chunks. Chunks are pulled and released one at a time, so memory is bounded by the
+          chunk size rather than the number of features, and the result is the same as for the concatenated dataframe
     percentiles: Percentiles to report levels
     explode = boolean explode the percentiles in the output dataframe or keep as list form
     keep_last_changepoint = False, bbyu default changepoint analysis keeps the last point in the timeseries regardless of any changepoints. Useful for plotting in the generate_vlm_display function but less useful for clarity
     trend_penalty = 10 default ruptures change point sensitivity parameter, lower means more change points identified but introduces noise
-    rolling_sd_window: set to None else sets the window for standard deviation anomaly detection to identify timeseries whose levels may not change but with periods of variable volatility
+    rolling_sd_window: set to None else sets the window for standard deviation anomaly detection to identify timeseries whose levels may not change but with periods of variable volatility. The rolling sd of the residuals from the trend segments is segmented with a linear cost (see _volatility_change_points)
     rolling_sd_penalty: as with trend_penalty but for the rolling sd anomaly detection
+    cost_model: 'rbf' (default, ruptures kernel cost) or the linear cost 'normal' (mean and variance changes) / 'l2' (mean changes) backends for long histories
+    search_method: 'pelt' (default), 'binseg', 'window' or an unfitted ruptures-style algorithm instance. With the
+                   linear costs, series longer than PELT_MAX_LENGTH rows are searched with 'binseg' instead of 'pelt'
+    n_jobs: number of worker processes. 1 (default) runs serially, None or -1 uses all cores. Output is identical to the serial path
+    chunksize: number of features sent to a worker per task. Only chunksize columns per in-flight task are copied to the workers so memory stays bounded
+    bad_data: 'rows' (default) reports one record per bad row. 'runs' reports each contiguous run of bad data once instead, with end_datetime and length columns
+    bad_data_checks: subset of ['NaN','Inf','Zero','Constant']. Zero / Constant runs flag dead feeds and stuck values
+    min_constant_run: minimum number of rows of a reported Zero / Constant run
+    cache: None, a result_cache.ResultCache or a cache directory. Per-feature change points are cached on disk keyed by
+           the feature values, index and parameters, so unchanged features are not refitted on reruns. The cache is
+           evicted to its size budget (least recently used first) at the end of the call
+    screen_penalty: None (default) segments every feature. Otherwise tiered detection: a vectorized screening pass tests
+                    each chunk of features at once for a single mean / variance change (segmentation.split_gain) and
+                    only features whose gain exceeds screen_penalty are segmented, the rest are reported as one
+                    whole-series segment. The best split of pure noise gains a few units, so a value around the
+                    trend_penalty (e.g. 10) screens out stationary features while keeping real level, trend and
+                    volatility changes. Lower values are more conservative and screen out fewer features
+    percentile_sketches: None (default, exact np.percentile levels) or a pd.DataFrame of quantile_sketch.KLLSketch
+                         indexed like the rows of dfin, e.g. quantile_sketch.sketch_features of the raw history by day
+                         with dfin holding the daily aggregates. Segment levels and whole-series percentiles are then
+                         read from the merged sketches of the rows they span (within the sketch rank error), so the raw
+                         history never has to be loaded. Features without a sketch column keep exact percentiles
+    coarse_freq: None (default) segments the full series. Otherwise multi-resolution detection for high-frequency
+                 features (DatetimeIndex): each series is aggregated to per-period means and standard deviations (e.g.
+                 coarse_freq='1d' for minute data), change points are detected on those with the chosen cost model,
+                 trend_penalty and rolling_sd_penalty, and each is then placed at full resolution by an exact search
+                 within refine_periods periods either side. Run time scales with the number of periods plus the
+                 number of change points rather than the history length (the rbf cost is only built per window).
+                 Change point datetimes are then full timestamps instead of dates
+    refine_periods: number of coarse periods either side of a coarse change point searched at full resolution
     
     OUTPUT:
-    df_cp: pandas dataframe of change points
+    df_cp: pandas dataframe of change points. df_cp.attrs['series_percentiles'] holds the whole-series percentiles of each
+           feature (see series_percentiles), which the report functions reuse
     
     """
-    df = dfin.copy()
-    nx,ny = np.shape(df)
-    df_cp = pd.DataFrame({})
-    for i in range(ny):
-        
-        feature_name = df.columns[i]
-        x = df.index
-        y = df[feature_name].values
-        
-        
-        
-        #identify nans
-        idx_nan = np.where(y!=y)[0]
-        x_nan = list(x[idx_nan])
-        dfn = pd.DataFrame({'feature_name':[feature_name]*len(x_nan),'datetime':x_nan,'percentile':[np.nan]*len(x_nan),'value':[np.nan]*len(x_nan),'description':['NaN']*len(x_nan)})
-        df_cp = pd.concat([df_cp, dfn])
-        
-        
-        #indentify infs
-        idx_inf = np.where(np.isinf(y))[0]
-        x_inf = list(x[idx_inf])
-        dfn = pd.DataFrame({'feature_name':[feature_name]*len(x_inf),'datetime':x_inf,'percentile':[np.nan]*len(x_nan),'value':[np.nan]*len(x_inf),'description':['Inf']*len(x_inf)})
-        df_cp = pd.concat([df_cp, dfn])
-        
-        #remove these for trend bit
-        ys = pd.Series(y)
-        ys.iloc[idx_inf]=np.nan
-        y = ys.fillna(method='ffill').values
-        
-        algo = rpt.Pelt(model="rbf").fit(y)
-        result = algo.predict(pen=10)
-        
-        
-        #apply rolling standard deviation filter
-        if rolling_sd_window is not None:
-            yrsd = pd.Series(y).rolling(rolling_sd_window).std().shift(-int(rolling_sd_window/2)).dropna()
-            algo = rpt.Pelt(model="rbf").fit(y)
-            ap = algo.predict(pen=10)
-            result = result + ap
-            result = list(set(result))
-            result.sort()
-        
-        
-        
-        idxlo = 0
-        for r in result:
-            yn = y[idxlo:r]
-            y_pc = np.percentile(yn,percentiles)
-            idxlo = r
-            dfn = pd.DataFrame({'feature_name':[feature_name],'datetime':[x[min(nx-1,r)]],'percentile':[percentiles],'value':[y_pc],'description':['trend/volatility']})
-            df_cp = pd.concat([df_cp, dfn])
-        
-        
-        
-            
-    
-    df_cp['datetime']=pd.to_datetime(df_cp['datetime']).dt.date
-    
+    kwargs = dict(percentiles=percentiles,
+                  trend_penalty=trend_penalty,
+                  rolling_sd_window=rolling_sd_window,
+                  rolling_sd_penalty=rolling_sd_penalty,
+                  cost_model=cost_model,
+                  search_method=search_method)
+    stats_kwargs = dict(percentiles=percentiles,
+                        bad_data_checks=bad_data_checks,
+                        min_constant_run=min_constant_run,
+                        bad_data=bad_data)
+    func = _feature_change_points
+    if coarse_freq is not None:
+        func = _feature_refined_change_points
+        kwargs.update(coarse_freq=coarse_freq, refine_periods=refine_periods)
+    cache = _resolve_cache(cache)
+    blocks = _map_features(func, dfin, kwargs, n_jobs, chunksize, stats_kwargs, cache, screen_penalty, percentile_sketches)
+    
+    builder = ChangePointBuilder(percentiles, bad_data=bad_data)
+    feature_names, y_percentiles = [], []
+    for (feature_name, seg_x, seg_values), (bad, y_pc) in blocks:
+        builder.add(feature_name, seg_x=seg_x, seg_values=seg_values, **bad)
+        feature_names.append(feature_name)
+        y_percentiles.append(y_pc)
+    
+    # full timestamps when the change points are placed at full resolution
+    as_date = coarse_freq is None
     if keep_last_changepoint is False:
+        with profiling.stage('build'):
+            df_cp = builder.build(explode=False, as_date=as_date)
         df_cp = drop_end_changepoints(df_cp)
+    else:
+        with profiling.stage('build'):
+            df_cp = builder.build(explode=explode, as_date=as_date)
+    
+    df_cp = df_cp.reset_index(drop=True)
+    # whole-series percentiles, reused by generate_vlm_display / generate_vlm_report
+    df_cp.attrs['series_percentiles'] = pd.DataFrame(np.array(y_percentiles).reshape(len(feature_names), len(percentiles)),
+                                                     index=pd.Index(feature_names), columns=list(percentiles))
+    if cache is not None:
+        cache.evict()
+    return df_cp
+
+
+def synthetic_features(n_features:int = 7, n_history:int = 365, end_date = None, freq:str = '1d', seed:int = None)->pd.DataFrame:
+    """
+    Synthetic feature table with the failure modes the monitoring should catch, used by the example below and as the
+    benchmark workload (benchmark_monitoring.py)
     
-    if explode:
-        df_cp = df_cp.set_index(['feature_name','datetime']).apply(pd.Series.explode).reset_index()
-        
-    
-    
-    return df_cp.reset_index(drop=True)
-    
+    Every feature gets a random offset. Features are assigned a scenario cyclically (feature index modulo 7):
+    3: NaN and Inf rows, 4: trend between 1/2 and 3/4 of the history, 5: dead (zero) period, 6: volatility burst
+    over the same period, the others are stationary noise. With the defaults this is the original 7 feature example.
     
+    INPUTS:
+    n_features: number of features
+    n_history: number of rows
+    end_date: last date of the index (defaults to today)
+    freq: index frequency, e.g. '1d' or '1h' for long histories
+    seed: None to draw from the global numpy random state, or a seed for an independent generator
     
-if __name__ == '__main__':
-
-    # Ingest model input features data pull (previous-1yr)
-    #
-    #
-    #
-    ## this is just a template so create some synthetic data here
-    n_features = 7
-    n_history = 365
-    end_date = pd.Timestamp.today().date()
-    start_date = end_date - pd.Timedelta(str(int(n_history-1))+'D')
-    dates = pd.date_range(start_date, end_date, freq='1d')
-    X = np.random.randn(n_history,n_features)
+    OUTPUT:
+    df: pandas dataframe of features, one column per feature and a datetime index
+    """
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    if end_date is None:
+        end_date = pd.Timestamp.today().date()
+    dates = pd.date_range(end=pd.Timestamp(end_date), periods=n_history, freq=freq)
+    X = rng.randn(n_history,n_features)
     ## inject artificial feature offsets
-    offsets = 5*np.random.randn(n_features)
+    offsets = 5*rng.randn(n_features)
     X = X + offsets
-    ## inject artifical trend
-    idx_trend_feature = 4
-    idx_trend_start = int(n_history/2)
-    idx_trend_end = int(3/4*n_history)
-    trend = 0.1*(np.arange(n_history) - idx_trend_start) + X[idx_trend_start,idx_trend_feature]
-    trend[:idx_trend_start]=0
-    trend[idx_trend_end:]=trend[idx_trend_end]
-    X[:, idx_trend_feature] += trend 
-    
+    cols = np.arange(n_features)
+    idx_start = int(n_history/2)
+    idx_end = int(3/4*n_history)
     
     #Add nans and infinities
-    X[10:12,3]=np.nan
-    X[40:42,3] = np.inf
+    bad = cols[cols % 7 == 3]
+    X[10:12, bad] = np.nan
+    X[40:42, bad] = np.inf
     
+    ## inject artifical trend
+    trend = 0.1*(np.arange(n_history) - idx_start)
+    trend[:idx_start] = 0
+    trend[idx_end:] = trend[idx_end]
+    for j in cols[cols % 7 == 4]:
+        X[idx_start:, j] += trend[idx_start:] + X[idx_start, j]
     
     ## simulate dead-period
-    idx_trend_feature = 5
-    idx_trend_start = int(n_history/2)
-    idx_trend_end = int(3/4*n_history)
-    X[idx_trend_start:idx_trend_end, idx_trend_feature] = 0
+    X[idx_start:idx_end, cols[cols % 7 == 5]] = 0
     
     ## volatility change
-    idx_trend_feature = 6
-    idx_trend_start = int(n_history/2)
-    idx_trend_end = int(3/4*n_history)
-    xm = X[idx_trend_start:idx_trend_end, idx_trend_feature].mean()
-    X[idx_trend_start:idx_trend_end, idx_trend_feature] = (X[idx_trend_start:idx_trend_end, idx_trend_feature] - xm)*10 + xm
-    
+    vol = cols[cols % 7 == 6]
+    xm = X[idx_start:idx_end, vol].mean(axis=0)
+    X[idx_start:idx_end, vol] = (X[idx_start:idx_end, vol] - xm)*10 + xm
     
     # create feature dataframe 
     df = pd.DataFrame(X,columns = ['feature_'+str(i) for i in range(n_features)])
     df.index = dates
+    return df
+
+
+
+if __name__ == '__main__':
+
+    # Ingest model input features data pull (previous-1yr)
+    #
+    #
+    #
+    ## this is just a template so create some synthetic data here
+    df = synthetic_features(n_features=7, n_history=365)
     
     
     ## Change-point detection
-    change_points_for_chart = calculate_change_points(df, percentiles= [25,50,75],explode=False)
+    change_points_for_chart = calculate_change_points(df, percentiles= [25,50,75],explode=False, bad_data_checks=['NaN','Inf','Zero'])
     change_points = drop_end_changepoints(change_points_for_chart,explode=False)
     
     ## Monitoring Output
@@ -296,4 +207,4 @@ if __name__ == '__main__':
     
     
     
-    
\ No newline at end of file
+    
@@ -0,0 +1,160 @@
+"""
+Multi-resolution change point detection for high-frequency features, calculate_change_points(df, coarse_freq='1d').
+
+Each feature is aggregated to per-period means and standard deviations, change points are detected on those short
+series, and each one is then placed at full resolution by the best single split of the raw rows within refine_periods
+periods of it, so the cost grows with the number of periods and change points rather than the history length.
+"""
+import numpy as np
+import pandas as pd
+import segmentation
+import profiling
+from feature_segmentation import _segmenter, _clean_feature, _segment_records
+
+
+
+def _coarse_periods(x, coarse_freq:str)->np.ndarray:
+    """
+    Start position of each coarse period of a sorted DatetimeIndex, followed by len(x). A partial first or last period
+    (fewer than half the median number of rows, e.g. a history ending at midnight with coarse_freq='1d') is merged into
+    its neighbour, as its mean and standard deviation are much noisier than those of the full periods
+    """
+    if not isinstance(x, pd.DatetimeIndex):
+        raise TypeError('Multi-resolution detection needs a DatetimeIndex, got '+type(x).__name__)
+    if not x.is_monotonic_increasing:
+        raise ValueError('Multi-resolution detection needs a sorted index')
+    period = np.asarray(x.floor(coarse_freq))
+    bounds = np.append(np.flatnonzero(np.r_[True, period[1:] != period[:-1]]), len(x))
+    if len(bounds) > 3:
+        rows = np.diff(bounds)
+        if rows[0] < 0.5*np.median(rows):
+            bounds = np.delete(bounds, 1)
+        if rows[-1] < 0.5*np.median(rows):
+            bounds = np.delete(bounds, -2)
+    return bounds
+
+
+def _refine_change_point(y:np.ndarray, lo:int, hi:int, cost_model:str = 'normal', min_size:int = 2)->int:
+    """
+    Full resolution position of a change point found on the coarse series: the best single split of y[lo:hi]
+    
+    INPUTS:
+    y: cleaned numpy array of feature values
+    lo, hi: window of y around the coarse change point
+    cost_model: 'rbf', 'l2' or 'normal' (segmentation.CostRbf / CumSumCost, the window being standardised for the latter)
+    min_size: minimum segment length on either side
+    
+    OUTPUT:
+    position in y of the split, None if the window is too short
+    """
+    w = y[lo:hi]
+    t = np.arange(min_size, len(w) - min_size + 1)
+    if len(t) == 0 or not np.isfinite(w).all():
+        return None
+    if cost_model == 'rbf':
+        cost = segmentation.CostRbf().fit(w)
+    else:
+        cost = segmentation.CumSumCost(cost_model).fit((w - np.median(w))/segmentation.robust_scale(w))
+    return lo + int(t[np.argmin(cost.error(0, t) + cost.error(t, len(w)))])
+
+
+def _feature_refined_change_points(feature_name, x, y,
+                                   coarse_freq:str = '1d',
+                                   refine_periods:int = 1,
+                                   percentiles:list= [25,50,75],
+                                   trend_penalty:int = 10,
+                                   rolling_sd_window:int = 10,
+                                   rolling_sd_penalty:int=10,
+                                   cost_model:str = 'rbf',
+                                   search_method = 'pelt',
+                                   segment:bool = True,
+                                   sketches:list = None)->tuple:
+    """
+    Multi-resolution trend/volatility change points for a single high-frequency feature: detection on the coarse
+    per-period means (trend) and standard deviations (volatility), then each coarse change point is placed at full
+    resolution by the best single split within refine_periods periods either side of it. The cost is that of the coarse
+    detection plus one window per change point, instead of a segmentation of the full series
+    
+    INPUTS:
+    coarse_freq: pandas offset alias of the coarse periods, e.g. '1d' for hourly / minute level features
+    refine_periods: number of periods either side of a coarse change point searched at full resolution
+    rolling_sd_window: None skips the volatility stage. Otherwise the volatility changes are found on the log of the
+                       per-period standard deviations (the window is the coarse period, periods with fewer than 2 rows
+                       are left out), and with cost_model='normal' the coarse trend stage looks for changes in the means
+                       only (l2)
+    remaining inputs as in _feature_change_points
+    
+    OUTPUT:
+    tuple (feature_name, seg_x, seg_values)
+    """
+    with profiling.stage('clean', feature_name):
+        y = _clean_feature(y)
+    
+    if not segment:
+        with profiling.stage('segment_percentiles', feature_name):
+            seg_x, seg_values = _segment_records(x, y, [len(y)], percentiles, sketches)
+        return feature_name, seg_x, seg_values
+    
+    nx = len(y)
+    r = max(1, int(refine_periods))
+    with profiling.stage('coarse_fit', feature_name):
+        #per-period mean and sd of the finite values (only leading rows can still be NaN), empty periods left out
+        bounds = _coarse_periods(x, coarse_freq)
+        finite = np.isfinite(y)
+        centred = np.where(finite, y - (np.median(y[finite]) if finite.any() else 0.0), 0.0)
+        count = np.add.reduceat(finite.astype(float), bounds[:-1])
+        has_data = count > 0
+        starts = np.append(bounds[:-1][has_data], nx)
+        count = count[has_data]
+        mean = np.add.reduceat(centred, bounds[:-1])[has_data]/count
+        var = np.add.reduceat(centred**2, bounds[:-1])[has_data]/count - mean**2
+        n_coarse = len(mean)
+        
+        trend, vol = [], []
+        if n_coarse >= 4:
+            # with the volatility stage the per-period SDs cover variance changes, and the coarse trend is a change in
+            # the means only (the variance of a few dozen daily means flags stationary features at the usual penalty)
+            coarse_model = 'l2' if cost_model == 'normal' and rolling_sd_window is not None else cost_model
+            # the coarse series is short, every period boundary is a candidate (a change within a period leaves
+            # one mixed period, which a coarser grid can only isolate with a spurious extra change point)
+            algo = _segmenter(coarse_model, search_method, n_coarse, jump=1)
+            if isinstance(search_method, str):
+                if coarse_model in segmentation.COST_MODELS:
+                    # period means of heavy tailed noise keep occasional outliers, see the volatility scale below
+                    algo.scale = max(segmentation.robust_scale(mean), np.std(np.diff(mean))/np.sqrt(2))
+            trend = algo.fit(mean).predict(pen=trend_penalty)[:-1]
+            # a standard deviation needs at least 2 values, periods with fewer are left out of the volatility stage
+            has_sd = np.flatnonzero(count >= 2)
+            if rolling_sd_window is not None and len(has_sd) >= 4:
+                floor = 1e-3*segmentation.robust_scale(y[finite]) if finite.any() else 1e-3
+                log_sd = np.log(np.maximum(np.sqrt(np.maximum(var[has_sd], 0.0)), floor))
+                # heavy tailed noise gives occasional outlying period SDs, which the sd of the differences accounts for
+                # and the median absolute difference of robust_scale does not
+                scale = max(segmentation.robust_scale(log_sd), np.std(np.diff(log_sd))/np.sqrt(2))
+                vol_algo = _segmenter('l2', 'pelt', len(log_sd), jump=1)
+                vol_algo.scale = scale
+                vol = vol_algo.fit(log_sd).predict(pen=rolling_sd_penalty)[:-1]
+                vol = [int(has_sd[b]) for b in vol]
+                # volatility breaks near a trend change point cannot be told apart from it
+                vol = [b for b in vol if len(trend) == 0 or np.min(np.abs(np.array(trend) - b)) > r]
+    
+    with profiling.stage('refine_fit', feature_name):
+        # coarse change points within refine_periods of each other share one window (they are one change seen in
+        # neighbouring periods, or too close to be resolved at the coarse resolution)
+        candidates = sorted([(b, cost_model) for b in trend] + [(b, 'normal') for b in vol])
+        windows = []
+        for b, model in candidates:
+            if len(windows) > 0 and b - windows[-1][1] <= r:
+                windows[-1][1] = b
+            else:
+                windows.append([b, b, model])
+        result = set()
+        for first, last, model in windows:
+            position = _refine_change_point(y, starts[max(first - r, 0)], starts[min(last + r, n_coarse)], model)
+            if position is not None:
+                result.add(position)
+        result = sorted(result) + [nx]
+    
+    with profiling.stage('segment_percentiles', feature_name):
+        seg_x, seg_values = _segment_records(x, y, result, percentiles, sketches)
+    return feature_name, seg_x, seg_values
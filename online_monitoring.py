@@ -0,0 +1,217 @@
+import pickle
+import pandas as pd
+import numpy as np
+import segmentation
+from change_point_table import ChangePointBuilder, drop_end_changepoints, _bad_data_runs
+
+
+
+class _OnlineFeature:
+    """
+    Incremental change point state of a single feature: bad data rows or runs, the OnlinePelt recursion, percentile levels
+    of the confirmed (final) segments and the raw values since the last confirmed change point
+    """
+
+    def __init__(self, percentiles:list, trend_penalty:float, cost_model:str, min_size:int, jump:int, bad_data:str = 'rows',
+                 max_lookback:int = None):
+        self.percentiles = percentiles
+        self.pelt = segmentation.OnlinePelt(pen=trend_penalty, model=cost_model, min_size=min_size, jump=jump, max_lookback=max_lookback)
+        self.bad_data = bad_data
+        self.nan_x = []
+        self.inf_x = []
+        # [start_x, end_x, length, still open at the last row] per run
+        self.runs = {'NaN':[], 'Inf':[]}
+        self.seg_x = []
+        self.seg_values = []
+        self.x_tail = np.array([])
+        self.y_tail = np.array([])
+        self.last_valid = np.nan
+        self.pending_x = np.array([])
+        self.pending_y = np.array([])
+
+    def update(self, x:np.ndarray, y:np.ndarray):
+        """
+        Append new rows of the feature
+
+        INPUTS:
+        x: index values of the new rows
+        y: numpy array of feature values
+        """
+        y = np.asarray(y, dtype=float)
+        if self.bad_data == 'rows':
+            self.nan_x.extend(x[np.isnan(y)])
+            self.inf_x.extend(x[np.isinf(y)])
+        else:
+            self._update_runs(x, y)
+
+        # forward fill NaN / Inf from the last valid value. Values before the first valid one wait for it and are back filled
+        # with it, as feature_segmentation._clean_feature does for the batch path
+        x = np.concatenate([self.pending_x, x]) if len(self.pending_x) > 0 else x
+        y = np.concatenate([self.pending_y, y])
+        yf = np.where(np.isfinite(y), y, np.nan)
+        if yf[0] != yf[0]:
+            yf[0] = self.last_valid
+        yf = pd.Series(yf).fillna(method='ffill')
+        if yf.isna().all():
+            self.pending_x, self.pending_y = x, y
+            return
+        yf = yf.fillna(method='bfill').values
+        self.pending_x, self.pending_y = np.array([]), np.array([])
+        self.last_valid = yf[-1]
+
+        tail_start = self.pelt.confirmed_
+        self.x_tail = np.concatenate([self.x_tail, x]) if len(self.x_tail) > 0 else np.asarray(x)
+        self.y_tail = np.concatenate([self.y_tail, yf])
+
+        # freeze the percentile levels of newly confirmed segments and release their data
+        confirmed = self.pelt.update(yf)
+        lo = tail_start
+        for c in confirmed:
+            self.seg_x.append(self.x_tail[c - tail_start])
+            self.seg_values.append(np.percentile(self.y_tail[lo - tail_start:c - tail_start], self.percentiles))
+            lo = c
+        self.x_tail = self.x_tail[self.pelt.confirmed_ - tail_start:]
+        self.y_tail = self.y_tail[self.pelt.confirmed_ - tail_start:]
+
+    def _update_runs(self, x:np.ndarray, y:np.ndarray):
+        """
+        Extend the bad data runs with new rows, continuing a run that was open at the previous last row
+        """
+        _, start, length, description = _bad_data_runs(y, ['NaN','Inf'])
+        for check, runs in self.runs.items():
+            was_open = len(runs) > 0 and runs[-1][3]
+            if was_open:
+                runs[-1][3] = False
+            for s, n in zip(start[description == check], length[description == check]):
+                if s == 0 and was_open:
+                    runs[-1][1:] = [x[n-1], runs[-1][2] + n, n == len(y)]
+                else:
+                    runs.append([x[s], x[s+n-1], int(n), s+n == len(y)])
+
+    def records(self)->dict:
+        """
+        Change point records as ChangePointBuilder.add keyword arguments (confirmed segments followed by the live ones)
+        """
+        n = self.pelt.n_samples
+        tail_start = self.pelt.confirmed_
+        seg_x = list(self.seg_x)
+        seg_values = list(self.seg_values)
+        lo = tail_start
+        if n > tail_start:
+            for r in self.pelt.predict():
+                seg_x.append(self.x_tail[min(n-1, r) - tail_start])
+                seg_values.append(np.percentile(self.y_tail[lo - tail_start:r - tail_start], self.percentiles))
+                lo = r
+        if self.bad_data == 'rows':
+            bad_x = list(self.nan_x) + list(self.inf_x)
+            bad_description = ['NaN']*len(self.nan_x) + ['Inf']*len(self.inf_x)
+            return dict(bad_x=bad_x, bad_description=bad_description, seg_x=seg_x, seg_values=seg_values)
+        runs = self.runs['NaN'] + self.runs['Inf']
+        return dict(bad_x=[r[0] for r in runs],
+                    bad_description=['NaN']*len(self.runs['NaN']) + ['Inf']*len(self.runs['Inf']),
+                    bad_end_x=[r[1] for r in runs],
+                    bad_length=[r[2] for r in runs],
+                    seg_x=seg_x, seg_values=seg_values)
+
+
+
+class OnlineChangePointDetector:
+    """
+    Stateful change point detection for feature tables that grow by appended rows (e.g. one new day per nightly run).
+
+    Each feature keeps an incremental PELT state (segmentation.OnlinePelt), so an update costs about the number of new
+    rows times the number of live candidates instead of a refit over the whole history. For the same penalty the change
+    points equal calculate_change_points(df, cost_model=cost_model, rolling_sd_window=None) with the scale / center frozen
+    at the first update, as long as no segment stays unconfirmed for more than max_lookback rows. Volatility changes are
+    covered by the 'normal' cost model (mean and variance segments) rather than a separate rolling sd stage.
+
+    Only data since each feature's last confirmed change point is held, at most about max_lookback rows per feature: a
+    feature without changes for longer than that has its live segment split (see segmentation.OnlinePelt), which bounds
+    the state and the update cost. The detector pickles with save() / load() so a nightly job can resume from the
+    previous snapshot.
+
+    INPUTS:
+    percentiles: Percentiles to report levels
+    trend_penalty: change point penalty (fixed for the lifetime of the detector)
+    cost_model: 'normal' (default) or 'l2', see segmentation.py
+    min_size, jump: as for segmentation.Pelt
+    bad_data: 'rows' (default) or 'runs', as in calculate_change_points. Runs that continue across updates are merged.
+              Only NaN / Inf are checked
+    max_lookback: maximum number of rows held per feature since its last confirmed change point (None for no cap)
+    """
+
+    def __init__(self, percentiles:list = [25,50,75], trend_penalty:float = 10, cost_model:str = 'normal', min_size:int = 2, jump:int = 5,
+                 bad_data:str = 'rows', max_lookback:int = 20000):
+        if cost_model not in segmentation.COST_MODELS:
+            raise ValueError('Online detection needs a cumulative sum cost, one of '+str(segmentation.COST_MODELS))
+        self.percentiles = percentiles
+        self.trend_penalty = trend_penalty
+        self.cost_model = cost_model
+        self.min_size = min_size
+        self.jump = jump
+        self.bad_data = bad_data
+        self.max_lookback = max_lookback
+        self.features = {}
+        self.last_index = None
+
+    def update(self, dfnew:pd.DataFrame):
+        """
+        Append new rows (the first call provides the initial history)
+
+        INPUTS:
+        dfnew: dataframe of new rows, index after any previously seen row. Columns not seen before start a new feature,
+               previously seen columns must all be present
+
+        OUTPUT:
+        self
+        """
+        if len(dfnew) == 0:
+            return self
+        if self.last_index is not None and dfnew.index[0] <= self.last_index:
+            raise ValueError('New rows must come after the last seen index value '+str(self.last_index))
+        missing = [name for name in self.features if name not in dfnew.columns]
+        if len(missing) > 0:
+            raise ValueError('Missing previously seen features: '+str(missing))
+        x = np.asarray(dfnew.index)
+        for name in dfnew.columns:
+            if name not in self.features:
+                self.features[name] = _OnlineFeature(self.percentiles, self.trend_penalty, self.cost_model, self.min_size, self.jump, self.bad_data,
+                                                    self.max_lookback)
+            self.features[name].update(x, dfnew[name].values)
+        self.last_index = dfnew.index[-1]
+        return self
+
+    def change_points(self, explode:bool = True, keep_last_changepoint:bool = True)->pd.DataFrame:
+        """
+        Change points of all rows seen so far, in the calculate_change_points schema
+
+        INPUTS:
+        explode, keep_last_changepoint: as in calculate_change_points
+
+        OUTPUT:
+        df_cp: pandas dataframe of change points
+        """
+        builder = ChangePointBuilder(self.percentiles, bad_data=self.bad_data)
+        for name, feature in self.features.items():
+            builder.add(name, **feature.records())
+        if keep_last_changepoint is False:
+            return drop_end_changepoints(builder.build(explode=False)).reset_index(drop=True)
+        return builder.build(explode=explode)
+
+    def save(self, path:str):
+        """
+        Pickle the detector state, e.g. ./data_s3/OVForecast_20220606_1_cpstate.pickle
+        """
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path:str):
+        """
+        Load a detector saved with save()
+        """
+        with open(path, 'rb') as f:
+            detector = pickle.load(f)
+        if not isinstance(detector, cls):
+            raise TypeError(path+' does not contain a '+cls.__name__)
+        return detector
@@ -0,0 +1,161 @@
+"""
+Change points for several trend penalties from one fit per feature (penalty_sweep_change_points), to tune the
+trend_penalty of calculate_change_points. A list of penalties is evaluated as given, a penalty range with CROPS.
+"""
+import pandas as pd
+import segmentation
+import profiling
+from change_point_table import ChangePointBuilder
+from feature_segmentation import _segmenter, _volatility_change_points, _clean_feature, _segment_records
+from feature_pool import _map_features, _resolve_cache
+
+
+
+def _crops(algo, pen_min:float, pen_max:float, max_evals:int = 50)->dict:
+    """
+    Changepoints for a Range Of PenaltieS (CROPS, Haynes et al. 2017): all distinct optimal segmentations for
+    penalties in [pen_min, pen_max], found with a number of predict calls close to the number of distinct segmentations
+    
+    INPUTS:
+    algo: fitted search algorithm exposing predict(pen) and cost.sum_of_costs(bkps)
+    pen_min, pen_max: penalty range
+    max_evals: maximum number of predict calls
+    
+    OUTPUT:
+    dict of penalty -> segment ends, for every evaluated penalty
+    """
+    evaluated = {}
+    def run(pen):
+        bkps = algo.predict(pen=pen)
+        evaluated[pen] = bkps
+        return (pen, len(bkps) - 1, algo.cost.sum_of_costs(bkps))
+    
+    stack = [(run(pen_min), run(pen_max))]
+    while stack and len(evaluated) < max_evals:
+        (b0, m0, q0), (b1, m1, q1) = stack.pop()
+        if m0 <= m1 + 1:
+            continue
+        # penalty at which the two segmentations have equal penalised cost
+        b = (q1 - q0)/(m0 - m1)
+        if not b0 < b < b1:
+            continue
+        mid = run(b)
+        if mid[1] not in (m0, m1):
+            stack.append(((b0, m0, q0), mid))
+            stack.append((mid, (b1, m1, q1)))
+    return evaluated
+
+
+def _feature_penalty_sweep(feature_name, x, y,
+                           penalties:list = None,
+                           penalty_range:tuple = None,
+                           max_evals:int = 50,
+                           percentiles:list= [25,50,75],
+                           rolling_sd_window:int = 10,
+                           rolling_sd_penalty:int=10,
+                           cost_model:str = 'rbf',
+                           search_method = 'pelt')->list:
+    """
+    Change point records of a single feature for several trend penalties from a single fit
+    
+    INPUTS:
+    as in penalty_sweep_change_points
+    
+    OUTPUT:
+    list of (penalty, (feature_name, seg_x, seg_values)) in increasing penalty order, consecutive identical segmentations dropped
+    """
+    with profiling.stage('clean', feature_name):
+        y = _clean_feature(y)
+    with profiling.stage('trend_fit', feature_name):
+        if cost_model == 'rbf' and search_method == 'pelt':
+            # same segmentation as rpt.Pelt(model='rbf'), but O(1) segment costs from the integral image of the gram matrix
+            algo = segmentation.Pelt(model='rbf').fit(y)
+        else:
+            algo = _segmenter(cost_model, search_method, len(y)).fit(y)
+        if penalty_range is not None:
+            path = _crops(algo, min(penalty_range), max(penalty_range), max_evals)
+        else:
+            path = {pen:algo.predict(pen=pen) for pen in penalties}
+    
+    out = []
+    previous = None
+    for pen in sorted(path):
+        result = path[pen]
+        if penalty_range is not None and result == previous:
+            continue
+        previous = result
+        if rolling_sd_window is not None:
+            with profiling.stage('volatility_fit', feature_name):
+                result = sorted(set(result) | set(_volatility_change_points(y, result, rolling_sd_window, rolling_sd_penalty)))
+        with profiling.stage('segment_percentiles', feature_name):
+            seg_x, seg_values = _segment_records(x, y, result, percentiles)
+        out.append((pen, (feature_name, seg_x, seg_values)))
+    return out
+
+
+def penalty_sweep_change_points(dfin,
+                                penalties:list = None,
+                                penalty_range:tuple = None,
+                                max_evals:int = 50,
+                                percentiles:list= [25,50,75],
+                                explode:bool=True,
+                                rolling_sd_window:int = 10,
+                                rolling_sd_penalty:int=10,
+                                cost_model:str = 'rbf',
+                                search_method = 'pelt',
+                                n_jobs:int = 1,
+                                chunksize:int = 16,
+                                bad_data:str = 'rows',
+                                bad_data_checks:list = ['NaN','Inf'],
+                                min_constant_run:int = 7,
+                                cache = None)->pd.DataFrame:
+    """
+    Change points for several values of trend_penalty, fitting each feature once. The search is fitted once per feature
+    (for rbf the integral image of the gram matrix, see segmentation.CostRbf, for the linear costs the cumulative sums) and
+    predict is called per penalty, so tuning costs about one fit per feature instead of one calculate_change_points call per penalty.
+    
+    INPUTS:
+    dfin: Input pandas dataframe or iterable of column chunks, as in calculate_change_points
+    penalties: list of trend penalties to evaluate
+    penalty_range: alternatively (min, max) penalty range. All distinct segmentations in the range are found with CROPS
+                   and reported at the penalty they were first found for
+    max_evals: maximum number of penalties evaluated per feature with penalty_range
+    remaining inputs as in calculate_change_points
+    
+    OUTPUT:
+    df_cp: pandas dataframe of change points with a leading penalty column. The rows for each penalty match
+           calculate_change_points(dfin, trend_penalty=penalty) (last change point kept)
+    """
+    if (penalties is None) == (penalty_range is None):
+        raise ValueError('Pass exactly one of penalties or penalty_range')
+    kwargs = dict(penalties=penalties,
+                  penalty_range=penalty_range,
+                  max_evals=max_evals,
+                  percentiles=percentiles,
+                  rolling_sd_window=rolling_sd_window,
+                  rolling_sd_penalty=rolling_sd_penalty,
+                  cost_model=cost_model,
+                  search_method=search_method)
+    # gather per penalty so the output is grouped by penalty then feature
+    stats_kwargs = dict(percentiles=percentiles,
+                        bad_data_checks=bad_data_checks,
+                        min_constant_run=min_constant_run,
+                        bad_data=bad_data)
+    cache = _resolve_cache(cache)
+    by_penalty = {}
+    bad = []
+    for i, (sweep, (bad_i, _)) in enumerate(_map_features(_feature_penalty_sweep, dfin, kwargs, n_jobs, chunksize, stats_kwargs, cache)):
+        bad.append(bad_i)
+        for pen, block in sweep:
+            by_penalty.setdefault(pen, []).append((i,) + block)
+    
+    builder = ChangePointBuilder(percentiles, key_columns=['penalty'], bad_data=bad_data)
+    for pen in sorted(by_penalty):
+        for i, feature_name, seg_x, seg_values in by_penalty[pen]:
+            builder.add(feature_name, seg_x=seg_x, seg_values=seg_values, keys=(pen,), **bad[i])
+    with profiling.stage('build'):
+        df_cp = builder.build(explode=explode)
+    df_cp['penalty'] = df_cp['penalty'].astype(float)
+    if cache is not None:
+        cache.evict()
+    return df_cp
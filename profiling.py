@@ -0,0 +1,206 @@
+"""
+Per-stage timing hooks for the monitoring pipeline.
+
+calculate_change_points, penalty_sweep_change_points, drop_end_changepoints, generate_vlm_display and generate_vlm_report
+wrap their stages (bad data scan, trend fit, segment percentiles, result build, page rendering, ...) in stage(name, feature).
+Nothing is recorded unless a StageProfiler is active:
+
+    with StageProfiler() as prof:
+        df_cp = calculate_change_points(df)
+        generate_vlm_display(df, 'vlm.pdf', change_points=df_cp)
+    print(prof.report())
+
+Stages that run in worker processes (n_jobs > 1) are recorded there and merged into the active profiler. Without an
+active profiler stage() returns a shared no-op context manager, so the hooks cost a function call per stage.
+"""
+import time
+import tracemalloc
+import pandas as pd
+
+
+RECORD_COLUMNS = ['stage', 'feature', 'seconds', 'alloc_bytes', 'peak_bytes']
+
+_active = None
+
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    Times one stage into the active profiler. With allocation tracking the traced memory peak is reset on entry and
+    the enclosing stage's peak so far is carried on the profiler's stack, so nested stages all report their own peak
+    """
+
+    def __init__(self, profiler, name:str, feature):
+        self.profiler = profiler
+        self.name = name
+        self.feature = feature
+
+    def __enter__(self):
+        if self.profiler.allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            stack = self.profiler._peaks
+            if len(stack) > 0:
+                stack[-1] = max(stack[-1], peak)
+            stack.append(0)
+            tracemalloc.reset_peak()
+            self.start_bytes = current
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+        alloc_bytes, peak_bytes = None, None
+        if self.profiler.allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            stack = self.profiler._peaks
+            peak = max(stack.pop(), peak)
+            if len(stack) > 0:
+                stack[-1] = max(stack[-1], peak)
+            alloc_bytes = current - self.start_bytes
+            peak_bytes = peak - self.start_bytes
+        self.profiler.record((self.name, self.feature, seconds, alloc_bytes, peak_bytes))
+        return False
+
+
+def stage(name:str, feature = None):
+    """
+    Context manager timing a pipeline stage into the active StageProfiler (a no-op when there is none)
+
+    INPUTS:
+    name: stage name, e.g. 'trend_fit'
+    feature: None for whole-table stages, else the feature name
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _Stage(_active, name, feature)
+
+
+def active():
+    """
+    The active StageProfiler, or None
+    """
+    return _active
+
+
+def call_profiled(func, allocations:bool, *args):
+    """
+    Process pool task wrapper: func(*args) under a fresh profiler
+
+    OUTPUT:
+    (result, list of stage records)
+    """
+    with StageProfiler(allocations=allocations) as profiler:
+        result = func(*args)
+    return result, profiler.records
+
+
+
+class StageProfiler:
+    """
+    Context-managed collector of per-feature, per-stage durations
+
+    INPUTS:
+    allocations: also record the net allocated and peak bytes of each stage with tracemalloc (slows the pipeline down
+                 noticeably, so off by default)
+    callback: None or a function called with each record as it is collected, e.g. to stream timings to a log
+
+    Records are (stage, feature, seconds, alloc_bytes, peak_bytes) tuples, feature None for whole-table stages and the
+    byte counts None without allocation tracking. Profilers can be nested, stages are recorded by the innermost one.
+    """
+
+    def __init__(self, allocations:bool = False, callback = None):
+        self.allocations = allocations
+        self.callback = callback
+        self.records = []
+        self._peaks = []
+        self._previous = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _active
+        if self.allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        self._previous = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def record(self, record:tuple):
+        """
+        Add one (stage, feature, seconds, alloc_bytes, peak_bytes) record
+        """
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def extend(self, records:list):
+        """
+        Add records collected elsewhere, e.g. in a worker process
+        """
+        for record in records:
+            self.record(record)
+
+    def to_frame(self)->pd.DataFrame:
+        """
+        All records as a DataFrame with RECORD_COLUMNS
+        """
+        return pd.DataFrame(self.records, columns=RECORD_COLUMNS)
+
+    def stage_summary(self)->pd.DataFrame:
+        """
+        Calls, total / mean / max seconds (and total allocated / max peak bytes) per stage, slowest stage first
+        """
+        df = self.to_frame()
+        summary = df.groupby('stage', sort=False).agg(calls=('seconds', 'size'), total_s=('seconds', 'sum'),
+                                                      mean_s=('seconds', 'mean'), max_s=('seconds', 'max'))
+        if self.allocations:
+            bytes_summary = df.groupby('stage', sort=False).agg(alloc_bytes=('alloc_bytes', 'sum'), peak_bytes=('peak_bytes', 'max'))
+            summary = summary.join(bytes_summary)
+        return summary.sort_values('total_s', ascending=False)
+
+    def slowest_features(self, n:int = 10)->pd.DataFrame:
+        """
+        Per-feature seconds by stage and in total for the n slowest features
+
+        INPUTS:
+        n: number of features to return (None for all)
+
+        OUTPUT:
+        pd.DataFrame indexed by feature with one column per stage and a total_s column, slowest feature first
+        """
+        df = self.to_frame()
+        df = df[df['feature'].notna()]
+        table = df.pivot_table(index='feature', columns='stage', values='seconds', aggfunc='sum', fill_value=0.0, sort=False)
+        table.columns.name = None
+        table['total_s'] = table.sum(axis=1)
+        table = table.sort_values('total_s', ascending=False)
+        return table if n is None else table.head(n)
+
+    def report(self, n:int = 10)->str:
+        """
+        Text summary: time per stage and the n slowest features
+        """
+        if len(self.records) == 0:
+            return 'No stages recorded'
+        return ('Time per stage\n'+self.stage_summary().to_string()+'\n\n'
+                'Slowest features\n'+self.slowest_features(n).to_string())
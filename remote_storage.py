@@ -0,0 +1,618 @@
+"""
+Asynchronous access to the datasets in the forecast-model-datasets bucket, with a local cache.
+
+Instead of copying whole pickles into ./data_s3 with `aws s3 cp` before every job, a DatasetCache fetches versioned
+datasets (ModelName_DateStamp_Version, either a pickle or a dataset_storage directory) on demand and keeps them on local
+disk:
+
+    cache = DatasetCache(S3Store('forecast-model-datasets'), './data_s3/cache')
+    df = cache.load('OVForecast_20220606_1', columns=['feature_1', 'feature_2'], rows=(0, 100000))
+    paths = cache.fetch_many([cache.latest('OVForecast'), 'OVForecast_20220601_2'])
+
+Requests run concurrently on an asyncio event loop, up to `concurrency` at a time. Within a dataset only the shards of
+the requested columns and rows are downloaded, and large files are downloaded as concurrent byte ranges. Every file is
+checked against its sha256 (the dataset manifest checksums, or the <name>.pickle.sha256 file written by push) before it
+enters the cache, so a cache hit never reads a partial or corrupt download. The cache is bounded by max_bytes and evicted
+least recently used first, as result_cache.ResultCache. read_rows reads rows of a column straight from the bucket with
+ranged requests, without caching the shards.
+
+LocalStore is a filesystem-backed stand-in for a bucket with the same interface, e.g. to try the workflow or a job
+without S3 credentials. S3Store needs boto3.
+"""
+import io
+import os
+import re
+import json
+import asyncio
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+import profiling
+from dataset_storage import MANIFEST, FORMAT_VERSION, read_manifest, load_dataset, _shard_file, _row_range, _sha256
+
+
+DATASET_NAME = re.compile(r'^([^_/]+)_(\d{8})_(\d+)$')
+PICKLE = '.pickle'
+CHECKSUM = '.sha256'
+
+
+
+def _run(coro):
+    """
+    Run a coroutine to completion from synchronous code, also when an event loop is already running (e.g. in a notebook)
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def parse_dataset_name(name:str)->tuple:
+    """
+    (model_name, date_stamp, version) of a ModelName_DateStamp_Version dataset name, None when it does not follow the convention
+    """
+    match = DATASET_NAME.match(name)
+    if match is None:
+        return None
+    return match.group(1), match.group(2), int(match.group(3))
+
+
+
+class LocalStore:
+    """
+    Filesystem-backed stand-in for an S3 bucket: object keys are paths relative to root
+
+    INPUTS:
+    root: directory holding the objects
+    max_workers: threads serving requests
+
+    Attributes n_requests and bytes_read count the get requests and the bytes they returned (updated under a lock, the
+    requests run in pool threads)
+    """
+
+    def __init__(self, root:str, max_workers:int = 8):
+        self.root = root
+        self.n_requests = 0
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers)
+
+    def _path(self, key:str)->str:
+        return os.path.join(self.root, *key.split('/'))
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _size(self, key:str)->int:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError('No object '+key)
+        return os.path.getsize(path)
+
+    async def size(self, key:str)->int:
+        """
+        Size of an object in bytes (FileNotFoundError when it does not exist)
+        """
+        return await self._call(self._size, key)
+
+    def _count(self, data:bytes)->bytes:
+        with self._lock:
+            self.n_requests += 1
+            self.bytes_read += len(data)
+        return data
+
+    def _get(self, key:str, start:int, stop:int)->bytes:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError('No object '+key)
+        with open(path, 'rb') as f:
+            f.seek(start or 0)
+            data = f.read() if stop is None else f.read(max(0, stop - (start or 0)))
+        return self._count(data)
+
+    async def get(self, key:str, start:int = None, stop:int = None)->bytes:
+        """
+        Bytes start:stop of an object (all of it by default)
+        """
+        return await self._call(self._get, key, start, stop)
+
+    def _put(self, key:str, data:bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path+'.'+str(os.getpid())+'.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def put(self, key:str, data:bytes):
+        """
+        Write an object
+        """
+        await self._call(self._put, key, data)
+
+    def _list(self, prefix:str)->list:
+        keys = []
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                key = os.path.relpath(os.path.join(root, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.tmp'):
+                    keys.append(key)
+        return sorted(keys)
+
+    async def list(self, prefix:str = '')->list:
+        """
+        Sorted keys of the objects starting with prefix
+        """
+        return await self._call(self._list, prefix)
+
+
+class S3Store(LocalStore):
+    """
+    Objects of an S3 (or S3 compatible) bucket, through boto3 calls run in a thread pool
+
+    INPUTS:
+    bucket: bucket name, e.g. forecast-model-datasets
+    prefix: key prefix of the datasets in the bucket
+    client: boto3 S3 client (defaults to boto3.client('s3'), e.g. pass one with an endpoint_url for other S3 compatible
+            stores). Its connection pool (10 by default) should be at least max_workers
+    max_workers: threads serving requests
+    """
+
+    def __init__(self, bucket:str, prefix:str = '', client = None, max_workers:int = 8):
+        if client is None:
+            if boto3 is None:
+                raise ImportError('S3Store needs boto3 (pip install boto3)')
+            client = boto3.client('s3')
+        super().__init__(None, max_workers)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')+'/' if prefix.strip('/') != '' else ''
+        self.client = client
+
+    def _error_code(self, error)->str:
+        response = getattr(error, 'response', None) or {}
+        return response.get('Error', {}).get('Code')
+
+    def _missing(self, error)->bool:
+        return self._error_code(error) in ('404', 'NoSuchKey', 'NotFound')
+
+    def _size(self, key:str)->int:
+        try:
+            return int(self.client.head_object(Bucket=self.bucket, Key=self.prefix+key)['ContentLength'])
+        except Exception as e:
+            if self._missing(e):
+                raise FileNotFoundError('No object '+key) from e
+            raise
+
+    def _get(self, key:str, start:int, stop:int)->bytes:
+        kwargs = {}
+        if start is not None or stop is not None:
+            if stop is not None and stop <= (start or 0):
+                return b''
+            kwargs['Range'] = 'bytes='+str(start or 0)+'-'+('' if stop is None else str(stop - 1))
+        try:
+            data = self.client.get_object(Bucket=self.bucket, Key=self.prefix+key, **kwargs)['Body'].read()
+        except Exception as e:
+            # a range starting past the end, e.g. of an empty object
+            if self._error_code(e) == 'InvalidRange':
+                return b''
+            if self._missing(e):
+                raise FileNotFoundError('No object '+key) from e
+            raise
+        return self._count(data)
+
+    def _put(self, key:str, data:bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix+key, Body=data)
+
+    def _list(self, prefix:str)->list:
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix+prefix):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return sorted(keys)
+
+
+
+class DatasetCache:
+    """
+    Local cache of the datasets of a store, fetched asynchronously
+
+    INPUTS:
+    store: LocalStore or S3Store holding <name>.pickle files (with optional <name>.pickle.sha256 checksums) and
+           dataset_storage directories <name>/manifest.json, <name>/<shards>
+    cache_dir: cache directory (created if missing), e.g. ./data_s3/cache. Cached datasets keep the store layout, so a
+               cached dataset directory can be read with dataset_storage.load_dataset
+    max_bytes: size budget of the directory, enforced after every fetch
+    concurrency: maximum number of requests in flight
+    part_size: files larger than this are downloaded as concurrent byte ranges of this size
+    """
+
+    def __init__(self, store, cache_dir:str, max_bytes:int = 2**34, concurrency:int = 8, part_size:int = 2**23):
+        self.store = store
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.concurrency = max(1, int(concurrency))
+        self.part_size = max(1, int(part_size))
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key:str)->str:
+        return os.path.join(self.cache_dir, *key.split('/'))
+
+    async def _download(self, key:str, sha256:str, semaphore:asyncio.Semaphore)->str:
+        """
+        Download an object into the cache and move it in place only when it matches the sha256 checksum (None to skip
+        the check). Returns the cached path. The first part_size bytes are requested first, larger objects are then
+        completed with concurrent byte ranges
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path)+'.', suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async def part(start:int):
+                    async with semaphore:
+                        data = await self.store.get(key, start, min(start + self.part_size, size))
+                    # no await between the seek and the write, so parts cannot interleave
+                    f.seek(start)
+                    f.write(data)
+                async with semaphore:
+                    data = await self.store.get(key, 0, self.part_size)
+                f.write(data)
+                if len(data) == self.part_size:
+                    async with semaphore:
+                        size = await self.store.size(key)
+                    await asyncio.gather(*[part(start) for start in range(self.part_size, size, self.part_size)])
+            if sha256 is not None and _sha256(tmp_path) != sha256:
+                raise ValueError('Checksum mismatch for '+key+', the download is corrupt or the object changed')
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def _cached(self, key:str, sha256:str = None, verify:bool = False)->bool:
+        """
+        Is the object in the cache (checking its checksum again when verify), marking it as recently used
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return False
+        if verify and sha256 is not None and _sha256(path) != sha256:
+            os.remove(path)
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def _get_text(self, key:str, semaphore:asyncio.Semaphore)->str:
+        async with semaphore:
+            return (await self.store.get(key)).decode()
+
+    async def _manifest(self, name:str, semaphore:asyncio.Semaphore, refresh:bool = False)->dict:
+        """
+        Manifest of a dataset directory, from the cache or the store (None when the store has no such dataset). A
+        refreshed manifest whose checksums differ from the cached one drops the cached shards that changed
+        """
+        key = name+'/'+MANIFEST
+        if not refresh and self._cached(key):
+            return read_manifest(self._path(name))
+        try:
+            manifest = json.loads(await self._get_text(key, semaphore))
+        except FileNotFoundError:
+            return None
+        if manifest.get('format') != 'npy-shards' or manifest.get('format_version', 0) > FORMAT_VERSION:
+            raise ValueError(name+' is not a supported dataset (format '+str(manifest.get('format'))+')')
+        if os.path.isfile(self._path(key)):
+            old = read_manifest(self._path(name))['checksums']
+            for shard, checksum in old.items():
+                if manifest['checksums'].get(shard) != checksum and os.path.exists(self._path(name+'/'+shard)):
+                    os.remove(self._path(name+'/'+shard))
+        os.makedirs(self._path(name), exist_ok=True)
+        tmp_path = self._path(key)+'.'+str(os.getpid())+'.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self._path(key))
+        return manifest
+
+    def _shards(self, manifest:dict, columns:list = None, rows = None)->list:
+        """
+        Shard files holding the selected columns and rows (and the index) of a dataset
+        """
+        stored = manifest['columns']
+        if columns is None:
+            columns = stored
+        missing = [col for col in columns if col not in stored]
+        if len(missing) > 0:
+            raise KeyError('Columns not in dataset: '+str(missing))
+        start, stop = _row_range(rows, manifest['n_rows'])
+        chunk_rows = manifest['chunk_rows']
+        chunks = range(start//chunk_rows, max(start, stop - 1)//chunk_rows + 1)
+        positions = ([-1] if manifest['index']['kind'] != 'range' else []) + [stored.index(col) for col in columns]
+        return [_shard_file(j, k, manifest['compressed']) for j in positions for k in chunks]
+
+    async def _fetch(self, name:str, semaphore:asyncio.Semaphore, columns:list = None, rows = None, verify:bool = False,
+                     refresh:bool = False)->str:
+        """
+        Cached path of a dataset, downloading the missing files
+        """
+        with profiling.stage('fetch', name):
+            if not refresh and columns is None and rows is None and os.path.isfile(self._path(name+PICKLE)):
+                checksum = None
+                if verify and os.path.isfile(self._path(name+PICKLE+CHECKSUM)):
+                    with open(self._path(name+PICKLE+CHECKSUM)) as f:
+                        checksum = f.read().split()[0]
+                if self._cached(name+PICKLE, checksum, verify):
+                    return self._path(name+PICKLE)
+
+            manifest = await self._manifest(name, semaphore, refresh)
+            if manifest is not None:
+                shards = self._shards(manifest, columns, rows)
+                missing = [shard for shard in shards if not self._cached(name+'/'+shard, manifest['checksums'].get(shard), verify)]
+                await asyncio.gather(*[self._download(name+'/'+shard, manifest['checksums'].get(shard), semaphore) for shard in missing])
+                return self._path(name)
+
+            if columns is not None or rows is not None:
+                raise ValueError(name+' is a pickle, columns and rows can only be selected from dataset directories')
+            try:
+                checksum = (await self._get_text(name+PICKLE+CHECKSUM, semaphore)).split()[0]
+            except FileNotFoundError:
+                checksum = None
+            try:
+                path = await self._download(name+PICKLE, checksum, semaphore)
+            except FileNotFoundError:
+                raise FileNotFoundError('No dataset '+name+' in the store') from None
+            if checksum is not None:
+                with open(self._path(name+PICKLE+CHECKSUM), 'w') as f:
+                    f.write(checksum+'\n')
+            return path
+
+    async def fetch_async(self, name:str, columns:list = None, rows = None, verify:bool = False, refresh:bool = False)->str:
+        """
+        Local path of a dataset, downloading what is not cached yet
+
+        INPUTS:
+        name: dataset name, e.g. OVForecast_20220606_1 (a dataset directory <name>/ or a pickle <name>.pickle in the store)
+        columns, rows: as in dataset_storage.load_dataset, to fetch only the shards these cover (dataset directories only)
+        verify: check the checksums of cached files again (they are always checked on download)
+        refresh: read the dataset manifest from the store again (datasets are immutable unless saved with overwrite=True)
+
+        OUTPUT:
+        path: cached dataset directory or pickle file
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        path = await self._fetch(name, semaphore, columns, rows, verify, refresh)
+        self.evict(keep=[path])
+        return path
+
+    async def fetch_many_async(self, names:list, columns:list = None, rows = None, verify:bool = False, refresh:bool = False)->list:
+        """
+        Local paths of several datasets, fetched concurrently (arguments as in fetch_async)
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        paths = await asyncio.gather(*[self._fetch(name, semaphore, columns, rows, verify, refresh) for name in names])
+        self.evict(keep=paths)
+        return list(paths)
+
+    def fetch(self, name:str, columns:list = None, rows = None, verify:bool = False, refresh:bool = False)->str:
+        """
+        Synchronous fetch_async
+        """
+        return _run(self.fetch_async(name, columns, rows, verify, refresh))
+
+    def fetch_many(self, names:list, columns:list = None, rows = None, verify:bool = False, refresh:bool = False)->list:
+        """
+        Synchronous fetch_many_async
+        """
+        return _run(self.fetch_many_async(names, columns, rows, verify, refresh))
+
+    def load(self, name:str, columns:list = None, rows = None, mmap:bool = False, verify:bool = False)->pd.DataFrame:
+        """
+        DataFrame of a dataset, fetched through the cache
+
+        INPUTS:
+        name: dataset name
+        columns, rows, mmap: as in dataset_storage.load_dataset (dataset directories only)
+        verify: as in fetch_async
+        """
+        path = self.fetch(name, columns, rows, verify)
+        if os.path.isdir(path):
+            return load_dataset(path, columns=columns, rows=rows, mmap=mmap)
+        return pd.read_pickle(path, compression=None)
+
+    async def datasets_async(self, model_name:str = None)->list:
+        """
+        (model_name, date_stamp, version) of the datasets in the store, optionally of one model, sorted
+        """
+        keys = await self.store.list('' if model_name is None else model_name+'_')
+        names = set()
+        for key in keys:
+            if key.endswith('/'+MANIFEST) and key.count('/') == 1:
+                names.add(key[:-len(MANIFEST)-1])
+            elif key.endswith(PICKLE) and '/' not in key:
+                names.add(key[:-len(PICKLE)])
+        parsed = [parse_dataset_name(name) for name in names]
+        return sorted(p for p in parsed if p is not None and (model_name is None or p[0] == model_name))
+
+    def latest(self, model_name:str, date_stamp:str = None)->str:
+        """
+        Name of the latest version of a model's dataset in the store (of the latest date, or of date_stamp)
+        """
+        datasets = [d for d in _run(self.datasets_async(model_name)) if date_stamp is None or d[1] == str(date_stamp)]
+        if len(datasets) == 0:
+            raise FileNotFoundError('No datasets of '+model_name+('' if date_stamp is None else ' dated '+str(date_stamp))+' in the store')
+        model_name, date_stamp, version = datasets[-1]
+        return model_name+'_'+date_stamp+'_'+str(version)
+
+    async def _read_shard_rows(self, key:str, lo:int, hi:int, semaphore:asyncio.Semaphore)->np.ndarray:
+        """
+        Rows lo:hi of an .npy shard with ranged requests: the header, then only the bytes of the rows
+        """
+        async with semaphore:
+            head = await self.store.get(key, 0, 1024)
+        f = io.BytesIO(head)
+        major, _ = np.lib.format.read_magic(f)
+        header_bytes = f.tell() + (2 if major == 1 else 4) + int.from_bytes(head[8:10] if major == 1 else head[8:12], 'little')
+        if header_bytes > len(head):
+            async with semaphore:
+                head = await self.store.get(key, 0, header_bytes)
+            f = io.BytesIO(head)
+            np.lib.format.read_magic(f)
+        shape, fortran_order, dtype = (np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0)(f)
+        if dtype.hasobject or len(shape) != 1:
+            raise ValueError(key+' is not a 1d array of plain values')
+        hi = min(hi, shape[0])
+        if hi <= lo:
+            return np.empty(0, dtype=dtype)
+        async with semaphore:
+            data = await self.store.get(key, header_bytes + lo*dtype.itemsize, header_bytes + hi*dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype)
+
+    async def _cached_rows(self, key:str, lo:int, hi:int)->np.ndarray:
+        return np.load(self._path(key), mmap_mode='r')[lo:hi]
+
+    async def read_rows_async(self, name:str, column, rows = None)->np.ndarray:
+        """
+        Rows of one column of an uncompressed dataset directory, read from the cached shards or straight from the
+        store with ranged requests (which are not cached, and cannot be checked against the shard checksums)
+
+        INPUTS:
+        name: dataset name
+        column: column name, or None for the index values (UTC datetime64 values for a timezone aware index)
+        rows: None (all), (start, stop) or slice of row positions
+
+        OUTPUT:
+        values: numpy array
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        manifest = await self._manifest(name, semaphore)
+        if manifest is None:
+            raise FileNotFoundError('No dataset directory '+name+' in the store')
+        if manifest['compressed']:
+            raise ValueError('Rows can only be read from uncompressed datasets, fetch compressed ones instead')
+        if column is None:
+            if manifest['index']['kind'] == 'range':
+                raise ValueError(name+' has a range index, it is not stored')
+            j = -1
+        elif column in manifest['columns']:
+            j = manifest['columns'].index(column)
+        else:
+            raise KeyError('Column not in dataset: '+str(column))
+        start, stop = _row_range(rows, manifest['n_rows'])
+        chunk_rows = manifest['chunk_rows']
+        parts = []
+        for k in range(start//chunk_rows, max(start, stop - 1)//chunk_rows + 1):
+            key = name+'/'+_shard_file(j, k, False)
+            lo, hi = max(start - k*chunk_rows, 0), min(stop - k*chunk_rows, chunk_rows)
+            if self._cached(key):
+                parts.append(self._cached_rows(key, lo, hi))
+            else:
+                parts.append(self._read_shard_rows(key, lo, hi, semaphore))
+        values = np.concatenate(await asyncio.gather(*parts)) if len(parts) > 0 else np.empty(0)
+        dtype = manifest['index']['dtype'] if j < 0 else manifest['dtypes'][j]
+        return values.astype(object) if dtype == 'object' else values
+
+    def read_rows(self, name:str, column, rows = None)->np.ndarray:
+        """
+        Synchronous read_rows_async
+        """
+        return _run(self.read_rows_async(name, column, rows))
+
+    async def push_async(self, path:str):
+        """
+        Upload a local dataset directory or pickle (named with the ModelName_DateStamp_Version convention) to the store.
+        A dataset's manifest is written last, so readers never see a partial dataset, and a pickle gets a .sha256 checksum
+        """
+        name = os.path.basename(path.rstrip('/'))
+        if name.endswith(PICKLE):
+            name = name[:-len(PICKLE)]
+        if parse_dataset_name(name) is None:
+            raise ValueError(name+' does not follow the ModelName_DateStamp_Version convention')
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def put(key, file):
+            with open(file, 'rb') as f:
+                data = f.read()
+            async with semaphore:
+                await self.store.put(key, data)
+
+        if os.path.isdir(path):
+            manifest = read_manifest(path)
+            await asyncio.gather(*[put(name+'/'+shard, os.path.join(path, shard)) for shard in manifest['checksums']])
+            await put(name+'/'+MANIFEST, os.path.join(path, MANIFEST))
+        else:
+            await put(name+PICKLE, path)
+            async with semaphore:
+                await self.store.put(name+PICKLE+CHECKSUM, (_sha256(path)+'  '+name+PICKLE+'\n').encode())
+
+    def push(self, path:str):
+        """
+        Synchronous push_async
+        """
+        _run(self.push_async(path))
+
+    def entries(self)->list:
+        """
+        (modification time, size, path) of every cached file
+        """
+        out = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.tmp'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    out.append((stat.st_mtime, stat.st_size, path))
+        return out
+
+    def size(self)->int:
+        """
+        Total size of the cached files in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes:int = None, keep:list = [])->int:
+        """
+        Delete least recently used files until the cache fits in max_bytes (defaults to self.max_bytes)
+
+        INPUTS:
+        max_bytes: size budget
+        keep: cached paths (files or dataset directories) not to delete, e.g. the ones just fetched
+
+        OUTPUT:
+        number of files deleted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else int(max_bytes)
+        keep = [os.path.abspath(path) for path in keep]
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        n_deleted = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            full = os.path.abspath(path)
+            if any(full == k or full.startswith(k+os.sep) for k in keep):
+                continue
+            try:
+                os.remove(path)
+                n_deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return n_deleted
+
+    def clear(self)->int:
+        """
+        Delete every cached file
+        """
+        return self.evict(0)
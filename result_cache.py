@@ -0,0 +1,186 @@
+"""
+Content-addressed on-disk cache for per-feature results (change points, rendered report pages).
+
+Entries are keyed by a sha256 digest of everything the result depends on: the feature values, the index, the
+feature name and the parameters. A rerun over features whose history has not changed (static features, reruns after
+a failed report) reads the stored result instead of recomputing it. The cache directory is bounded by max_bytes and
+evicted least recently used first, recency being the file modification time (refreshed on every hit). Keys also
+include a fingerprint of the source of the modules computing the cached results, so entries made by older code are
+never read back.
+
+Entries are pickles, so only point a cache at a directory you trust.
+"""
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# bump to invalidate existing entries when something outside FINGERPRINT_MODULES changes the cached results
+CACHE_VERSION = 1
+# modules (next to this one) whose source is part of every key
+FINGERPRINT_MODULES = ['model_monitoring.py', 'change_point_table.py', 'feature_segmentation.py', 'feature_pool.py', 'screening.py',
+                       'multi_resolution.py', 'penalty_sweep.py', 'grouped_monitoring.py', 'vlm_report.py', 'segmentation.py',
+                       'quantile_sketch.py']
+# default of get_or_compute's lookup, so that a cached None is a hit
+_MISSING = object()
+
+
+def code_fingerprint(modules:list = FINGERPRINT_MODULES)->str:
+    """
+    Digest of the source files of modules (found next to this module, missing ones are skipped)
+    """
+    h = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in modules:
+        try:
+            with open(os.path.join(directory, name), 'rb') as f:
+                source = f.read()
+        except FileNotFoundError:
+            continue
+        h.update(name.encode()+b':'+str(len(source)).encode()+b':')
+        h.update(source)
+    return h.hexdigest()
+
+
+def _part_bytes(part)->bytes:
+    """
+    Bytes identifying a key part. Pickles of containers depend on object identity (shared references are memoised),
+    which is not preserved when a task is sent to a worker process, so arrays and frames are serialised element wise
+    """
+    if isinstance(part, (pd.Index, pd.Series)):
+        part = np.asarray(part)
+    if isinstance(part, pd.DataFrame):
+        return pickle.dumps(list(part.columns), protocol=4)+b''.join(_part_bytes(part.iloc[:, j].values) for j in range(part.shape[1]))
+    if isinstance(part, np.ndarray) and part.dtype.kind in 'biufcmM':
+        return str(part.dtype).encode()+str(part.shape).encode()+np.ascontiguousarray(part).tobytes()
+    if isinstance(part, np.ndarray):
+        try:
+            return str(part.shape).encode()+pd.util.hash_array(part.ravel()).tobytes()
+        except TypeError:
+            # unhashable cells, e.g. arrays of percentile levels
+            return str(part.shape).encode()+b''.join(_part_bytes(item) for item in part.ravel())
+    if isinstance(part, bytes):
+        return part
+    return pickle.dumps(part, protocol=4)
+
+
+class ResultCache:
+    """
+    On-disk LRU cache of picklable results
+
+    INPUTS:
+    cache_dir: cache directory (created if missing), e.g. ./data_s3/cache
+    max_bytes: size budget of the directory, enforced by evict()
+    fingerprint: code fingerprint included in every key, code_fingerprint() by default
+    """
+
+    def __init__(self, cache_dir:str, max_bytes:int = 2**30, fingerprint:str = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.fingerprint = code_fingerprint() if fingerprint is None else fingerprint
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, *parts)->str:
+        """
+        Digest of the parts a result depends on and of the code computing it. numpy arrays, indexes and DataFrames are
+        hashed by value (column by column), anything else by its pickle
+        """
+        h = hashlib.sha256(str(CACHE_VERSION).encode()+b':'+self.fingerprint.encode())
+        for part in parts:
+            data = _part_bytes(part)
+            h.update(str(len(data)).encode()+b':')
+            h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key:str)->str:
+        return os.path.join(self.cache_dir, key[:2], key+'.pickle')
+
+    def get(self, key:str, default = None):
+        """
+        Cached result for key (default when missing), marking it as recently used
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key:str, value):
+        """
+        Store a result. The file is written under a temporary name and renamed, so concurrent workers never read a
+        partial entry
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path+'.'+str(os.getpid())+'.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=4)
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, key:str, func, *args, **kwargs):
+        """
+        Cached result for key, else func(*args, **kwargs) stored under key (a cached None is returned as well)
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = func(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def entries(self)->list:
+        """
+        (modification time, size, path) of every entry
+        """
+        out = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.pickle'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    out.append((stat.st_mtime, stat.st_size, path))
+        return out
+
+    def size(self)->int:
+        """
+        Total size of the cache entries in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes:int = None)->int:
+        """
+        Delete least recently used entries until the cache fits in max_bytes (defaults to self.max_bytes)
+
+        OUTPUT:
+        number of entries deleted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else int(max_bytes)
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        n_deleted = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                n_deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return n_deleted
+
+    def clear(self)->int:
+        """
+        Delete every entry
+        """
+        return self.evict(0)
@@ -0,0 +1,33 @@
+"""
+Screening pass of the tiered change point detection.
+
+Most features never change, yet each pays the full segmentation cost. With calculate_change_points(df, screen_penalty=10)
+each chunk of features is first tested at once for a single mean / variance change (segmentation.split_gain, a
+likelihood ratio CUSUM test). Only the flagged features are segmented, the rest are reported as one whole-series segment.
+"""
+import numpy as np
+import segmentation
+import profiling
+from feature_segmentation import _clean_feature
+
+
+
+def _screen_features(Y:np.ndarray, screen_penalty:float)->np.ndarray:
+    """
+    Vectorized screening pass of the tiered detection: which columns may hold a change point
+    
+    INPUTS:
+    Y: 2d numpy array (n_history x n_features) of feature values
+    screen_penalty: minimum single split gain (segmentation.split_gain, normal cost) of a flagged feature
+    
+    OUTPUT:
+    boolean numpy array, True for the features to segment. Features still holding NaN after cleaning (no valid value
+    at all) are always flagged
+    """
+    with profiling.stage('screen'):
+        Y = _clean_feature(Y)
+        flagged = ~np.isfinite(Y).all(axis=0)
+        valid = ~flagged
+        if valid.any():
+            flagged[valid] = segmentation.split_gain(Y[:, valid]) > screen_penalty
+    return flagged
@@ -0,0 +1,597 @@
+"""
+Fast change point segmentation backends for calculate_change_points.
+
+The ruptures rbf kernel builds an O(n^2) gram matrix per feature. The classes here follow the same
+fit(signal).predict(pen) interface as ruptures but use parametric costs evaluated from cumulative sums,
+so every segment cost is O(1) and all candidate costs for a given end point are evaluated as one
+numpy expression. Signals are standardised by a robust noise scale before fitting and costs are gaussian
+negative log likelihoods, so the penalties used with the rbf model (around 10) give comparable segmentations.
+
+Cost models:
+l2: squared deviation from the segment mean, i.e. gaussian with fixed unit variance (level changes)
+normal: gaussian with segment mean and variance (level and volatility changes)
+"""
+import numpy as np
+
+
+COST_MODELS = ['l2', 'normal']
+# mean segment length above which segment_percentiles partitions each segment instead of sorting the whole signal
+SORTED_BLOCK_MAX_LENGTH = 256
+
+
+
+def robust_scale(signal:np.ndarray)->float:
+    """
+    Robust estimate of the noise standard deviation of a signal from the median absolute first difference.
+    Level shifts and trends barely affect the estimate, unlike the plain standard deviation.
+
+    INPUTS:
+    signal: 1d numpy array
+
+    OUTPUT:
+    scale: float, 1.0 if the signal is (almost) constant
+    """
+    signal = np.asarray(signal, dtype=float)
+    if len(signal) < 3:
+        return 1.0
+    diffs = np.abs(np.diff(signal))
+    scale = np.median(diffs)/(0.6745*np.sqrt(2))
+    if not scale > 0:
+        scale = np.std(signal)
+    if not scale > 0:
+        scale = 1.0
+    return float(scale)
+
+
+
+def rolling_std(signal:np.ndarray, window:int)->np.ndarray:
+    """
+    Rolling standard deviation (ddof=1, as pandas rolling().std()) from cumulative sums, O(1) per step
+
+    INPUTS:
+    signal: 1d numpy array
+    window: window length
+
+    OUTPUT:
+    rsd: numpy array of length len(signal)-window+1, rsd[j] is the standard deviation of signal[j:j+window]
+    """
+    signal = np.asarray(signal, dtype=float)
+    window = int(window)
+    if window < 2 or len(signal) < window:
+        return np.zeros(max(0, len(signal) - window + 1))
+    # centre first to limit cancellation in the sum of squares
+    centred = signal - np.mean(signal)
+    s1 = np.concatenate([[0.0], np.cumsum(centred)])
+    s2 = np.concatenate([[0.0], np.cumsum(centred**2)])
+    sum1 = s1[window:] - s1[:-window]
+    sum2 = s2[window:] - s2[:-window]
+    var = (sum2 - sum1**2/window)/(window - 1)
+    return np.sqrt(np.maximum(var, 0.0))
+
+
+def segment_percentiles(signal:np.ndarray, bkps:list, percentiles:list = [25,50,75])->np.ndarray:
+    """
+    Percentiles of every segment of a signal, equal to np.percentile (linear method) on each segment
+    
+    With many short segments the signal is sorted once by (segment, value), every segment is then a sorted block and
+    all percentiles of all segments are read off with one vectorized gather and interpolation, instead of one
+    np.percentile call per segment. Segments longer than SORTED_BLOCK_MAX_LENGTH on average are cheaper with the
+    per-segment partition of np.percentile, which is O(n) rather than O(n log n).
+    
+    INPUTS:
+    signal: 1d numpy array
+    bkps: segment ends (ruptures convention, the last one len(signal))
+    percentiles: percentiles to compute
+    
+    OUTPUT:
+    values: 2d numpy array (n_segments x n_percentiles), all NaN for segments holding a NaN (as np.percentile)
+    """
+    signal = np.asarray(signal, dtype=float)
+    ends = np.asarray(bkps, dtype=int)
+    starts = np.concatenate([[0], ends[:-1]])
+    lengths = ends - starts
+    if len(ends) == 0:
+        return np.zeros((0, len(percentiles)))
+    if ends[-1] > SORTED_BLOCK_MAX_LENGTH*len(ends):
+        return np.array([np.percentile(signal[lo:hi], percentiles) for lo, hi in zip(starts, ends)]).reshape(len(ends), len(percentiles))
+    seg = np.repeat(np.arange(len(ends)), lengths)
+    signal = signal[:len(seg)]
+    # NaN sorts to the end of its block
+    blocks = signal[np.lexsort((signal, seg))]
+    
+    # numpy's linear method: virtual index (n-1)q, interpolated between its floor and the next value
+    q = np.true_divide(np.asarray(percentiles), 100)
+    virtual = (lengths[:, None] - 1)*q[None, :]
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous = np.minimum(previous.astype(int), lengths[:, None] - 1)
+    following = np.minimum(previous + 1, lengths[:, None] - 1)
+    a = blocks[starts[:, None] + previous]
+    b = blocks[starts[:, None] + following]
+    diff_b_a = b - a
+    values = np.where(gamma >= 0.5, b - diff_b_a*(1 - gamma), a + diff_b_a*gamma)
+    values[np.bincount(seg, weights=np.isnan(signal), minlength=len(ends)) > 0] = np.nan
+    return values
+
+
+
+def split_gain(Y:np.ndarray, model:str = 'normal', min_size:int = 2, min_var:float = 0.1)->np.ndarray:
+    """
+    Screening statistic for many signals at once: the largest cost reduction from splitting each column of Y in two
+    (a likelihood ratio CUSUM test for a single change in mean, and with the normal model variance). Columns are
+    standardised by their robust scale as in the search methods, and every split point of every column is evaluated
+    in one numpy expression, O(n) per column.
+
+    A column whose gain is below a penalty has no single split worth that penalty, so PELT with the same cost and
+    penalty would usually keep it as one segment.
+
+    INPUTS:
+    Y: 2d numpy array (n_history x n_signals) of finite values
+    model: 'l2' or 'normal', as in CumSumCost
+    min_size: minimum segment length
+    min_var: variance floor of the normal model
+
+    OUTPUT:
+    gain: numpy array of the best split gain of each column (0 for columns too short to split)
+    """
+    if model not in COST_MODELS:
+        raise ValueError('Unknown cost model '+str(model)+', expected one of '+str(COST_MODELS))
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    n, m = Y.shape
+    min_size = max(1, int(min_size))
+    if n < 2*min_size or m == 0:
+        return np.zeros(m)
+    # robust_scale of every column
+    scale = np.median(np.abs(np.diff(Y, axis=0)), axis=0)/(0.6745*np.sqrt(2)) if n >= 3 else np.ones(m)
+    scale = np.where(scale > 0, scale, np.std(Y, axis=0))
+    scale = np.where(scale > 0, scale, 1.0)
+    Z = (Y - np.median(Y, axis=0))/scale
+    s1 = np.concatenate([np.zeros((1, m)), np.cumsum(Z, axis=0)])
+    s2 = np.concatenate([np.zeros((1, m)), np.cumsum(Z**2, axis=0)])
+
+    def cost(sum1, sum2, length):
+        if model == 'l2':
+            return 0.5*np.maximum(sum2 - sum1**2/length, 0.0)
+        return 0.5*length*np.log(np.maximum(sum2/length - (sum1/length)**2, min_var))
+
+    t = np.arange(min_size, n - min_size + 1)[:, None]
+    split = cost(s1[t[:, 0]], s2[t[:, 0]], t) + cost(s1[n] - s1[t[:, 0]], s2[n] - s2[t[:, 0]], n - t)
+    return np.maximum(cost(s1[n], s2[n], n) - split.min(axis=0), 0.0)
+
+
+
+class CumSumCost:
+    """
+    Segment costs from cumulative sums of the (standardised) signal
+
+    INPUTS:
+    model: 'l2' or 'normal'
+    min_var: variance floor for the normal model (in units of the standardised signal). Stops constant segments
+             (e.g. dead periods of zeros) from having an infinitely negative cost
+    """
+
+    def __init__(self, model:str = 'normal', min_var:float = 0.1):
+        if model not in COST_MODELS:
+            raise ValueError('Unknown cost model '+str(model)+', expected one of '+str(COST_MODELS))
+        self.model = model
+        self.min_var = min_var
+        self.s1 = None
+        self.s2 = None
+
+    def fit(self, signal:np.ndarray):
+        """
+        Precompute the cumulative sums
+
+        INPUTS:
+        signal: 1d numpy array (already standardised)
+        """
+        signal = np.asarray(signal, dtype=float)
+        self.s1 = np.concatenate([[0.0], np.cumsum(signal)])
+        self.s2 = np.concatenate([[0.0], np.cumsum(signal**2)])
+        return self
+
+    def error(self, start, end):
+        """
+        Cost of the segments signal[start:end]. start and end broadcast, so all candidate starts for an end point
+        (or all split points of a segment) are evaluated in one call.
+        """
+        start = np.asarray(start)
+        end = np.asarray(end)
+        n = end - start
+        sum1 = self.s1[end] - self.s1[start]
+        sum2 = self.s2[end] - self.s2[start]
+        if self.model == 'l2':
+            return 0.5*np.maximum(sum2 - sum1**2/n, 0.0)
+        var = np.maximum(sum2/n - (sum1/n)**2, self.min_var)
+        return 0.5*n*np.log(var)
+
+    def sum_of_costs(self, bkps:list)->float:
+        """
+        Total cost of a segmentation given by its breakpoints (ruptures convention, last breakpoint is the signal length)
+        """
+        bounds = np.array([0] + list(bkps))
+        return float(np.sum(self.error(bounds[:-1], bounds[1:])))
+
+
+
+class CostRbf:
+    """
+    Kernel (rbf) segment cost with the same gram matrix as ruptures CostRbf (median heuristic bandwidth), but with a
+    2d cumulative sum (integral image) of the gram matrix so every segment cost is O(1) and vectorises over candidates.
+    Fitting is still O(n^2) in time and memory, so this is for reusing one fit across many penalties
+    (see penalty_sweep_change_points), not for long histories.
+    """
+
+    def __init__(self):
+        self.integral = None
+
+    def fit(self, signal:np.ndarray):
+        """
+        Build the gram matrix and its integral image
+
+        INPUTS:
+        signal: 1d numpy array
+        """
+        signal = np.asarray(signal, dtype=float).reshape(-1, 1)
+        K = (signal - signal.T)**2
+        K_median = np.median(K[np.triu_indices(len(signal), k=1)]) if len(signal) > 1 else 0
+        if K_median != 0:
+            K /= K_median
+        np.clip(K, 1e-2, 1e2, K)
+        gram = np.exp(-K)
+        np.fill_diagonal(gram, 1.0)
+        self.integral = np.zeros((len(signal) + 1, len(signal) + 1))
+        self.integral[1:, 1:] = gram.cumsum(axis=0).cumsum(axis=1)
+        return self
+
+    def error(self, start, end):
+        """
+        Cost of the segments signal[start:end] (broadcasting as CumSumCost.error)
+        """
+        start = np.asarray(start)
+        end = np.asarray(end)
+        I = self.integral
+        block = I[end, end] - I[start, end] - I[end, start] + I[start, start]
+        return (end - start) - block/(end - start)
+
+    def sum_of_costs(self, bkps:list)->float:
+        """
+        Total cost of a segmentation given by its breakpoints (ruptures convention, last breakpoint is the signal length)
+        """
+        bounds = np.array([0] + list(bkps))
+        return float(np.sum(self.error(bounds[:-1], bounds[1:])))
+
+
+
+class _CumSumSearch:
+    """
+    Shared fit logic for the search methods below. scale / center default to the robust scale and median of the
+    fitted signal. model is one of COST_MODELS or 'rbf' (CostRbf)
+    """
+
+    def __init__(self, model:str = 'normal', min_size:int = 2, jump:int = 5, scale:float = None, center:float = None, min_var:float = 0.1):
+        self.cost = CostRbf() if model == 'rbf' else CumSumCost(model=model, min_var=min_var)
+        self.min_size = max(1, int(min_size))
+        self.jump = max(1, int(jump))
+        self.scale = scale
+        self.center = center
+        self.n_samples = None
+
+    def fit(self, signal:np.ndarray):
+        """
+        Standardise the signal and precompute the cost
+
+        INPUTS:
+        signal: 1d numpy array
+        """
+        signal = np.asarray(signal, dtype=float).ravel()
+        self.scale_ = robust_scale(signal) if self.scale is None else float(self.scale)
+        self.center_ = np.median(signal) if self.center is None else float(self.center)
+        self.n_samples = len(signal)
+        self.cost.fit((signal - self.center_)/self.scale_)
+        return self
+
+    def _grid(self)->np.ndarray:
+        """
+        Admissible breakpoint positions: multiples of jump and the signal end
+        """
+        grid = np.arange(0, self.n_samples, self.jump)
+        return np.append(grid, self.n_samples)
+
+
+
+class Pelt(_CumSumSearch):
+    """
+    Pruned Exact Linear Time search with a cumulative sum cost. Same interface as ruptures.Pelt
+    (min_size=2 and jump=5 by default, as in ruptures).
+
+    For each end point the costs of all surviving candidate starts are evaluated in one vectorised call and
+    candidates that can no longer be optimal are pruned. The runtime is close to linear when change points keep pruning
+    the candidates, but on long series without change points most candidates survive and it grows as about n^1.4.
+    """
+
+    def predict(self, pen:float)->list:
+        """
+        Optimal segmentation for a penalty
+
+        INPUTS:
+        pen: penalty per change point
+
+        OUTPUT:
+        bkps: sorted list of breakpoints, the last one being the signal length
+        """
+        grid = self._grid()
+        n_grid = len(grid)
+        F = np.full(n_grid, np.inf)
+        F[0] = -pen
+        last = np.zeros(n_grid, dtype=int)
+        R = np.array([0], dtype=int)
+        for g in range(1, n_grid):
+            t = grid[g]
+            admissible = grid[R] <= t - self.min_size
+            cands = R[admissible]
+            if len(cands) == 0:
+                R = np.append(R, g)
+                continue
+            costs = F[cands] + self.cost.error(grid[cands], t)
+            k = np.argmin(costs)
+            F[g] = costs[k] + pen
+            last[g] = cands[k]
+            # prune candidates whose best continuation is already worse than F[g]
+            R = np.concatenate([R[~admissible], cands[costs <= F[g]], [g]])
+        bkps = []
+        g = n_grid - 1
+        while g > 0:
+            bkps.append(int(grid[g]))
+            g = last[g]
+        return sorted(bkps)
+
+
+
+class Binseg(_CumSumSearch):
+    """
+    Binary segmentation with a cumulative sum cost. Same interface as ruptures.Binseg.
+    The gain of every split point of a segment is evaluated in one vectorised call.
+    """
+
+    def _best_split(self, start:int, end:int):
+        """
+        Best split point of signal[start:end] and its gain, (None, 0) if the segment cannot be split
+        """
+        splits = np.arange(start + self.min_size, end - self.min_size + 1)
+        splits = splits[splits % self.jump == 0]
+        if len(splits) == 0:
+            return None, 0.0
+        gains = self.cost.error(start, end) - self.cost.error(start, splits) - self.cost.error(splits, end)
+        k = np.argmax(gains)
+        return int(splits[k]), float(gains[k])
+
+    def predict(self, pen:float)->list:
+        """
+        Binary segmentation for a penalty: keep splitting while the best split reduces the cost by more than pen
+
+        INPUTS:
+        pen: penalty per change point
+
+        OUTPUT:
+        bkps: sorted list of breakpoints, the last one being the signal length
+        """
+        bkps = [self.n_samples]
+        stack = [(0, self.n_samples)]
+        while stack:
+            start, end = stack.pop()
+            split, gain = self._best_split(start, end)
+            if split is not None and gain > pen:
+                bkps.append(split)
+                stack.append((start, split))
+                stack.append((split, end))
+        return sorted(bkps)
+
+
+
+class Window(_CumSumSearch):
+    """
+    Window sliding detection with a cumulative sum cost. Same interface as ruptures.Window.
+    The discrepancy between the two halves of a window centred on every point is computed in one vectorised call,
+    then peaks above the penalty are kept greedily (at least width/2 apart).
+
+    INPUTS:
+    width: window length in samples
+    """
+
+    def __init__(self, width:int = 20, model:str = 'normal', min_size:int = 2, jump:int = 5, scale:float = None, center:float = None, min_var:float = 0.1):
+        super().__init__(model=model, min_size=min_size, jump=jump, scale=scale, center=center, min_var=min_var)
+        self.width = 2*max(self.min_size, int(width)//2)
+
+    def predict(self, pen:float)->list:
+        """
+        Window detection for a penalty
+
+        INPUTS:
+        pen: minimum discrepancy for a change point
+
+        OUTPUT:
+        bkps: sorted list of breakpoints, the last one being the signal length
+        """
+        half = self.width//2
+        centres = np.arange(half, self.n_samples - half + 1)
+        centres = centres[centres % self.jump == 0]
+        bkps = [self.n_samples]
+        if len(centres) == 0:
+            return bkps
+        gains = self.cost.error(centres - half, centres + half) - self.cost.error(centres - half, centres) - self.cost.error(centres, centres + half)
+        taken = np.zeros(self.n_samples + 1, dtype=bool)
+        for k in np.argsort(-gains):
+            if gains[k] <= pen:
+                break
+            c = centres[k]
+            if taken[max(0, c - half):c + half + 1].any():
+                continue
+            taken[c] = True
+            bkps.append(int(c))
+        return sorted(bkps)
+
+
+
+class OnlinePelt:
+    """
+    Incremental PELT for appended data. The optimal cost F(t) of PELT only depends on the signal up to t, so new samples
+    extend the recursion without refitting: the state is the cumulative sums, F and the pruned candidate set R.
+    For the same penalty, scale and center, predict() after any sequence of updates equals Pelt().fit(full signal).predict(pen).
+
+    A change point is confirmed once it lies on the optimal path back from every surviving candidate, after which no
+    future data can move it. Segments before the last confirmed change point are returned by update() and their data is
+    released, so the state only spans the signal since the last confirmed change point.
+
+    On a signal without changes nothing is confirmed and the state grows with the history. max_lookback caps it: once
+    more than max_lookback samples follow the last confirmed change point, the latest change point of the current optimal
+    path that is at least max_lookback/2 samples old is confirmed, or failing that the latest surviving candidate that old
+    (a forced split of a long segment). The state then spans at most about max_lookback samples, and the result equals
+    the batch fit as long as no segment is left unconfirmed for more than max_lookback samples.
+
+    INPUTS:
+    pen: penalty per change point (fixed, pruning depends on it)
+    model, min_size, jump, min_var: as for Pelt
+    scale, center: standardisation of the signal. If None they are estimated from the first update and then frozen
+    max_lookback: maximum number of samples held since the last confirmed change point (None for no cap, exact)
+    """
+
+    def __init__(self, pen:float = 10, model:str = 'normal', min_size:int = 2, jump:int = 5, scale:float = None, center:float = None, min_var:float = 0.1,
+                 max_lookback:int = None):
+        self.pen = float(pen)
+        self.max_lookback = None if max_lookback is None else max(2*int(jump), 2*int(min_size), int(max_lookback))
+        self.cost = CumSumCost(model=model, min_var=min_var)
+        self.min_size = max(1, int(min_size))
+        self.jump = max(1, int(jump))
+        self.scale_ = scale
+        self.center_ = center
+        self.n_samples = 0
+        self.confirmed_ = 0
+        # cumulative sums are held from absolute position base_
+        self.base_ = 0
+        self.cost.s1 = np.zeros(1)
+        self.cost.s2 = np.zeros(1)
+        self.R_ = np.array([0], dtype=int)
+        self.F_R_ = np.array([-self.pen])
+        self.last_ = {0:0}
+
+    def _error(self, start, end):
+        return self.cost.error(np.asarray(start) - self.base_, np.asarray(end) - self.base_)
+
+    def _step(self, t:int):
+        """
+        PELT recursion at grid position t (same candidate order and pruning as Pelt.predict)
+        """
+        admissible = self.R_ <= t - self.min_size
+        cands = self.R_[admissible]
+        if len(cands) == 0:
+            F_t = np.inf
+            self.last_[t] = 0
+            keep_R, keep_F = cands, self.F_R_[admissible]
+        else:
+            costs = self.F_R_[admissible] + self._error(cands, t)
+            k = np.argmin(costs)
+            F_t = costs[k] + self.pen
+            self.last_[t] = int(cands[k])
+            keep = costs <= F_t
+            keep_R, keep_F = cands[keep], self.F_R_[admissible][keep]
+        self.R_ = np.concatenate([self.R_[~admissible], keep_R, [t]])
+        self.F_R_ = np.concatenate([self.F_R_[~admissible], keep_F, [F_t]])
+
+    def _chain(self, t:int)->list:
+        """
+        Optimal change points back from t (t, last[t], ...) down to the confirmed change point
+        """
+        chain = [t]
+        while t > self.confirmed_:
+            t = self.last_[t]
+            chain.append(t)
+        return chain
+
+    def update(self, signal:np.ndarray)->list:
+        """
+        Append samples and advance the recursion
+
+        INPUTS:
+        signal: 1d numpy array of new samples
+
+        OUTPUT:
+        newly confirmed change points (absolute positions, ascending)
+        """
+        signal = np.asarray(signal, dtype=float).ravel()
+        if len(signal) == 0:
+            return []
+        if self.scale_ is None:
+            self.scale_ = robust_scale(signal)
+        if self.center_ is None:
+            self.center_ = float(np.median(signal))
+        z = (signal - self.center_)/self.scale_
+        self.cost.s1 = np.concatenate([self.cost.s1, self.cost.s1[-1] + np.cumsum(z)])
+        self.cost.s2 = np.concatenate([self.cost.s2, self.cost.s2[-1] + np.cumsum(z**2)])
+        n_old = self.n_samples
+        self.n_samples += len(signal)
+        for t in range((n_old//self.jump + 1)*self.jump, self.n_samples + 1, self.jump):
+            self._step(t)
+
+        # the latest change point shared by the optimal paths of all live candidates is final
+        live = self.R_[np.isfinite(self.F_R_)]
+        common = None
+        for t in live:
+            chain = set(self._chain(int(t)))
+            common = chain if common is None else common & chain
+        common = [c for c in (common or []) if c < self.n_samples]
+        confirmed = max(common) if len(common) > 0 else self.confirmed_
+        forced = self.max_lookback is not None and self.n_samples - confirmed > self.max_lookback
+        if forced:
+            confirmed = self._forced_confirmation()
+        if confirmed <= self.confirmed_:
+            return []
+        new = sorted(c for c in self._chain(confirmed) if c > self.confirmed_)
+        self.confirmed_ = confirmed
+        if forced:
+            # only candidates whose optimal path runs through the forced change point stay
+            keep = np.array([self._chain(int(t))[-1] == confirmed for t in self.R_], dtype=bool)
+            self.R_, self.F_R_ = self.R_[keep], self.F_R_[keep]
+
+        # release state before the confirmed change point
+        self.last_ = {t:p for t, p in self.last_.items() if t >= confirmed}
+        base = int(min(self.R_.min(), confirmed))
+        self.cost.s1 = self.cost.s1[base - self.base_:]
+        self.cost.s2 = self.cost.s2[base - self.base_:]
+        self.base_ = base
+        return new
+
+    def _forced_confirmation(self)->int:
+        """
+        Change point confirmed when the state exceeds max_lookback: the latest one on the current optimal path, or the
+        latest surviving candidate, at least max_lookback/2 samples before the end
+        """
+        horizon = self.n_samples - self.max_lookback//2
+        path = [c for c in self.predict()[:-1] if c <= horizon]
+        if len(path) > 0:
+            return path[-1]
+        cands = self.R_[(self.R_ <= horizon) & np.isfinite(self.F_R_)]
+        return int(cands.max()) if len(cands) > 0 else self.confirmed_
+
+    def predict(self)->list:
+        """
+        Current optimal change points after the last confirmed one
+
+        OUTPUT:
+        bkps: sorted list of change points (absolute positions), the last one being the number of samples seen
+        """
+        n = self.n_samples
+        if n <= self.confirmed_:
+            return [n]
+        if n % self.jump == 0:
+            chain = self._chain(n)
+        else:
+            admissible = self.R_ <= n - self.min_size
+            cands = self.R_[admissible]
+            if len(cands) == 0:
+                return [n]
+            costs = self.F_R_[admissible] + self._error(cands, n)
+            chain = [n] + self._chain(int(cands[np.argmin(costs)]))
+        return sorted(t for t in chain if t > self.confirmed_)
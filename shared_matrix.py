@@ -0,0 +1,202 @@
+"""
+Feature matrix shared between worker processes without copying.
+
+The parallel paths of calculate_change_points, penalty_sweep_change_points, generate_vlm_display and generate_vlm_report
+used to pickle every chunk of feature columns (and the index) into each task. A SharedFeatureMatrix copies the feature
+values once, column major so every column is contiguous, into a multiprocessing.shared_memory block (or a memory-mapped
+temporary file when /dev/shm is too small, e.g. docker's 64MB default). Tasks then only carry the small handle and the
+positions of their columns, and workers read the columns as views of the shared block:
+
+    with SharedFeatureMatrix(df) as matrix:
+        tasks = ((matrix, slice(i, i+16)) for i in range(0, matrix.shape[1], 16))
+        ...
+    # in the worker
+    x, Y = matrix.index, matrix.values[:, cols]
+
+The process that created the matrix owns the block and removes it on close(). Workers attach on first use and keep the
+attachment for the life of the process.
+"""
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+
+
+SHM_DIR = '/dev/shm'
+
+# per-process attachments of the blocks created elsewhere, keyed by block name
+_attached = {}
+
+
+
+def _shm_free_bytes()->int:
+    """
+    Free space of the shared memory filesystem (None where it cannot be queried)
+    """
+    try:
+        stat = os.statvfs(SHM_DIR)
+    except (OSError, AttributeError):
+        return None
+    return stat.f_bavail*stat.f_frsize
+
+
+def shareable(df:pd.DataFrame)->bool:
+    """
+    Can the DataFrame be held in a SharedFeatureMatrix: all columns of one plain numpy int or float dtype, so a block of
+    shared columns has the same dtype as df.iloc[:, cols].values (mixed, bool, object and extension dtypes are not shared)
+    """
+    dtypes = set(df.dtypes)
+    if len(dtypes) != 1:
+        return False
+    dtype = dtypes.pop()
+    return isinstance(dtype, np.dtype) and dtype.kind in 'iuf'
+
+
+
+def _index_state(x:pd.Index)->tuple:
+    """
+    (values to place in the block or None, metadata to rebuild the index) of a feature index
+    """
+    if isinstance(x, pd.DatetimeIndex):
+        return x.asi8, ('datetime', x.name, None if x.tz is None else str(x.tz), x.freqstr)
+    if not isinstance(x, pd.RangeIndex) and x.dtype.kind in 'iuf' and isinstance(x.dtype, np.dtype):
+        return np.asarray(x), ('numeric', x.name, str(x.dtype))
+    # range (a few numbers) and object indexes travel pickled in the handle
+    return None, ('pickle', pickle.dumps(x, protocol=4))
+
+
+def _index_from_state(values:np.ndarray, meta:tuple)->pd.Index:
+    kind = meta[0]
+    if kind == 'datetime':
+        _, name, tz, freq = meta
+        x = pd.DatetimeIndex(values.astype('datetime64[ns]'), name=name)
+        if tz is not None:
+            x = x.tz_localize('UTC').tz_convert(tz)
+        if freq is not None and len(x) > 0:
+            x = pd.DatetimeIndex(x, freq=freq)
+        return x
+    if kind == 'numeric':
+        return pd.Index(values.copy(), name=meta[1], dtype=meta[2])
+    return pickle.loads(meta[1])
+
+
+
+class SharedFeatureMatrix:
+    """
+    Feature values of a DataFrame placed once in memory shared by all processes, with the index and column names
+    alongside. The handle is picklable: a copy sent to a worker process attaches to the same block
+
+    INPUTS:
+    df: feature DataFrame with columns of one int or float dtype (see shareable)
+    dir: None to use shared memory (falling back to a memory-mapped file in the temporary directory when /dev/shm has
+         too little free space), or a directory for the memory-mapped file
+
+    Attributes: shape, dtype, columns, index (pd.Index) and values (read-only 2d Fortran-ordered numpy array, a view of
+    the shared block)
+    """
+
+    def __init__(self, df:pd.DataFrame, dir:str = None):
+        if not shareable(df):
+            raise TypeError('Shared feature matrices need columns of one int or float dtype, got '+str(sorted(set(map(str, df.dtypes)))))
+        self.shape = df.shape
+        self.dtype = df.dtypes.iloc[0]
+        self.columns = df.columns
+        index_values, self._index_meta = _index_state(df.index)
+        matrix_bytes = self.shape[0]*self.shape[1]*self.dtype.itemsize
+        self._index_len = 0 if index_values is None else len(index_values)
+        self._index_dtype = None if index_values is None else index_values.dtype
+        size = max(1, matrix_bytes + (0 if index_values is None else index_values.nbytes))
+
+        free = _shm_free_bytes()
+        if dir is None and (free is None or free >= size):
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self._name, self._path, buffer = shm.name, None, shm.buf
+        else:
+            shm = None
+            fd, self._path = tempfile.mkstemp(prefix='features_', suffix='.bin', dir=dir)
+            os.ftruncate(fd, size)
+            os.close(fd)
+            self._name = self._path
+            buffer = np.memmap(self._path, dtype=np.uint8, mode='r+', shape=(size,))
+        self._owner = os.getpid()
+
+        try:
+            values, index = self._views(buffer, writeable=True)
+            for j in range(self.shape[1]):
+                values[:, j] = df.iloc[:, j].values
+            if index_values is not None:
+                index[:] = index_values
+            values.flags.writeable = False
+        except BaseException:
+            values = index = buffer = None
+            self._release(shm, unlink=True)
+            raise
+        self._shm, self._buffer = shm, buffer
+        self.values = values
+        self.index = df.index
+
+    def _views(self, buffer, writeable:bool = False)->tuple:
+        """
+        (values, index values or None) arrays over a block
+        """
+        values = np.ndarray(self.shape, dtype=self.dtype, buffer=buffer, order='F')
+        index = None
+        if self._index_dtype is not None:
+            index = np.ndarray((self._index_len,), dtype=self._index_dtype, buffer=buffer, offset=values.nbytes)
+        if not writeable:
+            values.flags.writeable = False
+        return values, index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ['_shm', '_buffer', 'values', 'index']:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # attach once per process, later handles to the same block reuse the views
+        if self._name not in _attached:
+            if self._path is None:
+                shm = shared_memory.SharedMemory(name=self._name)
+                buffer = shm.buf
+            else:
+                shm = None
+                buffer = np.memmap(self._path, dtype=np.uint8, mode='r')
+            values, index = self._views(buffer)
+            _attached[self._name] = (shm, values, _index_from_state(index, self._index_meta))
+        self._shm, self._buffer = None, None
+        _, self.values, self.index = _attached[self._name]
+
+    def _release(self, shm, unlink:bool):
+        if shm is not None:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        elif unlink and self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+
+    def close(self):
+        """
+        Release the block. In the creating process this also removes it, so it must outlive the tasks using it
+        """
+        if getattr(self, '_owner', None) != os.getpid() or (self._shm is None and self._buffer is None):
+            return
+        self.values, self.index = None, None
+        shm, self._shm, self._buffer = self._shm, None, None
+        self._release(shm, unlink=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+from change_point_table import drop_end_changepoints
+from model_monitoring import synthetic_features, calculate_change_points
+
+
+def _legacy_drop_end_changepoints(change_points, explode=True, keep_percentiles=[25,50,75]):
+    # the original index based version, which the vectorized drop_end_changepoints replaces
+    df_cp = change_points.copy()
+    df_cp1 = df_cp.set_index(['feature_name','datetime'])
+    df_cp2 = df_cp.drop_duplicates(subset='feature_name',keep='last').set_index(['feature_name','datetime'])
+    df_cp3 = df_cp1.drop(df_cp2.index).round(2).reset_index()
+    if explode:
+        df_cp3 = df_cp3.set_index(['feature_name','datetime']).apply(pd.Series.explode).reset_index()
+        df_cp3 = df_cp3[df_cp3['percentile'].isin(keep_percentiles)]
+    return df_cp3.reset_index(drop=True)
+
+
+@pytest.mark.parametrize('explode', [True, False])
+@pytest.mark.parametrize('keep_percentiles', [[25,50,75], [50]])
+def test_drop_end_changepoints_matches_legacy(explode, keep_percentiles):
+    # up to 10 features, the legacy explode needs the (feature_name, datetime) index sorted
+    df = synthetic_features(n_features=10, n_history=365, end_date='2022-06-06', seed=7)
+    change_points = calculate_change_points(df, explode=False, bad_data_checks=['NaN','Inf','Zero'])
+    # the legacy version needs unique (feature_name, datetime) pairs, and can only explode list valued rows
+    change_points = change_points.drop_duplicates(subset=['feature_name','datetime']).reset_index(drop=True)
+    if explode:
+        change_points = change_points[change_points['description'] == 'trend/volatility'].reset_index(drop=True)
+    ours = drop_end_changepoints(change_points, explode=explode, keep_percentiles=keep_percentiles)
+    legacy = _legacy_drop_end_changepoints(change_points, explode=explode, keep_percentiles=keep_percentiles)
+    assert len(ours) > 0
+    pd.testing.assert_frame_equal(ours, legacy, check_dtype=False)
@@ -0,0 +1,21 @@
+import os
+import pytest
+import model_monitoring as mm
+
+pypdf = pytest.importorskip('pypdf')
+
+
+def test_parallel_pdf_matches_serial(tmp_path):
+    df = mm.synthetic_features(n_features=12, n_history=200, end_date='2022-06-06', seed=7)
+    change_points = mm.calculate_change_points(df, cost_model='normal', explode=False)
+    serial, parallel = str(tmp_path/'serial.pdf'), str(tmp_path/'parallel.pdf')
+    mm.generate_vlm_display(df, serial, change_points=change_points, n_jobs=1)
+    mm.generate_vlm_display(df, parallel, change_points=change_points, n_jobs=2, chunksize=5)
+    expected = pypdf.PdfReader(serial)
+    # the streamed output is a well formed document (xref offsets and page tree checked)
+    merged = pypdf.PdfReader(parallel, strict=True)
+    assert len(merged.pages) == len(expected.pages) == 12 + 1
+    for page, expected_page in zip(merged.pages, expected.pages):
+        assert page.extract_text() == expected_page.extract_text()
+    # objects shared by the chunks (glyphs, graphics states) are written once
+    assert os.path.getsize(parallel) <= 1.05*os.path.getsize(serial)
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+from model_monitoring import synthetic_features, calculate_change_points
+from grouped_monitoring import calculate_grouped_change_points
+
+
+def test_grouped_matches_per_series():
+    df = synthetic_features(n_features=14, n_history=200, end_date='2022-06-06', seed=9)
+    dflong = df.stack(dropna=False).rename('value').reset_index()
+    dflong.columns = ['timestamp', 'feature', 'value']
+    dflong['market'] = np.where(dflong['feature'].str[-1].astype(int) % 2 == 0, 'uk', 'ie')
+    # series of different lengths and timestamps
+    dflong = dflong[~((dflong['market'] == 'ie') & (dflong['timestamp'] < dflong['timestamp'].iloc[60]))]
+    dflong = dflong.sample(frac=1, random_state=0)
+    
+    grouped = calculate_grouped_change_points(dflong, entity_columns=['market'], cost_model='normal', n_jobs=2, chunksize=3)
+    expected, expected_percentiles = [], []
+    for (market, feature), series in dflong.groupby(['market', 'feature']):
+        df_series = series.set_index('timestamp').sort_index()[['value']].rename(columns={'value':feature})
+        df_cp = calculate_change_points(df_series, cost_model='normal')
+        expected_percentiles.append(df_cp.attrs.pop('series_percentiles').values[0])
+        df_cp.insert(0, 'market', market)
+        expected.append(df_cp)
+    expected = pd.concat(expected, ignore_index=True)
+    pd.testing.assert_frame_equal(grouped, expected)
+    np.testing.assert_array_equal(grouped.attrs['series_percentiles'].values, np.array(expected_percentiles))
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+from model_monitoring import synthetic_features, calculate_change_points
+
+
+def _features():
+    return synthetic_features(n_features=28, n_history=365, end_date='2022-06-06', seed=5)
+
+
+@pytest.mark.parametrize('cost_model', ['rbf', 'normal'])
+def test_tiered_screening_matches_full_run(cost_model):
+    df = _features()
+    full = calculate_change_points(df, cost_model=cost_model)
+    tiered = calculate_change_points(df, cost_model=cost_model, screen_penalty=10)
+    pd.testing.assert_frame_equal(tiered, full)
+    pd.testing.assert_frame_equal(tiered.attrs['series_percentiles'], full.attrs['series_percentiles'])
+
+
+@pytest.mark.parametrize('kwargs', [dict(cost_model='normal'),
+                                    dict(cost_model='rbf', bad_data='runs', bad_data_checks=['NaN','Inf','Zero','Constant']),
+                                    dict(cost_model='normal', screen_penalty=10)])
+def test_parallel_matches_serial(kwargs):
+    df = _features()
+    serial = calculate_change_points(df, **kwargs)
+    parallel = calculate_change_points(df, n_jobs=2, chunksize=5, **kwargs)
+    pd.testing.assert_frame_equal(parallel, serial)
+    # column chunks are sent to the workers one at a time
+    chunked = calculate_change_points((df.iloc[:, i:i+6] for i in range(0, df.shape[1], 6)), n_jobs=2, chunksize=5, **kwargs)
+    pd.testing.assert_frame_equal(chunked, serial)
@@ -0,0 +1,45 @@
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+import segmentation
+from model_monitoring import synthetic_features, calculate_change_points
+from online_monitoring import OnlineChangePointDetector
+
+
+@pytest.mark.parametrize('chunks', [[365], [2, 1, 100, 262], [50]*8])
+def test_online_matches_batch_with_leading_bad_rows(chunks):
+    df = synthetic_features(n_features=7, n_history=365, end_date='2022-06-06', seed=2)
+    df.iloc[:3, :] = np.nan
+    df.iloc[:40, 2] = np.inf
+    batch = calculate_change_points(df, cost_model='normal', rolling_sd_window=None, explode=False)
+    detector = OnlineChangePointDetector()
+    pos = 0
+    for k in chunks:
+        detector.update(df.iloc[pos:pos+k])
+        pos += k
+    online = detector.change_points(explode=False)
+    pd.testing.assert_frame_equal(online, batch)
+
+
+def test_online_pelt_lookback_is_exact_with_frequent_changes():
+    rng = np.random.RandomState(1)
+    y = np.repeat(rng.randn(40)*3, 500) + rng.randn(20000)
+    algo = segmentation.OnlinePelt(pen=10, model='normal', max_lookback=2000)
+    confirmed = []
+    for i in range(0, len(y), 700):
+        confirmed += algo.update(y[i:i+700])
+    batch = segmentation.Pelt(model='normal', scale=algo.scale_, center=algo.center_).fit(y).predict(10)
+    assert confirmed + algo.predict() == batch
+
+
+def test_online_state_is_bounded_without_changes():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({'a':rng.randn(60000)}, index=pd.date_range('2020-01-01', periods=60000, freq='min'))
+    detector = OnlineChangePointDetector(max_lookback=2000)
+    sizes = []
+    for i in range(0, len(df), 5000):
+        detector.update(df.iloc[i:i+5000])
+        sizes.append(len(pickle.dumps(detector)))
+    assert max(sizes) < 1.5*sizes[0]
+    assert len(detector.features['a'].y_tail) <= 2000 + 5000
@@ -0,0 +1,46 @@
+import warnings
+import numpy as np
+import pytest
+import ruptures as rpt
+import segmentation
+from model_monitoring import synthetic_features
+from feature_segmentation import _clean_feature
+
+
+def _scenarios():
+    df = synthetic_features(n_features=7, n_history=365, end_date='2022-06-06', seed=1234)
+    # an all NaN feature stays NaN after cleaning, and the segmentation runs on finite values
+    return [(name, _clean_feature(df[name].values)) for name in df.columns]
+
+
+@pytest.mark.parametrize('model', segmentation.COST_MODELS)
+def test_cumsum_cost_matches_direct_computation(model):
+    rng = np.random.RandomState(0)
+    signal = np.concatenate([rng.randn(50), 3 + 4*rng.randn(70), np.zeros(10)])
+    cost = segmentation.CumSumCost(model=model, min_var=0.1).fit(signal)
+    for start, end in [(0, 130), (0, 50), (50, 120), (120, 130), (17, 18), (3, 61)]:
+        segment = signal[start:end]
+        if model == 'l2':
+            expected = 0.5*np.sum((segment - segment.mean())**2)
+        else:
+            expected = 0.5*len(segment)*np.log(max(segment.var(), 0.1))
+        assert cost.error(start, end) == pytest.approx(expected, rel=1e-9, abs=1e-9)
+    # broadcast over candidate starts
+    starts = np.array([0, 10, 60])
+    assert np.allclose(cost.error(starts, 100), [cost.error(s, 100) for s in starts])
+    assert cost.sum_of_costs([50, 120, 130]) == pytest.approx(cost.error(0, 50) + cost.error(50, 120) + cost.error(120, 130))
+
+
+@pytest.mark.parametrize('model', segmentation.COST_MODELS)
+@pytest.mark.parametrize('pen', [5, 10, 30])
+def test_pelt_matches_ruptures(model, pen):
+    for name, y in _scenarios():
+        y = y[np.isfinite(y)]
+        algo = segmentation.Pelt(model=model, min_var=1e-12).fit(y)
+        ours = algo.predict(pen=pen)
+        # the costs here are half the ruptures costs (gaussian negative log likelihoods) on the standardised signal
+        z = (y - algo.center_)/algo.scale_
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            theirs = rpt.Pelt(model=model, min_size=2, jump=5).fit(z).predict(pen=2*pen)
+        assert ours == theirs, name
@@ -0,0 +1,690 @@
+"""
+Variable level monitoring reports: the multi page pdf of generate_vlm_display and the downsampled html / png report of
+generate_vlm_report, one page per feature with the calculate_change_points output overlaid and a change point summary.
+"""
+import os
+import io
+import re
+import html
+import base64
+import hashlib
+import warnings
+import pandas as pd
+import numpy as np
+from matplotlib.backends.backend_pdf import PdfPages
+import matplotlib.pylab as plt
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+import profiling
+from result_cache import ResultCache
+from shared_matrix import SharedFeatureMatrix, shareable
+from quantile_sketch import sketch_percentiles
+from change_point_table import BAD_DATA_CHECKS, drop_end_changepoints
+from feature_pool import _ordered_parallel_map, _resolve_cache, _resolve_n_jobs
+
+
+
+def _render_feature_page(feature_name, x, y:np.ndarray,
+                         percentiles:list = [25,50,75],
+                         percentile_lines:bool=False,
+                         cp_trend:pd.DataFrame = None,
+                         cp_bad:pd.DataFrame = None,
+                         change_point_percentile_lines:bool=True,
+                         plot_index:np.ndarray = None,
+                         figsize:tuple = (8.27, 11.69),
+                         y_percentiles:np.ndarray = None):
+    """
+    Draw the vlm page of one feature
+    
+    INPUTS:
+    feature_name: name of the feature
+    x: index (datetimes) of the feature timeseries
+    y: numpy array of feature values
+    cp_trend: None or the trend/volatility change points of this feature
+    cp_bad: None or the bad data change points of this feature
+    plot_index: None or the positions of the points to plot (see downsample_index). Percentiles always use the full series
+    figsize: figure size in inches
+    y_percentiles: None or the precomputed whole-series percentiles (see series_percentiles)
+    remaining inputs as in generate_vlm_display
+    
+    OUTPUT:
+    fig: matplotlib figure of the page (closing it is up to the caller)
+    """
+    # Create a figure instance (ie. a new page)
+    fig = plt.figure(figsize=figsize, dpi=100)
+    ax1 = fig.add_subplot(111)
+    
+    # Plot variable-level data
+    if y_percentiles is None:
+        y_percentiles = np.percentile(y, percentiles) 
+    str_pc1 = ', '.join([str(int(pc))+'%' for pc in percentiles])+' percentiles'
+    str_pc2 = ', '.join([str(np.round(pc,2)) for pc in y_percentiles])
+    
+    # add change points
+    str_pc0 = '\n'
+    if cp_trend is not None:
+        ncp = len(cp_trend)
+        if ncp > 1:
+            str_pc0 = str(int(ncp-1))+' change points detected\n'
+        for i2 in range(ncp):
+            datetime = cp_trend['datetime'].iloc[i2]
+            if ((ncp > 1) and (i2 < ncp-1)):
+                ax1.axvline(datetime,color='k',linewidth=2)
+            if change_point_percentile_lines:
+                ypc = cp_trend['value'].iloc[i2]
+                ax1.axhline(ypc[0],ls=':',color='k')
+                ax1.axhline(ypc[1],ls='--',color='k')
+                ax1.axhline(ypc[2],ls=':',color='k')
+    
+    #add bad data change points (one span per run, or one line per row)
+    if cp_bad is not None:
+        for i3 in range(len(cp_bad)):
+            datetime = cp_bad['datetime'].iloc[i3]
+            if i3==0:
+                lab = 'Bad Data'
+            else:
+                lab=None
+            if 'end_datetime' in cp_bad.columns:
+                ax1.axvspan(datetime,cp_bad['end_datetime'].iloc[i3],color='r',alpha=0.2,label=lab)
+            else:
+                ax1.axvline(datetime,color='r',linewidth=2,label=lab,ls=':')
+    
+    str_pc = str_pc0+ str_pc1+'\n'+str_pc2
+    
+    label = feature_name+': '+ str_pc            
+    if plot_index is not None:
+        ax1.plot(x[plot_index], y[plot_index],label=label,zorder=0)
+    else:
+        ax1.plot(x, y,label=label,zorder=0)
+    ax1.set_ylabel('value')
+    
+    #show percentiles (unless the change point levels are drawn)
+    if percentile_lines and (cp_trend is None or len(cp_trend) == 0):
+        ax1.axhline(y_percentiles[0],ls=':',color='k')
+        ax1.axhline(y_percentiles[1],ls='--',color='k')
+        ax1.axhline(y_percentiles[2],ls=':',color='k')
+    
+    # titles
+    ax1.set_title(feature_name)
+    ax1.legend()
+    ax1.grid()
+    return fig
+
+
+def _summary_table(change_points_trend:pd.DataFrame)->pd.DataFrame:
+    """
+    Change point summary table: the trend/volatility change points without the end of series points
+    """
+    return drop_end_changepoints(change_points_trend.drop(columns=['end_datetime','length'], errors='ignore'))
+
+
+SUMMARY_ROWS_PER_PAGE = 40
+
+
+def _render_summary_pages(change_points_trend:pd.DataFrame, rows_per_page:int = SUMMARY_ROWS_PER_PAGE):
+    """
+    Generator of the change point summary table pages, rows_per_page change points each (none when there are no change
+    points to report). One table of every change point grows with the number of features, so the caller saves and
+    closes each figure before the next is drawn
+    """
+    df_cp3 = _summary_table(change_points_trend)
+    n_pages = -(-len(df_cp3)//rows_per_page)
+    for page in range(n_pages):
+        rows = df_cp3.iloc[page*rows_per_page:(page + 1)*rows_per_page]
+        fig = plt.figure()
+        fig.suptitle('VLM Change Point Summary' + ('' if n_pages == 1 else ' (%d/%d)' % (page + 1, n_pages)))
+        table = plt.table(cellText=rows.values, colLabels=rows.columns, loc='center',
+              colWidths=[0.1 for col in range(rows.columns.size)])
+        table.auto_set_font_size(True)
+        #table.set_fontsize(24)
+        #table.scale(2, 2)
+        plt.axis('off')
+        yield fig
+
+
+def _index_change_points(change_points:pd.DataFrame)->tuple:
+    """
+    Split the change points by type and feature in a single pass, so page lookups do not rescan the whole frame
+    
+    INPUTS:
+    change_points: pd.dataframe output of calculate_change_points
+    
+    OUTPUT:
+    change_points_trend: the trend/volatility change points (for the summary table)
+    cp_index: dict of feature_name -> (cp_trend, cp_bad) for every feature with change points
+    no_change_points: (cp_trend, cp_bad) empty frames for the remaining features
+    """
+    description = change_points['description']
+    change_points_trend = change_points[(description=='trend/volatility').values]
+    change_points_bad = change_points[description.isin(BAD_DATA_CHECKS).values]
+    empty_trend, empty_bad = change_points_trend.iloc[:0], change_points_bad.iloc[:0]
+    cp_index = {}
+    for feature_name, cp_trend in change_points_trend.groupby('feature_name', sort=False):
+        cp_index[feature_name] = (cp_trend, empty_bad)
+    for feature_name, cp_bad in change_points_bad.groupby('feature_name', sort=False):
+        cp_index[feature_name] = (cp_index.get(feature_name, (empty_trend,))[0], cp_bad)
+    return change_points_trend, cp_index, (empty_trend, empty_bad)
+
+
+def series_percentiles(dfin:pd.DataFrame, percentiles:list = [25,50,75])->pd.DataFrame:
+    """
+    Whole-series percentiles of every feature, one vectorized np.percentile call per block of about 2**20 values
+    
+    INPUTS:
+    dfin: Input dataframe of timeseries features
+    percentiles: Percentiles to compute
+    
+    OUTPUT:
+    pd.DataFrame indexed by feature name with one column per percentile (NaN for features holding a NaN, as np.percentile)
+    """
+    nx, ny = dfin.shape
+    block = max(1, 2**20//max(nx, 1))
+    values = np.zeros((ny, len(percentiles)))
+    for i in range(0, ny, block):
+        values[i:i+block] = np.percentile(dfin.iloc[:, i:i+block].values.astype(float), percentiles, axis=0).T
+    return pd.DataFrame(values, index=dfin.columns, columns=list(percentiles))
+
+
+def _cached_series_percentiles(dfin:pd.DataFrame, change_points:pd.DataFrame = None, percentiles:list = [25,50,75],
+                               percentile_sketches:pd.DataFrame = None)->pd.DataFrame:
+    """
+    Whole-series percentiles for the report: from the merged percentile_sketches when given, else reused from
+    calculate_change_points (change_points.attrs) when they cover the same features and percentiles, else computed once
+    for all features
+    """
+    if percentile_sketches is not None:
+        return sketch_percentiles(percentile_sketches.reindex(index=dfin.index, columns=dfin.columns), percentiles)
+    if change_points is not None:
+        cached = change_points.attrs.get('series_percentiles')
+        if cached is not None and list(cached.columns) == list(percentiles) and dfin.columns.isin(cached.index).all():
+            return cached
+    return series_percentiles(dfin, percentiles)
+
+
+def _feature_page_args(df:pd.DataFrame, cp_index:dict = None, no_change_points:tuple = (None, None), y_percentiles:pd.DataFrame = None,
+                       matrix:SharedFeatureMatrix = None):
+    """
+    Generator of (feature_name, y, cp_trend, cp_bad, y_percentiles) for each page of the display
+    
+    INPUTS:
+    df: feature dataframe
+    cp_index, no_change_points: None or the per-feature change points from _index_change_points
+    y_percentiles: None or the whole-series percentiles from _cached_series_percentiles
+    matrix: None or a SharedFeatureMatrix of df, in which case y is the column position (see _shared_pages)
+    """
+    for j, feature_name in enumerate(df.columns):
+        cp_trend, cp_bad = no_change_points
+        if cp_index is not None:
+            cp_trend, cp_bad = cp_index.get(feature_name, no_change_points)
+        pc = None if y_percentiles is None else y_percentiles.loc[feature_name].values
+        yield feature_name, df[feature_name].values if matrix is None else j, cp_trend, cp_bad, pc
+
+
+def _shared_pages(x, pages:list)->tuple:
+    """
+    (index, pages) of a page rendering task, reading the values of pages sent with a SharedFeatureMatrix x (whose pages
+    carry column positions) from shared memory
+    """
+    if not isinstance(x, SharedFeatureMatrix):
+        return x, pages
+    return x.index, [(feature_name, x.values[:, j], cp_trend, cp_bad, pc) for feature_name, j, cp_trend, cp_bad, pc in pages]
+
+
+def _page_chunks(pages, chunksize:int = 16):
+    """
+    Generator of lists of up to chunksize pages, consuming pages lazily
+    """
+    chunksize = max(1, int(chunksize))
+    chunk = []
+    for page in pages:
+        chunk.append(page)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _render_page_chunks(func, dfin:pd.DataFrame, page_kwargs:dict, task_args:tuple, n_jobs:int = 1, chunksize:int = 16):
+    """
+    Render the feature pages in chunks with func(x, pages, *task_args), serially or over a process pool. In parallel the
+    features are placed in a SharedFeatureMatrix once and the tasks carry column positions instead of the values
+    
+    INPUTS:
+    func: _render_pages_pdf or _render_pages_png
+    dfin: feature dataframe
+    page_kwargs: change point and percentile inputs of _feature_page_args
+    task_args: remaining func inputs
+    n_jobs, chunksize: as in generate_vlm_display
+    
+    OUTPUT:
+    generator of func results in feature order
+    """
+    if n_jobs > 1 and shareable(dfin):
+        with SharedFeatureMatrix(dfin) as matrix:
+            pages = _feature_page_args(dfin, matrix=matrix, **page_kwargs)
+            chunks = _ordered_parallel_map(func, ((matrix, chunk)+task_args for chunk in _page_chunks(pages, chunksize)), n_jobs)
+            # the workers are done with the shared block before it is removed
+            try:
+                yield from chunks
+            finally:
+                chunks.close()
+        return
+    pages = _feature_page_args(dfin, **page_kwargs)
+    tasks = ((dfin.index, chunk)+task_args for chunk in _page_chunks(pages, chunksize))
+    if n_jobs == 1:
+        for task in tasks:
+            yield func(*task)
+    else:
+        yield from _ordered_parallel_map(func, tasks, n_jobs)
+
+
+def _render_pages_pdf(x, pages:list, kwargs:dict)->bytes:
+    """
+    Process pool task: render a chunk of feature pages to an in-memory pdf, closing each figure once it is saved
+    
+    INPUTS:
+    x: index (datetimes) of the feature timeseries, or the SharedFeatureMatrix holding the features
+    pages: list of (feature_name, y, cp_trend, cp_bad, y_percentiles), y the column position with a SharedFeatureMatrix
+    kwargs: remaining _render_feature_page inputs
+    
+    OUTPUT:
+    bytes of the pdf document holding the chunk's pages
+    """
+    x, pages = _shared_pages(x, pages)
+    buffer = io.BytesIO()
+    with PdfPages(buffer) as pdf_pages:
+        for feature_name, y, cp_trend, cp_bad, y_percentiles in pages:
+            with profiling.stage('render_page', feature_name):
+                fig = _render_feature_page(feature_name, x, y, cp_trend=cp_trend, cp_bad=cp_bad, y_percentiles=y_percentiles, **kwargs)
+            with profiling.stage('save_page', feature_name):
+                pdf_pages.savefig(fig)
+                plt.close(fig)
+    return buffer.getvalue()
+
+
+class _PdfAppender:
+    """
+    Writes the pages of pdf documents (matplotlib PdfPages output) to one output pdf as they arrive, so only the document
+    being appended is held in memory (pypdf.PdfWriter keeps every appended page until the output is written)
+    
+    The objects reachable from each page are written depth first, each after the objects it references, so an object
+    identical to one already written (the glyph procedures, graphics states and patterns every chunk embeds) is replaced
+    by a reference to it. The page tree, catalog and cross reference table are written at close. Only the public pypdf
+    reader and generic objects are used, with pypdf 3.17 (requirements.txt) and 6.x.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.offsets = []
+        self.pages = []
+        # sha1 of each shareable object written -> its number
+        self.written = {}
+        self.f.write(b'%PDF-1.4\n%\xac\xdc \xab\xba\n')
+        # written at close
+        self.pages_id = self._new_object()
+        self.catalog_id = self._new_object()
+    
+    def _new_object(self)->int:
+        self.offsets.append(None)
+        return len(self.offsets)
+    
+    def _write_object(self, obj, idnum:int = None)->int:
+        """
+        Write obj and return its number. Without idnum an identical object already written is reused instead
+        """
+        body = io.BytesIO()
+        obj.write_to_stream(body)
+        body = body.getvalue()
+        if idnum is None:
+            digest = hashlib.sha1(body).digest()
+            if digest in self.written:
+                return self.written[digest]
+            idnum = self.written[digest] = self._new_object()
+        self.offsets[idnum - 1] = self.f.tell()
+        self.f.write(b'%d 0 obj\n' % idnum + body + b'\nendobj\n')
+        return idnum
+    
+    def _copy(self, obj, numbers:dict):
+        """
+        Replace the references of obj (in place) by references to output objects, writing the objects not seen before
+        
+        INPUTS:
+        obj: pypdf object of the document being appended
+        numbers: dict of (object number, generation) in the document -> output object number
+        """
+        if isinstance(obj, pypdf.generic.IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key not in numbers:
+                # None while the object's own references are written
+                numbers[key] = None
+                numbers[key] = self._write_object(self._copy(obj.get_object(), numbers))
+            if numbers[key] is None:
+                raise ValueError('Reference cycles below the pages of a pdf cannot be appended')
+            return pypdf.generic.IndirectObject(numbers[key], 0, None)
+        if isinstance(obj, pypdf.generic.StreamObject) and '/Length' in obj:
+            # streams are written with the length of their data, an indirect length would be left unused
+            del obj['/Length']
+        if isinstance(obj, pypdf.generic.DictionaryObject):
+            for key, value in list(obj.items()):
+                obj[key] = self._copy(value, numbers)
+        elif isinstance(obj, pypdf.generic.ArrayObject):
+            for j, value in enumerate(obj):
+                obj[j] = self._copy(value, numbers)
+        return obj
+    
+    def append(self, pdf):
+        """
+        Write the pages of pdf (bytes or a file object) to the output
+        """
+        reader = pypdf.PdfReader(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf)
+        numbers = {}
+        for page in reader.pages:
+            page = page.get_object()
+            if '/Parent' in page:
+                del page['/Parent']
+            self._copy(page, numbers)
+            page[pypdf.generic.NameObject('/Parent')] = pypdf.generic.IndirectObject(self.pages_id, 0, None)
+            self.pages.append(self._write_object(page, self._new_object()))
+    
+    def close(self):
+        """
+        Write the page tree, catalog, cross reference table and trailer
+        """
+        name = pypdf.generic.NameObject
+        kids = pypdf.generic.ArrayObject([pypdf.generic.IndirectObject(idnum, 0, None) for idnum in self.pages])
+        self._write_object(pypdf.generic.DictionaryObject({name('/Type'):name('/Pages'), name('/Kids'):kids,
+                                                           name('/Count'):pypdf.generic.NumberObject(len(self.pages))}), self.pages_id)
+        self._write_object(pypdf.generic.DictionaryObject({name('/Type'):name('/Catalog'),
+                                                           name('/Pages'):pypdf.generic.IndirectObject(self.pages_id, 0, None)}), self.catalog_id)
+        xref = self.f.tell()
+        self.f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(self.offsets) + 1))
+        self.f.write(b''.join(b'%010d 00000 n \n' % offset for offset in self.offsets))
+        self.f.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(self.offsets) + 1, self.catalog_id, xref))
+
+
+def generate_vlm_display(dfin:pd.DataFrame, pdf_file:str, 
+                         percentiles:list = [25,50,75], 
+                         percentile_lines:bool=False, 
+                         change_points = None,
+                         change_point_percentile_lines:bool=True,
+                         n_jobs:int = 1,
+                         chunksize:int = 16,
+                         percentile_sketches:pd.DataFrame = None):
+    """
+    Visualise the results of variable level monitoring. Creates a multi page pdf with vlm timeseries plots (one per page) and optiona change points overlaid.
+    
+    Each figure is closed as soon as its page is saved and the change point summary table is split over pages of
+    SUMMARY_ROWS_PER_PAGE rows. With n_jobs > 1 chunks of pages are rendered to pdf in a process pool and written to the
+    output in feature order as they complete (needs the pypdf package, otherwise pages are rendered serially).
+    
+    INPUTS:
+    dfin: Input dataframe of timeseries features
+    pdf_file: The output filename to save the multipage pdf
+    percentiles: The percentiles to draw on the charts
+    percentile_lines: bool. Do we show percentiles?
+    change_points: None or pd.dataframe output of the change point analysis in the calculate_change_points function
+    change_point_percentile_lines: bool. Do we show change point percentiles for each change point split?
+    n_jobs: number of worker processes. 1 (default) renders serially, None or -1 uses all cores
+    chunksize: number of pages rendered per process pool task
+    percentile_sketches: None or per-row quantile sketches of the features (see calculate_change_points), to draw the
+                         whole-series percentiles from the sketches instead of dfin
+    
+    OUTPUT:
+    None
+    """
+    kwargs = dict(percentiles=percentiles,
+                  percentile_lines=percentile_lines,
+                  change_point_percentile_lines=change_point_percentile_lines)
+    x = dfin.index
+    cp_index, no_change_points = None, (None, None)
+    if change_points is not None:
+        change_points_trend, cp_index, no_change_points = _index_change_points(change_points)
+    page_kwargs = dict(cp_index=cp_index, no_change_points=no_change_points,
+                       y_percentiles=_cached_series_percentiles(dfin, change_points, percentiles, percentile_sketches))
+    n_jobs = _resolve_n_jobs(n_jobs)
+    if n_jobs > 1 and pypdf is None:
+        warnings.warn('Parallel rendering needs the pypdf package, rendering serially')
+        n_jobs = 1
+    
+    if n_jobs == 1:
+        with PdfPages(pdf_file) as pdf_pages:
+            for feature_name, y, cp_trend, cp_bad, y_percentiles in _feature_page_args(dfin, **page_kwargs):
+                with profiling.stage('render_page', feature_name):
+                    fig = _render_feature_page(feature_name, x, y, cp_trend=cp_trend, cp_bad=cp_bad, y_percentiles=y_percentiles, **kwargs)
+                # Done with the page
+                with profiling.stage('save_page', feature_name):
+                    pdf_pages.savefig(fig)
+                    plt.close(fig)
+            
+            # save change point data to pdf
+            if change_points is not None:
+                with profiling.stage('summary_page'):
+                    for fig in _render_summary_pages(change_points_trend):
+                        pdf_pages.savefig(fig)
+                        plt.close(fig)
+        return
+    
+    with open(pdf_file, 'wb') as f:
+        writer = _PdfAppender(f)
+        for chunk_pdf in _render_page_chunks(_render_pages_pdf, dfin, page_kwargs, (kwargs,), n_jobs, chunksize):
+            with profiling.stage('merge_pdf'):
+                writer.append(chunk_pdf)
+        
+        # save change point data to pdf
+        if change_points is not None:
+            with profiling.stage('summary_page'):
+                buffer = io.BytesIO()
+                with PdfPages(buffer) as pdf_pages:
+                    for fig in _render_summary_pages(change_points_trend):
+                        pdf_pages.savefig(fig)
+                        plt.close(fig)
+                    n_pages = pdf_pages.get_pagecount()
+                if n_pages > 0:
+                    writer.append(buffer.getvalue())
+        with profiling.stage('merge_pdf'):
+            writer.close()
+
+
+DOWNSAMPLE_METHODS = ['minmax','lttb']
+REPORT_FORMATS = ['html','png']
+
+
+def _minmax_index(y:np.ndarray, n_buckets:int)->np.ndarray:
+    """
+    Positions of the minimum and maximum of y in each of n_buckets equal buckets
+    """
+    n = len(y)
+    size = int(np.ceil(n/n_buckets))
+    blocks = np.full(int(np.ceil(n/size))*size, np.nan)
+    blocks[:n] = y
+    blocks = blocks.reshape(-1, size)
+    base = np.arange(len(blocks))*size
+    lo = np.argmin(np.where(np.isnan(blocks), np.inf, blocks), axis=1)
+    hi = np.argmax(np.where(np.isnan(blocks), -np.inf, blocks), axis=1)
+    return np.concatenate([base + lo, base + hi])
+
+
+def _lttb_index(y:np.ndarray, n_out:int)->np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets (Steinarsson 2013) selection of n_out positions of y, using positions as the x axis.
+    The first and last points are kept and each bucket keeps the point forming the largest triangle with the previously
+    kept point and the mean of the next bucket
+    """
+    n = len(y)
+    edges = np.linspace(1, n-1, n_out-1).astype(int)
+    # mean of the bucket after each bucket (reduceat's final bucket is the last point alone)
+    counts = np.diff(np.append(edges, n))
+    valid = ~np.isnan(y)
+    mean_x = (np.add.reduceat(np.arange(n, dtype=float), edges)/counts)[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_y = (np.add.reduceat(np.where(valid, y, 0.0), edges)/np.add.reduceat(valid.astype(float), edges))[1:]
+    
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n-1
+    a = 0
+    for k in range(n_out-2):
+        cx = np.arange(edges[k], edges[k+1])
+        area = np.abs((a - mean_x[k])*(y[cx] - y[a]) - (a - cx)*(mean_y[k] - y[a]))
+        a = int(cx[np.argmax(np.where(np.isnan(area), -1.0, area))])
+        idx[k+1] = a
+    return idx
+
+
+def downsample_index(y:np.ndarray, max_points:int = 2000, method:str = 'minmax')->np.ndarray:
+    """
+    Positions of a shape preserving subsample of a series for plotting
+    
+    'minmax' keeps the minimum and maximum of max_points/2 equal buckets (spikes and drops survive, fully vectorized).
+    'lttb' keeps one visually representative point per bucket (Largest-Triangle-Three-Buckets). The first and last points
+    are always kept, as is the first non-finite value of each bucket so gaps in the data still show as gaps.
+    
+    INPUTS:
+    y: numpy array of feature values
+    max_points: approximate maximum number of points kept
+    method: 'minmax' or 'lttb'
+    
+    OUTPUT:
+    idx: sorted unique positions into y (all positions when len(y) <= max_points)
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError('Unknown downsample method '+str(method)+', expected one of '+str(DOWNSAMPLE_METHODS))
+    n = len(y)
+    if n <= max_points or max_points < 4:
+        return np.arange(n)
+    y = np.where(np.isfinite(y), y, np.nan)
+    if method == 'minmax':
+        idx = _minmax_index(y, max_points//2)
+    else:
+        idx = _lttb_index(y, max_points)
+    # first gap position of each bucket
+    size = int(np.ceil(n/(max_points//2)))
+    gap = np.flatnonzero(np.isnan(y))
+    gap = gap[np.unique(gap//size, return_index=True)[1]]
+    return np.unique(np.minimum(np.concatenate([idx, gap, [0, n-1]]), n-1))
+
+
+def _render_pages_png(x, pages:list, kwargs:dict, max_points:int = 2000, downsample:str = 'minmax', dpi:int = 80, cache:ResultCache = None)->list:
+    """
+    Process pool task: render a chunk of downsampled feature pages to png, closing each figure once it is saved
+    
+    INPUTS:
+    x: index (datetimes) of the feature timeseries, or the SharedFeatureMatrix holding the features
+    pages: list of (feature_name, y, cp_trend, cp_bad, y_percentiles), y the column position with a SharedFeatureMatrix
+    kwargs: remaining _render_feature_page inputs
+    max_points, downsample, dpi, cache: as in generate_vlm_report
+    
+    OUTPUT:
+    list of (feature_name, png bytes)
+    """
+    x, pages = _shared_pages(x, pages)
+    out = []
+    x_key = cache.key(x) if cache is not None else None
+    for feature_name, y, cp_trend, cp_bad, y_percentiles in pages:
+        if cache is not None:
+            key = cache.key('_render_pages_png', feature_name, x_key, y, cp_trend, cp_bad, y_percentiles, kwargs, max_points, downsample, dpi)
+            png = cache.get(key)
+            if png is not None:
+                out.append((feature_name, png))
+                continue
+        with profiling.stage('render_page', feature_name):
+            idx = downsample_index(y, max_points, downsample)
+            fig = _render_feature_page(feature_name, x, y, cp_trend=cp_trend, cp_bad=cp_bad, plot_index=idx, y_percentiles=y_percentiles, **kwargs)
+        with profiling.stage('save_page', feature_name):
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format='png', dpi=dpi)
+            plt.close(fig)
+        if cache is not None:
+            cache.put(key, buffer.getvalue())
+        out.append((feature_name, buffer.getvalue()))
+    return out
+
+
+def generate_vlm_report(dfin:pd.DataFrame, output:str,
+                        report_format:str = 'html',
+                        percentiles:list = [25,50,75],
+                        percentile_lines:bool=False,
+                        change_points = None,
+                        change_point_percentile_lines:bool=True,
+                        max_points:int = 2000,
+                        downsample:str = 'minmax',
+                        figsize:tuple = (12, 5),
+                        dpi:int = 80,
+                        n_jobs:int = 1,
+                        chunksize:int = 16,
+                        cache = None,
+                        percentile_sketches:pd.DataFrame = None):
+    """
+    Lightweight alternative to generate_vlm_display: raster pages of downsampled series, as one self-contained html page or
+    a directory of png tiles. Change point overlays and percentile lines are drawn as in the pdf, and the percentiles are
+    computed from the full series, but at most about max_points points are plotted per feature, so the page size and
+    render time do not grow with the history length. Pages are written out as they are rendered.
+    
+    INPUTS:
+    dfin: Input dataframe of timeseries features
+    output: html file (report_format='html') or directory for the png tiles and change_point_summary.csv (report_format='png')
+    report_format: 'html' or 'png'
+    percentiles, percentile_lines, change_points, change_point_percentile_lines: as in generate_vlm_display
+    max_points: maximum number of points plotted per feature
+    downsample: 'minmax' (default, min / max per bucket) or 'lttb' (Largest-Triangle-Three-Buckets), see downsample_index
+    figsize: page size in inches
+    dpi: png resolution
+    n_jobs: number of worker processes. 1 (default) renders serially, None or -1 uses all cores
+    chunksize: number of pages rendered per process pool task
+    cache: None, a result_cache.ResultCache or a cache directory. Rendered pages are cached keyed by the feature values,
+           change points and render parameters, so unchanged pages are not redrawn
+    percentile_sketches: as in generate_vlm_display
+    
+    OUTPUT:
+    None
+    """
+    if report_format not in REPORT_FORMATS:
+        raise ValueError('Unknown report format '+str(report_format)+', expected one of '+str(REPORT_FORMATS))
+    if downsample not in DOWNSAMPLE_METHODS:
+        raise ValueError('Unknown downsample method '+str(downsample)+', expected one of '+str(DOWNSAMPLE_METHODS))
+    kwargs = dict(percentiles=percentiles,
+                  percentile_lines=percentile_lines,
+                  change_point_percentile_lines=change_point_percentile_lines,
+                  figsize=figsize)
+    cp_index, no_change_points = None, (None, None)
+    if change_points is not None:
+        change_points_trend, cp_index, no_change_points = _index_change_points(change_points)
+    page_kwargs = dict(cp_index=cp_index, no_change_points=no_change_points,
+                       y_percentiles=_cached_series_percentiles(dfin, change_points, percentiles, percentile_sketches))
+    cache = _resolve_cache(cache)
+    chunks = _render_page_chunks(_render_pages_png, dfin, page_kwargs, (kwargs, max_points, downsample, dpi, cache),
+                                 _resolve_n_jobs(n_jobs), chunksize)
+    
+    if report_format == 'png':
+        os.makedirs(output, exist_ok=True)
+        i = 0
+        for chunk in chunks:
+            for feature_name, png in chunk:
+                tile = '%05d_%s.png' % (i, re.sub(r'[^A-Za-z0-9_.-]', '_', str(feature_name)))
+                with open(os.path.join(output, tile), 'wb') as f:
+                    f.write(png)
+                i += 1
+        # save change point data (as csv, a table image grows with the number of change points)
+        if change_points is not None:
+            _summary_table(change_points_trend).to_csv(os.path.join(output, 'change_point_summary.csv'), index=False)
+        if cache is not None:
+            cache.evict()
+        return
+    
+    with open(output, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>Variable Level Monitoring</title>\n'
+                '<style>body{font-family:sans-serif} img{max-width:100%} table{border-collapse:collapse} td,th{border:1px solid #ccc;padding:2px 6px}</style>\n'
+                '</head>\n<body>\n<h1>Variable Level Monitoring</h1>\n')
+        for chunk in chunks:
+            for feature_name, png in chunk:
+                name = html.escape(str(feature_name))
+                f.write('<h2>'+name+'</h2>\n<img alt="'+name+'" src="data:image/png;base64,'+base64.b64encode(png).decode('ascii')+'">\n')
+        # save change point data
+        if change_points is not None:
+            df_cp3 = _summary_table(change_points_trend)
+            if len(df_cp3) > 0:
+                f.write('<h2>VLM Change Point Summary</h2>\n'+df_cp3.to_html(index=False)+'\n')
+        f.write('</body>\n</html>\n')
+    if cache is not None:
+        cache.evict()